@@ -1,15 +1,19 @@
 # SPDX-FileCopyrightText: 2023 K.Agata
 # SPDX-License-Identifier: GPL-3.0
 
+import atexit
 import cv2
 import os
+import sys
 import numpy as np
-import slack_sdk
-import pyocr
-from threading import Thread
-from PIL import Image
 from logging import getLogger, FileHandler, StreamHandler, DEBUG
 
+# piswitchパッケージをインポート
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.ocr import OcrService
+from piswitch.capture import Capture, decode_fourcc
+from piswitch.notify import Notifier, SlackBackend, FileBackend
+
 SLACK_TOKEN = os.getenv('SLACK_API_TOKEN')
 SLACK_CHANNEL = os.getenv('SLACK_CHANNEL_ID')
 
@@ -22,37 +26,35 @@ logger.addHandler(FileHandler(f'{os.path.dirname(__file__)}/Common.log'))
 # path_tesseract = "/usr/share/tesseract-ocr/4.00/tessdata"
 # if path_tesseract not in os.environ["PATH"].split(os.pathsep):
 #     os.environ["PATH"] += os.pathsep + path_tesseract
-tools = pyocr.get_available_tools()
-if len(tools) == 0:
-    logger.error("Do not find OCR tools")
-OCR_TOOL = tools[0]
+# OCR_DEBUG_DIRを設定すると、OCRにかけた画像を保存する
+OCR_SERVICE = OcrService(lang="jpn", layout=6, debug_dir=os.getenv('OCR_DEBUG_DIR'))
 
 
-def _send_msg_to_slack(msg_text):
-    try:
-        slack_cl = slack_sdk.WebClient(token=SLACK_TOKEN)
-        slack_cl.chat_postMessage(text=msg_text, channel=SLACK_CHANNEL)
-    except slack_sdk.errors.SlackApiError as e:
-        logger.exception('Slack APIのエラー')
+def _create_notifier():
+    # NOTIFY_DIRを設定すると、Slackの代わりにローカルのディレクトリに保存する
+    notify_dir = os.getenv('NOTIFY_DIR')
+    if notify_dir:
+        return Notifier(FileBackend(notify_dir))
+    return Notifier(SlackBackend(SLACK_TOKEN, SLACK_CHANNEL))
 
-def send_msg_to_slack(msg_text):
-    Thread(target=_send_msg_to_slack, args=(msg_text,)).start()
 
-def _send_img_to_slack(msg_text, file_path):
-    try:
-        slack_cl = slack_sdk.WebClient(token=SLACK_TOKEN)
-        slack_cl.files_upload(channels=SLACK_CHANNEL,
-                              file=file_path,
-                              initial_comment=msg_text)
-    except slack_sdk.errors.SlackApiError as e:
-        logger.exception('Slack APIのエラー')
+NOTIFIER = _create_notifier()
+atexit.register(NOTIFIER.close)  # 終了前に残った通知を送る
+
+
+def send_msg_to_slack(msg_text):
+    NOTIFIER.notify(msg_text)
 
-def send_img_to_slack(msg_text, file_path='ss.jpg'):
-    Thread(target=_send_img_to_slack, args=(msg_text, file_path)).start()
 
-def decode_fourcc(v):
-    v = int(v)
-    return "".join([chr((v >> 8 * i) & 0xFF) for i in range(4)])
+def send_img_to_slack(msg_text, img='ss.jpg'):
+    """
+    img: 画像のデータ(bytes) | 画像ファイルのパス
+    """
+    if isinstance(img, str):
+        # 次のスクリーンショットで上書きされる前に読み込んでおく
+        with open(img, 'rb') as f:
+            img = f.read()
+    NOTIFIER.notify_image(msg_text, img)
 
 
 def img_binarization(img, threshold=127):
@@ -64,60 +66,5 @@ def img_cmp(image1, image2):
     return np.count_nonzero(image1 == image2) / image1.size
 
 
-def ocr(cv2_img):
-    pil_image = Image.fromarray(cv2_img)
-    return OCR_TOOL.image_to_string(
-        pil_image,
-        lang="jpn",
-        builder=pyocr.builders.TextBuilder(tesseract_layout=6))
-
-
-class Capture:
-
-    def __init__(self, device_id=0):
-        self.cap = cv2.VideoCapture(device_id)
-        # self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'))
-        self.cap.set(cv2.CAP_PROP_FOURCC,
-                     cv2.VideoWriter_fourcc('Y', 'U', 'Y', 'V'))
-        # self.cap.set(cv2.CAP_PROP_FPS, 30)
-        # self.cap.set(cv2.CAP_PROP_FPS, 10)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Latency Reduction
-
-        # print(
-        #     f"[{decode_fourcc(self.cap.get(cv2.CAP_PROP_FOURCC))} "
-        #     f"{self.cap.get(cv2.CAP_PROP_FPS):.1f}fps "
-        #     f"{self.cap.get(cv2.CAP_PROP_FRAME_WIDTH):.0f}x{self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT):.0f}]"
-        # )
-
-        if not self.cap.isOpened():
-            logger.error('Could not open device.')
-
-    def __del__(self):
-        self.cap.release()
-
-    def get_screenshot(self, gray=False):
-        self.cap.read()  # 1フレーム読み捨て
-        for i in range(64):
-            ret, cv2_img = self.cap.read()
-            if ret and cv2.countNonZero(cv2_img[0]) > 0:
-                if gray:
-                    return cv2.cvtColor(cv2_img, cv2.COLOR_BGR2GRAY)
-                return cv2_img
-        return None
-
-    def save_screenshot(self, save_path='ss.jpg'):
-        cv2_img = self.get_screenshot()
-        if cv2_img is None:
-            return False
-
-        # リサイズ
-        height = cv2_img.shape[0]
-        width = cv2_img.shape[1]
-        cv2_img = cv2.resize(cv2_img, (int(width * 0.5), int(height * 0.5)))
-
-        # 保存
-        cv2.imwrite(save_path, cv2_img, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
-
-        return True
+def ocr(cv2_img, name=None):
+    return OCR_SERVICE.recognize(cv2_img, name)
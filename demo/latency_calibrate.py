@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: 2023 K.Agata
+# SPDX-License-Identifier: GPL-3.0
+"""
+入力から画面表示までの遅延を計測して img/latency.json に保存する。
+使い方: latency_calibrate.py 名前 ボタン 戻すボタン x y w h [回数]
+例: latency_calibrate.py home_menu dpad_right dpad_left 80 380 1120 250 20
+"""
+
+import sys, os
+
+# piswitchパッケージをインポート
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from piswitch import Procon
+from piswitch.capture import Capture
+from piswitch.latency import LatencyProbe, save_result
+
+RESULT_PATH = os.path.join(os.path.dirname(__file__), "img", "latency.json")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 8:
+        print(__doc__)
+        sys.exit(1)
+    name, btn_key, revert_key = sys.argv[1:4]
+    roi = tuple(int(v) for v in sys.argv[4:8])
+    trials = int(sys.argv[8]) if len(sys.argv) > 8 else 20
+
+    con = Procon()
+    cap = Capture()
+    try:
+        if not con.start():
+            print("Failed to start")
+            sys.exit()
+        # 読み捨てをせず、届いたフレームをそのまま使う
+        probe = LatencyProbe(con, lambda: cap.cap.read()[1], roi)
+        print(probe.measure(btn_key, revert_key, trials=trials))
+        save_result(RESULT_PATH, name, probe)
+        probe.close()
+
+    except KeyboardInterrupt as e:
+        print("\nExiting with keyboard interrupt")
+
+    con.close()
+    print("Done")
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2023 K.Agata
+# SPDX-License-Identifier: GPL-3.0
+"""
+所持金の数字のテンプレートを作成する。
+使い方: learn_digits.py 画像(二値化済み) 写っている文字列 [画像 文字列 ...]
+0~9が全て含まれるように複数の画像を与える。
+"""
+
+import os
+import sys
+import cv2
+
+DIR_NAME = os.path.dirname(__file__)
+
+# piswitchパッケージをインポート
+sys.path.append(os.path.join(DIR_NAME, '..'))
+from piswitch.ocr import DigitRecognizer
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) == 0 or len(args) % 2 != 0:
+        print(__doc__)
+        sys.exit(1)
+
+    recognizer = DigitRecognizer()
+    for img_path, text in zip(args[0::2], args[1::2]):
+        img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+        recognizer.learn(img, text)
+
+    save_path = os.path.join(DIR_NAME, 'img', 'money_digits.npz')
+    recognizer.save(save_path)
+    print(f"{''.join(sorted(recognizer.chars))} -> {save_path}")
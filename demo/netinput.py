@@ -0,0 +1,38 @@
+# SPDX-FileCopyrightText: 2023 K.Agata
+# SPDX-License-Identifier: GPL-3.0
+"""
+ネットワーク経由の入力でSwitchを操作する。
+使い方: netinput.py [UDPポート] [WebSocketポート]
+"""
+
+import sys, os, time
+
+# piswitchパッケージをインポート
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from piswitch import Procon
+from piswitch.netinput import NetInputServer
+
+if __name__ == "__main__":
+    udp_port = int(sys.argv[1]) if len(sys.argv) > 1 else 5600
+    ws_port = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    con = Procon()
+    server = NetInputServer(port=udp_port)
+    con.add_tick_hook(server)
+    try:
+        if not con.start():
+            print("Failed to start")
+            sys.exit()
+        server.start()
+        if ws_port is not None:
+            server.start_websocket(port=ws_port)
+        while True:
+            time.sleep(10)
+            print("stats:", server.stats())
+
+    except KeyboardInterrupt as e:
+        print("\nExiting with keyboard interrupt")
+
+    server.stop()
+    con.close()
+    print("Done")
@@ -0,0 +1,37 @@
+# SPDX-FileCopyrightText: 2023 K.Agata
+# SPDX-License-Identifier: GPL-3.0
+"""
+接続したゲームパッドでSwitchを操作する。
+使い方: passthrough.py /dev/input/eventX
+"""
+
+import sys, os, time
+
+# piswitchパッケージをインポート
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from piswitch import Procon
+from piswitch.passthrough import EvdevSource, Passthrough
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+
+    con = Procon()
+    pt = Passthrough(EvdevSource(sys.argv[1], grab=True))
+    con.add_tick_hook(pt)
+    try:
+        if not con.start():
+            print("Failed to start")
+            sys.exit()
+        pt.start()
+        while True:
+            time.sleep(10)
+            print("latency[ms]:", pt.latency.summary())
+
+    except KeyboardInterrupt as e:
+        print("\nExiting with keyboard interrupt")
+
+    pt.stop()
+    con.close()
+    print("Done")
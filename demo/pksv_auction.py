@@ -12,10 +12,9 @@ OCRを用いて、商品の区別を行う。
 import time
 import sys
 import os
-import cv2
 import logging
 
-from Common import Capture, ocr, img_cmp, img_binarization, send_img_to_slack, send_msg_to_slack
+from Common import Capture, ocr, img_binarization, send_img_to_slack, send_msg_to_slack
 
 DIR_NAME = os.path.dirname(__file__)
 BASE_NAME = os.path.basename(__file__)
@@ -23,66 +22,50 @@ BASE_NAME = os.path.basename(__file__)
 # piswitchをインポートする
 sys.path.append(os.path.join(DIR_NAME, '..'))
 import piswitch
+from piswitch.template import TemplateRegistry
+from piswitch.bitimage import grid_rois, batch_match_ratios
+from piswitch.ocr import DigitRecognizer
+from piswitch.change_detect import ChangeDetector
+from piswitch.automation import StateMachine, CheckpointStore
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.WARNING)
 _logger.addHandler(logging.StreamHandler())
 _logger.addHandler(logging.FileHandler(os.path.join(DIR_NAME, f"{BASE_NAME}.log")))
 
+# テンプレート画像は一度だけ読み込んで使い回す
+templates = TemplateRegistry(os.path.join(DIR_NAME, 'img'))
 
-def party_search(box_img, poke_img, threshold=0.96):
-    _, poke_img = img_binarization(poke_img)
-    x = 171
-    y0 = 133
-    w = 80
-    h = 80
-    m = 4
-    result = []
-    for j in range(6):
-        y = y0 + (h + m) * j
-        cell_img = box_img[y:y + h, x:x + w]
-        _, cell_img = img_binarization(cell_img)
-        # cv2.imwrite(f'party/{j}.png', cell_img)
-        v = img_cmp(poke_img, cell_img)
-        if v > threshold:
-            result.append((-1, j))
-    return result
-
-
-def box_search(box_img, poke_img, threshold=0.96):
-    _, poke_img = img_binarization(poke_img)
-    w = 80
-    h = 80
-    m = 4
-    x0 = 300
-    y0 = 133
-    result = []
-    for j in range(5):
-        for i in range(6):
-            x = x0 + (w + m) * i
-            y = y0 + (h + m) * j
-            cell_img = box_img[y:y + h, x:x + w]
-            _, cell_img = img_binarization(cell_img)
-            # cv2.imwrite(f'box/{i}_{j}.png', cell_img)
-            v = img_cmp(poke_img, cell_img)
-            if v > threshold:
-                result.append((i, j))
-    return result
+# 所持金の数字のテンプレートがあれば、Tesseractを使わずに認識する
+DIGITS_PATH = os.path.join(DIR_NAME, 'img', 'money_digits.npz')
+money_digits = DigitRecognizer.load(DIGITS_PATH) if os.path.exists(DIGITS_PATH) else None
+
+# 画面が変化していない間は画像認識を省く
+detector = ChangeDetector()
+last_money = None
+
+
+def party_search(box_img, poke_tmpl, threshold=0.96):
+    rois = grid_rois(x0=171, y0=133, w=80, h=80, margin=4, cols=1, rows=6)
+    scores = batch_match_ratios(box_img, [roi for _, _, roi in rois], poke_tmpl.packed)
+    return [(-1, j) for (_, j, _), v in zip(rois, scores) if v > threshold]
+
+
+def box_search(box_img, poke_tmpl, threshold=0.96):
+    rois = grid_rois(x0=300, y0=133, w=80, h=80, margin=4, cols=6, rows=5)
+    scores = batch_match_ratios(box_img, [roi for _, _, roi in rois], poke_tmpl.packed)
+    return [(i, j) for (i, j, _), v in zip(rois, scores) if v > threshold]
 
 
 def search_egg(box_img):
-    box_egg_img = cv2.imread(f'{DIR_NAME}/img/egg.png', cv2.IMREAD_GRAYSCALE)
-    egg_img = cv2.imread(f'{DIR_NAME}/img/box_egg.png', cv2.IMREAD_GRAYSCALE)
-    box_r = box_search(box_img, box_egg_img)
-    party_r = party_search(box_img, egg_img)
+    box_r = box_search(box_img, templates.get('egg'))
+    party_r = party_search(box_img, templates.get('box_egg'))
     return box_r, party_r
 
 
 def search_empty(box_img):
-    box_empty_img = cv2.imread(f'{DIR_NAME}/img/empty.png', cv2.IMREAD_GRAYSCALE)
-    empty_img = cv2.imread(f'{DIR_NAME}/img/box_empty.png', cv2.IMREAD_GRAYSCALE)
-    box_r = box_search(box_img, box_empty_img, 0.99)
-    party_r = party_search(box_img, empty_img, 0.99)
+    box_r = box_search(box_img, templates.get('empty'), 0.99)
+    party_r = party_search(box_img, templates.get('box_empty'), 0.99)
     return box_r, party_r
 
 
@@ -90,27 +73,29 @@ def is_shiny(image):
     """
     Determine if the currently displayed Pokemon is the shiny color.
     """
-    shiny_img = cv2.imread(f'{DIR_NAME}/img/shiny.png', cv2.IMREAD_GRAYSCALE)
-    _, shiny_img = img_binarization(shiny_img)
     x = 1126
     y = 61
     w = 29
     h = 27
-    cap_img = image[y:y + h, x:x + w]
-    _, cap_img = img_binarization(cap_img)
-    return img_cmp(shiny_img, cap_img) > 0.95
+    return templates.get('shiny').match(image[y:y + h, x:x + w]) > 0.95
 
 
-def held_money(cap_img):
+def read_money(cap_img):
+    """
+    所持金の欄を認識する (前回の結果は使わない)
+    グローバルな状態を変更しないため、press_until の判定のスレッドからも呼べる。
+    Return: 所持金 | None (認識できない場合)
+    """
     x = 1111
     y = 16
     w = 120
     h = 24
     cap_img = cap_img[y:y + h, x:x + w]
     _, cap_img = img_binarization(cap_img, 250)
-    cv2.imwrite(f'{DIR_NAME}/money.png', cap_img)
+    if money_digits is not None:
+        return money_digits.recognize_int(cap_img)
     try:
-        return int(ocr(cap_img))
+        return int(ocr(cap_img, 'money'))
     except ValueError:
         return None
     except:
@@ -118,6 +103,18 @@ def held_money(cap_img):
         return None
 
 
+def held_money(cap_img):
+    global last_money
+    # 所持金の欄が変化していなければ前回の結果を使う
+    if not detector.changed(cap_img, (1111, 16, 120, 24), 'money'):
+        return last_money
+    last_money = read_money(cap_img)
+    if last_money is None:
+        # 認識できなかった場合は、同じ画面でも次回に認識し直す
+        detector.reset('money')
+    return last_money
+
+
 def get_goods_name(cap_img):
     x = 360
     y = 550
@@ -125,8 +122,7 @@ def get_goods_name(cap_img):
     h = 32
     cap_img = cap_img[y:y + h, x:x + w]
     _, cap_img = img_binarization(cap_img, 40)
-    cv2.imwrite(f'{DIR_NAME}/goods_name.png', cap_img)
-    return ocr(cap_img).split(' ')[0]
+    return ocr(cap_img, 'goods_name').split(' ')[0]
 
 
 def save_game_data(con: piswitch.Procon):
@@ -155,9 +151,20 @@ def cheange_date_setting(con: piswitch.Procon):
     con.push_button('home', delay=1.5)
 
 
-def launch_sv(con: piswitch.Procon):
+def launch_sv(con: piswitch.Procon, cap: Capture = None):
     print("ゲーム起動中")
     con.push_button('a', delay=1.0, n=2)
+    if cap is not None:
+        # 競りの画面(所持金の表示)が出た時点で操作を打ち切る
+        actions = [('a', 0.15, 1.0), ('b', 0.15, 0.15), ('b', 0.15, 0.15), ('b', 0.15, 0.15)] * 20
+        # 判定は別スレッドで行われるため、held_money() の状態は変更しない
+        r = con.press_until(actions, lambda f: read_money(f) is not None, lambda: cap.get_screenshot(gray=True), timeout=60.0)
+        if r.matched:
+            # 操作のスレッドで、条件を満たしたフレームの結果を held_money() に反映する
+            held_money(r.frame)
+            print(f"ゲーム起動完了 ({r.elapsed:.1f}s)")
+            return
+        _logger.warning(f"競りの画面を確認できなかった。{r}")
     for _ in range(20):
         con.push_button('a', delay=1.0)
         con.push_button('b', n=3)
@@ -171,68 +178,102 @@ def exit_game(con: piswitch.Procon):
     con.push_button('a', delay=4.0)
 
 
-if __name__ == '__main__':
-    con = piswitch.Procon()
-    con.start()
-    cap = Capture()
-    time.sleep(1.0)
+# 状態とカウンターを保存し、例外や再起動の後は競りの画面の確認から再開する
+machine = StateMachine("pksv_auction", CheckpointStore(os.path.join(DIR_NAME, 'checkpoints')), error_state="skip")
+
 
+@machine.state("start", initial=True, safe=False)
+def start(ctx):
     # 店員さんにお辞儀
-    con.push_button('b', n=4)
+    ctx.procon.push_button('b', n=4)
 
-    save_game_data(con)
-    exit_game(con)
-    cheange_date_setting(con)
-    launch_sv(con)
+    save_game_data(ctx.procon)
+    exit_game(ctx.procon)
+    cheange_date_setting(ctx.procon)
+    launch_sv(ctx.procon, ctx.capture)
+    return "check"
+
+
+@machine.state("check")
+def check(ctx):
+    con, cap = ctx.procon, ctx.capture
+    # 競りの画面かどうか
+    cap_img = cap.get_screenshot(gray=True)
+    money_n = held_money(cap_img)
+    if money_n is None:
+        con.push_button('a', delay=1.3)
 
-    while True:
         # 競りの画面かどうか
         cap_img = cap.get_screenshot(gray=True)
         money_n = held_money(cap_img)
         if money_n is None:
-            con.push_button('a', delay=1.3)
-
-            # 競りの画面かどうか
-            cap_img = cap.get_screenshot(gray=True)
-            money_n = held_money(cap_img)
-            if money_n is None:
-                print("商品の売り切れ。")
-                save_game_data(con)
-                exit_game(con)
-                cheange_date_setting(con)
-                launch_sv(con)
-                continue
-
-        # 所持金が1000000円以下の場合は終了
-        if money_n < 1000000:
-            _logger.warning(f"所持金が足りない。({money_n}円)")
-            send_msg_to_slack(f"所持金が{money_n}円ため、プログラムを停止。")
-            break
-
-        # 商品名の取得
-        goods_name = get_goods_name(cap_img)
-
-        # 目的の商品の場合は競りを開始
-        if goods_name.endswith('のハネ') or goods_name.endswith('の八ネ') or goods_name.endswith('のハネネ') or goods_name.endswith('の八ネネ') or goods_name.endswith(
-                'のみ') or goods_name.endswith('ボール'):
-
-            _logger.info(f"「{goods_name}」の競りを開始。所持金は{money_n}円")
+            print("商品の売り切れ。")
+            return "sold_out"
 
-            fin_flag = 0
-            while True:
-                con.push_button('a', n=10)
-                # 競りの画面かどうか
-                cap_img = cap.get_screenshot(gray=True)
-                is_auction = held_money(cap_img)
-                if is_auction is None:
-                    fin_flag += 1
-                    if fin_flag >= 4:
-                        print("競りが終了")
-                        send_msg_to_slack(f"「{goods_name}」を落札。\n所持金は{money_n}円。")
-                        break
-                else:
-                    fin_flag = 0
+    # 所持金が1000000円以下の場合は終了
+    if money_n < 1000000:
+        _logger.warning(f"所持金が足りない。({money_n}円)")
+        send_msg_to_slack(f"所持金が{money_n}円ため、プログラムを停止。")
+        return None
+
+    # 商品名の取得
+    goods_name = get_goods_name(cap_img)
+    ctx.data["goods_name"] = goods_name
+    ctx.data["money"] = money_n
+
+    # 目的の商品の場合は競りを開始
+    if goods_name.endswith('のハネ') or goods_name.endswith('の八ネ') or goods_name.endswith('のハネネ') or goods_name.endswith('の八ネネ') or goods_name.endswith(
+            'のみ') or goods_name.endswith('ボール'):
+        _logger.info(f"「{goods_name}」の競りを開始。所持金は{money_n}円")
+        return "bid"
+
+    _logger.info(f"目的外「{goods_name}」のため、リセット。")
+    return "skip"
+
+
+@machine.state("sold_out", safe=False)
+def sold_out(ctx):
+    ctx.count("date_resets")
+    save_game_data(ctx.procon)
+    exit_game(ctx.procon)
+    cheange_date_setting(ctx.procon)
+    launch_sv(ctx.procon, ctx.capture)
+    return "check"
+
+
+@machine.state("bid", safe=False)
+def bid(ctx):
+    con, cap = ctx.procon, ctx.capture
+    fin_flag = 0
+    while True:
+        con.push_button('a', n=10)
+        # 競りの画面かどうか
+        cap_img = cap.get_screenshot(gray=True)
+        is_auction = held_money(cap_img)
+        if is_auction is None:
+            fin_flag += 1
+            if fin_flag >= 4:
+                print("競りが終了")
+                ctx.count("won")
+                send_msg_to_slack(f"「{ctx.data['goods_name']}」を落札。\n所持金は{ctx.data['money']}円。")
+                return "check"
         else:
-            _logger.info(f"目的外「{goods_name}」のため、リセット。")
-            exit_game(con)
-            launch_sv(con)
+            fin_flag = 0
+
+
+@machine.state("skip", safe=False)
+def skip(ctx):
+    ctx.count("skipped")
+    exit_game(ctx.procon)
+    launch_sv(ctx.procon, ctx.capture)
+    return "check"
+
+
+if __name__ == '__main__':
+    con = piswitch.Procon()
+    con.start()
+    cap = Capture()
+    time.sleep(1.0)
+
+    ctx = machine.run(procon=con, capture=cap)
+    print(f"終了: {ctx.counters}")
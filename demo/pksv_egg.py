@@ -12,9 +12,6 @@ import time
 import sys
 import cv2
 import os
-import numpy as np
-import pyocr
-from PIL import Image
 import logging
 
 # piswitchをインポート
@@ -23,6 +20,9 @@ BASE_NAME = os.path.basename(__file__)
 
 sys.path.append(os.path.join(DIR_NAME, '..'))
 from piswitch import Procon
+from piswitch.template import TemplateRegistry
+from piswitch.bitimage import grid_rois, batch_match_ratios
+from piswitch.ocr import DigitRecognizer, OcrService
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.WARNING)
@@ -33,10 +33,15 @@ _logger.addHandler(logging.FileHandler(os.path.join(DIR_NAME, f"{BASE_NAME}.log"
 # path_tesseract = "/usr/share/tesseract-ocr/4.00/tessdata"
 # if path_tesseract not in os.environ["DIR_NAME"].split(os.pathsep):
 #     os.environ["DIR_NAME"] += os.pathsep + path_tesseract
-tools = pyocr.get_available_tools()
-if len(tools) == 0:
-    _logger.error("Do not find OCR tools")
-OCR_TOOL = tools[0]
+# OCR_DEBUG_DIRを設定すると、OCRにかけた画像を保存する
+OCR_SERVICE = OcrService(lang="jpn", layout=6, debug_dir=os.getenv('OCR_DEBUG_DIR'))
+
+# テンプレート画像は一度だけ読み込んで使い回す
+templates = TemplateRegistry(os.path.join(DIR_NAME, 'img'))
+
+# 所持金の数字のテンプレートがあれば、Tesseractを使わずに認識する (pksv_auction.py と共通)
+DIGITS_PATH = os.path.join(DIR_NAME, 'img', 'money_digits.npz')
+money_digits = DigitRecognizer.load(DIGITS_PATH) if os.path.exists(DIGITS_PATH) else None
 
 
 def decode_fourcc(v):
@@ -81,64 +86,27 @@ def binarization(img, threshold=127):
     return cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
 
 
-def comp_imgs(image1, image2):
-    # Compare by number of matched pixels
-    return np.count_nonzero(image1 == image2) / image1.size
-
-
-def party_search(box_img, poke_img, threshold=0.96):
-    _, poke_img = binarization(poke_img)
-    x = 171
-    y0 = 133
-    w = 80
-    h = 80
-    m = 4
-    result = []
-    for j in range(6):
-        y = y0 + (h + m) * j
-        cell_img = box_img[y:y + h, x:x + w]
-        _, cell_img = binarization(cell_img)
-        # cv2.imwrite(f'party/{j}.png', cell_img)
-        v = comp_imgs(poke_img, cell_img)
-        if v > threshold:
-            result.append((-1, j))
-    return result
-
-
-def box_search(box_img, poke_img, threshold=0.96):
-    _, poke_img = binarization(poke_img)
-    w = 80
-    h = 80
-    m = 4
-    x0 = 300
-    y0 = 133
-    result = []
-    for j in range(5):
-        for i in range(6):
-            x = x0 + (w + m) * i
-            y = y0 + (h + m) * j
-            cell_img = box_img[y:y + h, x:x + w]
-            _, cell_img = binarization(cell_img)
-            # cv2.imwrite(f'box/{i}_{j}.png', cell_img)
-            v = comp_imgs(poke_img, cell_img)
-            if v > threshold:
-                result.append((i, j))
-    return result
+def party_search(box_img, poke_tmpl, threshold=0.96):
+    rois = grid_rois(x0=171, y0=133, w=80, h=80, margin=4, cols=1, rows=6)
+    scores = batch_match_ratios(box_img, [roi for _, _, roi in rois], poke_tmpl.packed)
+    return [(-1, j) for (_, j, _), v in zip(rois, scores) if v > threshold]
+
+
+def box_search(box_img, poke_tmpl, threshold=0.96):
+    rois = grid_rois(x0=300, y0=133, w=80, h=80, margin=4, cols=6, rows=5)
+    scores = batch_match_ratios(box_img, [roi for _, _, roi in rois], poke_tmpl.packed)
+    return [(i, j) for (i, j, _), v in zip(rois, scores) if v > threshold]
 
 
 def search_egg(box_img):
-    box_egg_img = cv2.imread(f'{DIR_NAME}/img/egg.png', cv2.IMREAD_GRAYSCALE)
-    egg_img = cv2.imread(f'{DIR_NAME}/img/box_egg.png', cv2.IMREAD_GRAYSCALE)
-    box_r = box_search(box_img, box_egg_img)
-    party_r = party_search(box_img, egg_img)
+    box_r = box_search(box_img, templates.get('egg'))
+    party_r = party_search(box_img, templates.get('box_egg'))
     return box_r, party_r
 
 
 def search_empty(box_img):
-    box_empty_img = cv2.imread(f'{DIR_NAME}/img/empty.png', cv2.IMREAD_GRAYSCALE)
-    empty_img = cv2.imread(f'{DIR_NAME}/img/box_empty.png', cv2.IMREAD_GRAYSCALE)
-    box_r = box_search(box_img, box_empty_img, 0.99)
-    party_r = party_search(box_img, empty_img, 0.99)
+    box_r = box_search(box_img, templates.get('empty'), 0.99)
+    party_r = party_search(box_img, templates.get('box_empty'), 0.99)
     return box_r, party_r
 
 
@@ -146,26 +114,15 @@ def is_shiny(image):
     """
     Determine if the currently displayed Pokemon is the shiny color.
     """
-    shiny_img = cv2.imread(f'{DIR_NAME}/img/shiny.png', cv2.IMREAD_GRAYSCALE)
-    _, shiny_img = binarization(shiny_img)
     x = 1126
     y = 61
     w = 29
     h = 27
-    cap_img = image[y:y + h, x:x + w]
-    _, cap_img = binarization(cap_img)
-    return comp_imgs(shiny_img, cap_img) > 0.95
-
+    return templates.get('shiny').match(image[y:y + h, x:x + w]) > 0.95
 
-def ocr(cv2_img):
 
-    pil_image = Image.fromarray(cv2_img)
-    # TextBuilder  文字列を認識
-    # WordBoxBuilder  単語単位で文字認識 + BoundingBox
-    # LineBoxBuilder  行単位で文字認識 + BoundingBox
-    # DigitBuilder  数字 / 記号を認識
-    # DigitLineBoxBuilder  数字 / 記号を認識 + BoundingBox
-    return OCR_TOOL.image_to_string(pil_image, lang="jpn", builder=pyocr.builders.TextBuilder(tesseract_layout=6))
+def ocr(cv2_img, name=None):
+    return OCR_SERVICE.recognize(cv2_img, name)
 
 
 def held_money(cap_img):
@@ -174,10 +131,13 @@ def held_money(cap_img):
     w = 120
     h = 24
     cap_img = cap_img[y:y + h, x:x + w]
+    if money_digits is not None:
+        # 文字のテンプレートは pksv_auction.py と同じ閾値で二値化した画像で作っている
+        _, cap_img = binarization(cap_img, 250)
+        return money_digits.recognize_int(cap_img)
     _, cap_img = binarization(cap_img, 200)
-    cv2.imwrite('money.png', cap_img)
     try:
-        return int(ocr(cap_img))
+        return int(ocr(cap_img, 'money'))
     except ValueError:
         return None
     except:
@@ -192,8 +152,7 @@ def get_goods_name(cap_img):
     h = 32
     cap_img = cap_img[y:y + h, x:x + w]
     _, cap_img = binarization(cap_img, 55)
-    cv2.imwrite('goods_name.png', cap_img)
-    return ocr(cap_img).split(' ')[0]
+    return ocr(cap_img, 'goods_name').split(' ')[0]
 
 
 def save_game_data(con: Procon):
@@ -23,6 +23,7 @@ BASE_NAME = os.path.basename(__file__)
 # piswitchパッケージをインポート
 sys.path.append(os.path.join(DIR_NAME, '..'))
 import piswitch
+from piswitch.screenshot import ScreenshotEncoder
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.WARNING)
@@ -31,11 +32,14 @@ _logger.addHandler(logging.FileHandler(os.path.join(DIR_NAME, f"{BASE_NAME}.log"
 
 def screen_shot_loop():
     cb = Capture()
+    # 縮小とJPEGエンコードは別スレッドで行い、ファイルを介さずに送る
+    encoder = ScreenshotEncoder(scale=0.5, quality=85)
     while True:
         try:
-            if cb.save_screenshot('ss.jpg'):
+            cv2_img = cb.get_screenshot()
+            if cv2_img is not None:
                 date_str = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-                send_img_to_slack(date_str, 'ss.jpg')
+                encoder.submit(cv2_img, lambda data, msg=date_str: send_img_to_slack(msg, data))
         except Exception:
             _logger.exception('スクリーンショット時の不明なのエラー')
         time.sleep(60 * 30)  # 30 mins
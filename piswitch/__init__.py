@@ -1,7 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
+Nintendo Switch を Raspberry Pi から操作するためのモジュール
 
+コントローラ本体(Procon)は標準ライブラリだけで動作する。
+画像認識やOCRなどのサブモジュールは OpenCV などを必要とするため、
+piswitch.template のように初めて参照された時に読み込む。
 """
 
+import importlib
+
 from .procon import *
+
+# 使用時に読み込むサブモジュール
+_LAZY_SUBMODULES = (
+    "automation", "bitimage", "capture", "change_detect", "clock", "eventlog", "fake_gadget", "farm",
+    "latency", "macro", "netinput", "notify", "ocr", "passthrough", "profiler", "realtime", "report",
+    "roi", "screenshot", "search", "session", "stick", "template", "trace", "vision_worker",
+)
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+チェックポイント付きの自動化
+
+自動化の手順を名前付きの状態機械として書くと、安全な状態に移るたびに
+状態とカウンターをファイルに保存する (一時ファイルに書いてから置き換えるため、
+途中で電源が切れても壊れない)。例外や再起動の後は、最後に保存した状態から再開し、
+ゲームの再起動などの時間のかかる手順を最初からやり直さずに済む。
+
+    machine = StateMachine("auction", CheckpointStore("checkpoints"))
+
+    @machine.state("launch", initial=True, safe=False)
+    def launch(ctx):
+        ...
+        return "check"  # 次の状態 (None: 終了)
+
+    machine.run(procon=con, capture=cap)
+"""
+
+import json
+import logging
+import os
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """
+    チェックポイントの保存先 (状態機械ごとに1つのJSONファイル)
+    """
+
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+        os.makedirs(dir_path, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.dir_path, f"{name}.json")
+
+    def load(self, name: str):
+        """
+        チェックポイントを読み込む
+        Return: 保存した内容 | None (ない、または壊れている場合)
+        """
+        try:
+            with open(self.path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            _logger.warning(f"Broken checkpoint: {self.path(name)}")
+            return None
+
+    def save(self, name: str, checkpoint: dict):
+        """チェックポイントを書き込む (一時ファイルに書いてから置き換える)"""
+        path = self.path(name)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        # 置き換えたことをディレクトリにも反映する
+        fd = os.open(self.dir_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def clear(self, name: str):
+        """チェックポイントを削除する"""
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+
+class Context:
+    """
+    状態の関数に渡す実行中の情報
+    counters と data はチェックポイントに保存される (JSONにできる値のみ)。
+    """
+
+    def __init__(self, procon=None, capture=None, counters=None, data=None):
+        self.procon = procon
+        self.capture = capture
+        self.counters = counters if counters is not None else {}
+        self.data = data if data is not None else {}
+        self.state = None
+        self.resumed = False  # チェックポイントから再開した場合はTrue
+        self.transitions = 0
+
+    def count(self, name: str, n=1) -> int:
+        """カウンターを増やす"""
+        self.counters[name] = self.counters.get(name, 0) + n
+        return self.counters[name]
+
+
+class StateMachine:
+    """
+    チェックポイント付きの状態機械
+    """
+
+    def __init__(self, name: str, store: CheckpointStore, error_state=None):
+        """
+        name: 名前 (チェックポイントのファイル名)
+        store: チェックポイントの保存先
+        error_state: 例外が起きた時に移る状態 (None: 例外をそのまま送出する)
+        """
+        self.name = name
+        self.store = store
+        self.error_state = error_state
+        self.states = {}  # {状態名: (関数, 安全な状態か)}
+        self.initial = None
+
+    def add_state(self, name: str, func, initial=False, safe=True):
+        """
+        状態を追加する
+        func: func(ctx) -> 次の状態名 | None (終了)
+        initial: 最初の状態
+        safe: この状態に移る時にチェックポイントを保存する (途中から再開できる状態)
+        """
+        self.states[name] = (func, safe)
+        if initial or self.initial is None:
+            self.initial = name
+
+    def state(self, name: str, initial=False, safe=True):
+        """add_state() のデコレータ版"""
+        def decorator(func):
+            self.add_state(name, func, initial, safe)
+            return func
+        return decorator
+
+    def _checkpoint(self, ctx: Context, state):
+        self.store.save(self.name, {
+            "state": state,
+            "counters": ctx.counters,
+            "data": ctx.data,
+            "transitions": ctx.transitions,
+            "updated_at": time.time(),
+        })
+
+    def run(self, procon=None, capture=None, max_transitions=None, resume=True) -> Context:
+        """
+        状態機械を実行する
+        procon, capture: 状態の関数に渡す Procon と Capture
+        max_transitions: 最大の遷移回数 (None: 終了するまで)
+        resume: チェックポイントがあれば、その状態から再開する
+        Return: 実行後の Context
+        """
+        ctx = Context(procon, capture)
+        state = self.initial
+        checkpoint = self.store.load(self.name) if resume else None
+        if checkpoint is not None and checkpoint.get("state") in self.states:
+            state = checkpoint["state"]
+            ctx.counters = checkpoint.get("counters", {})
+            ctx.data = checkpoint.get("data", {})
+            ctx.transitions = checkpoint.get("transitions", 0)
+            ctx.resumed = True
+            _logger.info(f"{self.name}: resume from '{state}'")
+
+        executed = 0
+        while state is not None and (max_transitions is None or executed < max_transitions):
+            ctx.state = state
+            func, _ = self.states[state]
+            try:
+                next_state = func(ctx)
+            except Exception:
+                if self.error_state is None:
+                    raise
+                _logger.exception(f"{self.name}: error in '{state}'")
+                ctx.count("errors")
+                next_state = self.error_state
+            if next_state is not None and next_state not in self.states:
+                raise KeyError(f"{self.name}: unknown state '{next_state}' (from '{state}')")
+            executed += 1
+            ctx.transitions += 1
+            ctx.resumed = False
+            if next_state is None:
+                # 終了したら次回は最初から実行する
+                self.store.clear(self.name)
+            elif self.states[next_state][1]:
+                self._checkpoint(ctx, next_state)
+            state = next_state
+        ctx.state = state
+        return ctx
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ビットパックした二値画像の比較
+
+二値化した画像を np.packbits で1画素1bitに詰め、
+XOR + popcount で一致率を求める。
+uint8 のまま比較する場合と比べてメモリ帯域が1/8になり、
+一時的な bool 配列も作らない。
+"""
+
+import numpy as np
+
+# popcount用のテーブル (numpy 2.0未満用)
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed) -> np.ndarray:
+    """
+    各byteの立っているbit数を返す
+    packed: uint8の配列
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed)
+    return _POPCOUNT_TABLE[packed]
+
+
+def pack(binary) -> np.ndarray:
+    """
+    二値画像(0 | 255)をビットパックする
+    binary: 二値画像
+    Return: 1次元のuint8配列
+    """
+    return np.packbits(binary)
+
+
+def binarize_pack(gray, threshold=127) -> np.ndarray:
+    """
+    グレースケール画像を二値化してビットパックする
+    cv2.threshold(THRESH_BINARY) と同じ結果を、uint8の二値画像を作らずに得る。
+    gray: グレースケール画像
+    threshold: 二値化の閾値
+    Return: 1次元のuint8配列
+    """
+    return np.packbits(gray > threshold)
+
+
+def match_ratio(packed1, packed2, size: int) -> float:
+    """
+    ビットパックした2つの画像の一致率
+    packed1, packed2: pack()した画像
+    size: 元画像の画素数
+    Return: 0.0~1.0
+    """
+    diff = int(popcount(np.bitwise_xor(packed1, packed2)).sum(dtype=np.uint32))
+    return 1.0 - diff / size
+
+
+def grid_rois(x0: int, y0: int, w: int, h: int, margin: int, cols: int, rows: int) -> list:
+    """
+    格子状に並んだROIを列挙する
+    Return: [(i, j, (x, y, w, h)), ...]
+    """
+    return [(i, j, (x0 + (w + margin) * i, y0 + (h + margin) * j, w, h)) for j in range(rows) for i in range(cols)]
+
+
+def batch_match_ratios(gray, rois, packed_tmpl, threshold=127) -> np.ndarray:
+    """
+    複数のROIとテンプレートの一致率をまとめて計算する
+    gray: グレースケールのフレーム
+    rois: 同じ大きさのROIのリスト [(x, y, w, h), ...]
+    packed_tmpl: ROIと同じ大きさのテンプレートをpack()したもの
+    threshold: フレームの二値化の閾値
+    Return: 各ROIの一致率の配列
+    """
+    if not rois:
+        return np.empty(0)
+    _, _, w, h = rois[0]
+    cells = np.stack([gray[y:y + h, x:x + w] for x, y, _, _ in rois])
+    packed = np.packbits((cells > threshold).reshape(len(rois), w * h), axis=1)
+    diff = popcount(np.bitwise_xor(packed, packed_tmpl)).sum(axis=1, dtype=np.uint32)
+    return 1.0 - diff / (w * h)
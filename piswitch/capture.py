@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+キャプチャデバイスからの画像の取得
+OpenCVを使うため、piswitchの本体とは別に必要な時だけ読み込む。
+
+rois (piswitch.roi.RoiRegistry) を渡すと、登録したROIに必要な細かさを満たす最も低い
+解像度で取得し、YUYVの場合はRGBに変換せずに受け取って read_rois() でROIの部分だけを変換する。
+受け取ったデータがYUYVのフレームとして解釈できない場合は、OpenCVでの変換に戻す。
+"""
+
+import logging
+
+import cv2
+import numpy as np
+
+from .change_detect import ChangeDetector
+from .profiler import PROFILER
+
+_logger = logging.getLogger(__name__)
+
+
+def decode_fourcc(v):
+    v = int(v)
+    return "".join([chr((v >> 8 * i) & 0xFF) for i in range(4)])
+
+
+class Capture:
+    """キャプチャデバイスからの画像の取得"""
+
+    def __init__(self, device_id=0, rois=None, modes=None):
+        """
+        device_id: キャプチャデバイスの番号
+        rois: piswitch.roi.RoiRegistry (None: 1280x720で取得し、フレーム全体を変換する)
+        modes: 選べる (w, h, fourcc) のリスト (None: piswitch.roi.DEFAULT_MODES)
+        """
+        self.rois = rois
+        width, height, fourcc = (1280, 720, "YUYV") if rois is None else rois.choose_mode(modes)
+
+        self.cap = cv2.VideoCapture(device_id)
+        # self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'))
+        self.cap.set(cv2.CAP_PROP_FOURCC,
+                     cv2.VideoWriter_fourcc(*fourcc))
+        # self.cap.set(cv2.CAP_PROP_FPS, 30)
+        # self.cap.set(cv2.CAP_PROP_FPS, 10)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Latency Reduction
+        # ROIを使う場合はYUYVのまま受け取り、必要な部分だけを変換する
+        self.raw = rois is not None and fourcc == "YUYV" and self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self.size = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or width,
+                     int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or height)
+
+        # print(
+        #     f"[{decode_fourcc(self.cap.get(cv2.CAP_PROP_FOURCC))} "
+        #     f"{self.cap.get(cv2.CAP_PROP_FPS):.1f}fps "
+        #     f"{self.cap.get(cv2.CAP_PROP_FRAME_WIDTH):.0f}x{self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT):.0f}]"
+        # )
+
+        if not self.cap.isOpened():
+            _logger.error('Could not open device.')
+
+        self.detector = ChangeDetector()
+        self.frame = None  # 最後に取得したフレーム
+
+    def __del__(self):
+        self.cap.release()
+
+    def _read(self):
+        """
+        1フレーム読み込む
+        Return: BGRのフレーム | YUYVのフレーム (h, w, 2) (self.raw の場合) | None
+        """
+        ret, cv2_img = self.cap.read()
+        if not ret:
+            return None
+        if self.raw:
+            yuyv = self._as_yuyv(cv2_img)
+            if yuyv is None:
+                _logger.warning(f"Unexpected raw frame {cv2_img.shape}; falling back to converted frames")
+                self.raw = False
+                self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                return None
+            cv2_img = yuyv
+        return cv2_img
+
+    def _as_yuyv(self, raw):
+        """
+        変換していないデータをYUYVのフレーム (h, w, 2) として見る (コピーしない)
+        行の末尾に詰め物がある場合や、1行のバッファで渡された場合にも対応する。
+        Return: YUYVのフレーム | None (大きさが合わない場合)
+        """
+        w, h = self.size
+        if raw.dtype != np.uint8 or raw.size % h != 0:
+            return None
+        stride = raw.size // h
+        if stride < w * 2:
+            return None
+        if not raw.flags.c_contiguous:
+            raw = np.ascontiguousarray(raw)
+        rows = raw.reshape(h, stride)
+        return rows[:, :w * 2].reshape(h, w, 2)
+
+    def get_screenshot(self, gray=False):
+        with PROFILER.span("capture", "capture", gray=gray):
+            self.cap.read()  # 1フレーム読み捨て
+            for i in range(64):
+                cv2_img = self._read()
+                if cv2_img is not None and self.raw:
+                    cv2_img = cv2.cvtColor(cv2_img, cv2.COLOR_YUV2BGR_YUYV)
+                if cv2_img is not None and cv2.countNonZero(cv2_img[0]) > 0:
+                    self.frame = cv2_img
+                    if gray:
+                        return cv2.cvtColor(cv2_img, cv2.COLOR_BGR2GRAY)
+                    return cv2_img
+            return None
+
+    def read_rois(self, names=None, gray=True, fresh=True, out=None):
+        """
+        登録したROIの部分だけを取得する (フレーム全体は変換しない)
+        names: 取得するROIの名前 (None: 全て)
+        gray: グレースケールにする
+        fresh: 1フレーム読み捨ててから取得する
+        out: 書き込み先の {名前: 画像} (None: 毎回新しい画像を返す。RoiRegistry.extract() を参照)
+        Return: {名前: 画像} | None (取得できない場合)
+                画像は取得した解像度によらず1280x720のフレームでのROIの大きさになる
+        """
+        if self.rois is None:
+            raise ValueError("No ROI registry")
+        with PROFILER.span("capture_rois", "capture", gray=gray):
+            if fresh:
+                self.cap.read()  # 1フレーム読み捨て
+            for i in range(64):
+                cv2_img = self._read()
+                if cv2_img is not None and cv2.countNonZero(cv2_img[0, :, 0]) > 0:
+                    return self.rois.extract(cv2_img, names, gray, yuyv=self.raw, out=out)
+            return None
+
+    def changed(self, cv2_img, roi=None, key=None):
+        """前回の確認からROIが変化したかどうか"""
+        return self.detector.changed(cv2_img, roi, key)
+
+    def wait_until_changed(self, roi=None, timeout=5.0, gray=False):
+        """
+        ROIが変化するまで待機する
+        Return: 変化後の画像 | None (タイムアウト)
+        """
+        return self.detector.wait_until_changed(lambda: self.get_screenshot(gray), roi, timeout)
+
+    def save_screenshot(self, save_path='ss.jpg'):
+        cv2_img = self.get_screenshot()
+        if cv2_img is None:
+            return False
+
+        # リサイズ
+        height = cv2_img.shape[0]
+        width = cv2_img.shape[1]
+        cv2_img = cv2.resize(cv2_img, (int(width * 0.5), int(height * 0.5)))
+
+        # 保存
+        cv2.imwrite(save_path, cv2_img, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
+
+        return True
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+画面の変化の検出
+
+ROIを小さく縮小した画像を署名として保持し、前回の署名と比べて
+画面が変化したかどうかを判定する。
+OCRやテンプレートマッチングの前に確認することで、
+画面が変わっていない間の無駄な画像認識を省く。
+"""
+
+import time
+
+import cv2
+
+
+class ChangeDetector:
+    """
+    ROIごとの画面の変化の検出器
+    """
+
+    def __init__(self, size=(16, 16), tolerance=12):
+        """
+        size: 署名の大きさ (w, h)
+        tolerance: 変化とみなさない画素値の差
+        """
+        self.size = size
+        self.tolerance = tolerance
+        self._signatures = {}
+
+    def signature(self, frame, roi=None):
+        """
+        ROIの署名を返す
+        frame: フレーム
+        roi: (x, y, w, h) | None (フレーム全体)
+        Return: 縮小した画像
+        """
+        if roi is not None:
+            x, y, w, h = roi
+            frame = frame[y:y + h, x:x + w]
+        size = (min(self.size[0], frame.shape[1]), min(self.size[1], frame.shape[0]))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def differs(self, sig1, sig2) -> bool:
+        """2つの署名が異なるかどうか"""
+        if sig1 is None or sig2 is None or sig1.shape != sig2.shape:
+            return True
+        return int(cv2.absdiff(sig1, sig2).max()) > self.tolerance
+
+    def changed(self, frame, roi=None, key=None) -> bool:
+        """
+        前回の確認から画面が変化したかどうか
+        初回は常にTrueを返す。
+        frame: フレーム
+        roi: (x, y, w, h) | None (フレーム全体)
+        key: 署名を保存するキー (None: roiをキーとする)
+        """
+        if key is None:
+            key = tuple(roi) if roi is not None else None
+        sig = self.signature(frame, roi)
+        if not self.differs(self._signatures.get(key), sig):
+            return False
+        self._signatures[key] = sig
+        return True
+
+    def predicate(self, reference, roi=None):
+        """
+        ROIが基準のフレームと同じ表示になったかを判定する関数を返す
+        Procon.press_until() の条件として使う。
+        reference: 基準のフレーム
+        roi: (x, y, w, h) | None (フレーム全体)
+        """
+        sig = self.signature(reference, roi)
+        return lambda frame: not self.differs(sig, self.signature(frame, roi))
+
+    def reset(self, key=None):
+        """
+        保存した署名を破棄する
+        key: 破棄するキー (None: 全て)
+        """
+        if key is None:
+            self._signatures.clear()
+        else:
+            self._signatures.pop(key, None)
+
+    def wait_until_changed(self, get_frame, roi=None, timeout=None, interval=0.0):
+        """
+        ROIが変化するまで待機する
+        get_frame: フレームを返す関数
+        roi: (x, y, w, h) | None (フレーム全体)
+        timeout: 待機する最大時間[s] (None: 無制限)
+        interval: フレームを取得する間隔[s]
+        Return: 変化後のフレーム | None (タイムアウト)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        base = None
+        while deadline is None or time.monotonic() < deadline:
+            frame = get_frame()
+            if frame is not None:
+                sig = self.signature(frame, roi)
+                if base is None:
+                    base = sig
+                elif self.differs(base, sig):
+                    return frame
+            if interval > 0:
+                time.sleep(interval)
+        return None
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+時計
+
+ProconBase/Procon の時間の扱いは全てこの時計を通す。
+通常は実時間の Clock を使い、シミュレーションでは VirtualClock を使う。
+VirtualClock は sleep() で仮想時間を進め、その間に予定されたタイマー
+(入力レポートの送信など)を順番に実行するため、実時間を待たずに
+決まった順序で動作する。
+"""
+
+import heapq
+import time
+
+
+class Clock:
+    """実時間の時計"""
+
+    virtual = False
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    仮想時間の時計
+    時刻は整数のナノ秒で保持するため、誤差が積み重ならない。
+    1つのスレッドから使うこと。
+    """
+
+    virtual = True
+
+    def __init__(self, start=0.0):
+        self.now_ns = round(start * 1e9)
+        self._timers = []  # (時刻[ns], 登録順, 周期[ns], 関数)
+        self._seq = 0
+
+    def monotonic(self) -> float:
+        return self.now_ns / 1e9
+
+    def sleep(self, seconds: float):
+        """仮想時間を進め、その間のタイマーを実行する"""
+        self.advance_to(self.now_ns + max(0, round(seconds * 1e9)))
+
+    def advance_to(self, target_ns: int):
+        """指定した時刻[ns]まで進め、その間のタイマーを実行する"""
+        while self._timers and self._timers[0][0] <= target_ns:
+            t, _, period, func = heapq.heappop(self._timers)
+            self.now_ns = t
+            if period:
+                self._push(t + period, period, func)
+            func()
+        self.now_ns = max(self.now_ns, target_ns)
+
+    def call_at(self, seconds: float, func):
+        """指定した時刻[s]に関数を実行する"""
+        self._push(round(seconds * 1e9), 0, func)
+
+    def call_every(self, period: float, func, first=None):
+        """
+        一定周期で関数を実行する
+        period: 周期[s]
+        first: 最初に実行する時刻[s] (None: 現在時刻)
+        """
+        start = self.now_ns if first is None else round(first * 1e9)
+        self._push(start, round(period * 1e9), func)
+
+    def cancel(self, func):
+        """関数のタイマーを取り消す"""
+        self._timers = [t for t in self._timers if t[3] is not func]
+        heapq.heapify(self._timers)
+
+    def _push(self, t: int, period: int, func):
+        heapq.heappush(self._timers, (t, self._seq, period, func))
+        self._seq += 1
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+プロトコル層のイベントログ
+
+通信処理のスレッドでは固定長のレコードをキューに積むだけにし、
+文字列への整形やファイルへの書き込みはバックグラウンドのスレッドで行う。
+ログを有効にしたままでも、入力レポートの送信タイミングを乱さない。
+"""
+
+import logging
+import struct
+import threading
+import time
+from collections import deque
+
+# イベントの種類
+EV_MAC_ADDR = 0x01  # MACアドレスの要求
+EV_HANDSHAKE = 0x02  # ハンドシェイク
+EV_BAUDRATE = 0x03  # ボーレートの設定
+EV_REPORT_ON = 0x04  # 入力レポートの開始
+EV_REPORT_OFF = 0x05  # 入力レポートの停止
+EV_UART = 0x10  # UARTのサブコマンド (arg: サブコマンド)
+EV_SPI_MISS = 0x11  # 存在しないSPIアドレスの読み込み
+EV_UNKNOWN = 0xff  # 不明なパケット
+
+# UARTのサブコマンド名
+UART_SUBCMD_NAMES = {
+    0x01: "Bluetooth manual pairing",
+    0x02: "Request device info",
+    0x03: "Set input report mode",
+    0x04: "Trigger buttons elapsed time",
+    0x08: "Set shipment low power state",
+    0x10: "SPI flash read",
+    0x21: "Set NFC/IR MCU configuration",
+    0x30: "Set player lights",
+    0x38: "Set HOME light",
+    0x40: "Enable IMU",
+    0x48: "Enable vibration",
+}
+
+_EVENT_NAMES = {
+    EV_MAC_ADDR: "Requested MAC addr",
+    EV_HANDSHAKE: "Handshake",
+    EV_BAUDRATE: "baudrate setting",
+    EV_REPORT_ON: "Enable USB HID Joystick report",
+    EV_REPORT_OFF: "Disable USB HID Joystick report",
+    EV_SPI_MISS: "SPI address not found",
+    EV_UNKNOWN: "Unknown packet",
+}
+
+# レコード: 時刻[s], 種類, 引数, データ長, データ
+RECORD = struct.Struct("<dBBB32s")
+MAX_DATA_LEN = 32
+
+
+def format_event(code: int, arg: int, data: bytes) -> str:
+    """イベントを文字列に整形する"""
+    if code == EV_UART:
+        name = UART_SUBCMD_NAMES.get(arg, f"0x{arg:02x}")
+        return f">>> [UART] {name}: {data.hex()}"
+    return f">>> {_EVENT_NAMES.get(code, f'0x{code:02x}')}: {data.hex()}"
+
+
+def read_records(path: str):
+    """
+    ファイルに保存したレコードを読み込む
+    Return: [(時刻, 種類, 引数, データ), ...]
+    """
+    with open(path, "rb") as f:
+        buf = f.read()
+    result = []
+    for t, code, arg, n, data in RECORD.iter_unpack(buf[:len(buf) - len(buf) % RECORD.size]):
+        result.append((t, code, arg, data[:n]))
+    return result
+
+
+class EventLog:
+    """
+    キューを使ったイベントログ
+    """
+
+    def __init__(self, logger=None, path=None, maxlen=4096, interval=0.1):
+        """
+        logger: 整形したイベントの出力先 (None: 出力しない)
+        path: レコードを追記するファイル (None: 保存しない)
+        maxlen: キューの最大長 (溢れた場合は古いものから捨てる)
+        interval: 書き出しの間隔[s]
+        """
+        self.logger = logger
+        self.path = path
+        self.interval = interval
+        self.enabled = logger is not None or path is not None
+        self._queue = deque(maxlen=maxlen)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def emit(self, code: int, arg=0, data=b""):
+        """
+        イベントを記録する (通信処理のスレッドから呼ぶ)
+        code: イベントの種類
+        arg: 引数 (0~255)
+        data: 付加データ (MAX_DATA_LENを超えた分は切り捨てる)
+        """
+        if self.enabled:
+            self._queue.append((time.monotonic(), code, arg, bytes(data[:MAX_DATA_LEN])))
+
+    def start(self):
+        """書き出しのスレッドを開始する"""
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """書き出しのスレッドを停止する (残ったイベントは書き出す)"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def flush(self):
+        """キューに溜まったイベントを書き出す"""
+        records = []
+        while self._queue:
+            records.append(self._queue.popleft())
+        if not records:
+            return
+
+        if self.logger is not None and self.logger.isEnabledFor(logging.INFO):
+            for _, code, arg, data in records:
+                self.logger.info(format_event(code, arg, data))
+
+        if self.path is not None:
+            with open(self.path, "ab") as f:
+                for t, code, arg, data in records:
+                    f.write(RECORD.pack(t, code, arg, len(data), data))
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+        self.flush()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+USB Gadgetの代わりに使う疑似的な送受信先
+
+送信したパケットを時刻付きで記録し、受信するパケットはテストから与える。
+VirtualClock と組み合わせると、実機なしで入力レポートの列を
+決まった結果として得られるため、ゴールデンファイルとの比較に使える。
+"""
+
+from collections import deque
+
+from .clock import Clock
+
+
+class FakeGadget:
+    """
+    UsbGadgetと同じメソッドを持つ疑似的な送受信先
+    """
+
+    def __init__(self, clock: Clock = None):
+        self.clock = clock if clock is not None else Clock()
+        self.sent = []  # [(時刻[s], データ), ...]
+        self.is_open = False
+        self._recv_queue = deque()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def send(self, data) -> bool:
+        self.sent.append((self.clock.monotonic(), bytes(data)))
+        return True
+
+    def feed(self, data: bytes):
+        """ホストから受信するパケットを追加する"""
+        self._recv_queue.append(bytes(data))
+
+    def wait_readable(self, timeout=None) -> bool:
+        if self._recv_queue:
+            return True
+        if timeout:
+            self.clock.sleep(timeout)
+        return bool(self._recv_queue)
+
+    def recv(self, max_len=128):
+        if not self._recv_queue:
+            raise BlockingIOError()
+        return self._recv_queue.popleft()[:max_len]
+
+    def reports(self, report_id=0x30) -> list:
+        """指定したレポートIDの送信パケットを返す"""
+        return [(t, d) for t, d in self.sent if d[0] == report_id]
+
+    def dumps(self) -> str:
+        """送信したパケットを1行ずつの文字列にする (ゴールデンファイル用)"""
+        return "".join(f"{round(t * 1e6):d} {d.hex()}\n" for t, d in self.sent)
+
+    def save(self, path: str):
+        """送信したパケットをファイルに保存する"""
+        with open(path, "w") as f:
+            f.write(self.dumps())
+
+    def matches(self, path: str) -> bool:
+        """送信したパケットがゴールデンファイルと一致するかどうか"""
+        with open(path) as f:
+            return f.read() == self.dumps()
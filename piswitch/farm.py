@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+複数のコントローラでのジョブの実行
+
+ジョブのキューを、コントローラとキャプチャの組(ワーカー)に割り当てて実行する。
+空いたワーカーが次のジョブを取るため、負荷は自然に分散する。
+ワーカーのプロセスが落ちた場合は作り直し、実行中だったジョブはキューに戻す。
+ジョブが報告した周回と工程ごとの時間から、周回数/時間などの指標を集計する。
+
+ワーカーの種類:
+    LocalWorker: このマシンの子プロセスで実行する
+    RemoteWorker: 別のRaspberry Piで serve_worker() を実行しておき、接続して実行する
+    simulated_resources をリソースに使うと、実機なしで1台のマシンで試せる
+
+ジョブの関数は ctx (JobContext) を受け取るモジュールの関数にする (ワーカーに名前で渡すため)。
+
+    def grind(ctx):
+        while ctx.running():
+            with ctx.stage("reset"):
+                ...
+            ctx.cycle()
+"""
+
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+_logger = logging.getLogger(__name__)
+
+
+class Job:
+    """実行するジョブ"""
+
+    _next_id = 0
+
+    def __init__(self, name: str, func, args=(), kwargs=None, cycles=None, max_attempts=3):
+        """
+        name: ジョブ名
+        func: func(ctx, *args, **kwargs) の形のモジュールの関数
+        cycles: 周回数の上限 (None: 無制限)
+        max_attempts: 失敗した場合に実行する最大回数
+        """
+        Job._next_id += 1
+        self.id = Job._next_id
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.cycles = cycles
+        self.max_attempts = max_attempts
+        self.attempts = 0
+        self.completed = 0  # 完了した周回数 (やり直した場合はここから数える)
+
+
+class JobContext:
+    """ワーカー側でジョブの関数に渡す情報"""
+
+    def __init__(self, conn, job: Job, procon, capture):
+        self.procon = procon
+        self.capture = capture
+        self.job = job
+        self.cycles = job.completed
+        self._conn = conn
+        self._stopped = False
+
+    def running(self) -> bool:
+        """続けてよいかどうか (周回数の上限・停止の要求)"""
+        if not self._stopped and self._conn.poll():
+            if self._conn.recv() == "stop":
+                self._stopped = True
+        if self.job.cycles is not None and self.cycles >= self.job.cycles:
+            return False
+        return not self._stopped
+
+    def cycle(self):
+        """1周したことを報告する (前回までの実行も含めた周回数を送る)"""
+        self.cycles += 1
+        self._conn.send(("cycle", self.job.id, self.cycles))
+
+    def stage(self, name: str):
+        """工程の時間を計測して報告する (with文で使う)"""
+        return _Stage(self, name)
+
+
+class _Stage:
+    def __init__(self, ctx: JobContext, name: str):
+        self.ctx = ctx
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.ctx._conn.send(("stage", self.ctx.job.id, (self.name, time.monotonic() - self.start)))
+        return False
+
+
+def _serve(conn, resources):
+    """ワーカー側: ジョブを受け取って順番に実行する"""
+    procon, capture = resources()
+    try:
+        while True:
+            try:
+                job = conn.recv()
+            except (EOFError, OSError):
+                return
+            if job is None:
+                return
+            if not isinstance(job, Job):
+                continue  # 実行していない時の停止の要求など
+            ctx = JobContext(conn, job, procon, capture)
+            try:
+                job.func(ctx, *job.args, **job.kwargs)
+                conn.send(("done", job.id, ctx.cycles))
+            except Exception:
+                conn.send(("error", job.id, traceback.format_exc()))
+    finally:
+        if procon is not None:
+            procon.close()
+
+
+def simulated_resources():
+    """実機の代わりに FakeGadget と VirtualClock で動かす Procon (キャプチャなし)"""
+    from .clock import VirtualClock
+    from .fake_gadget import FakeGadget
+    from .procon import Procon
+
+    clock = VirtualClock()
+    procon = Procon(gadget=FakeGadget(clock), clock=clock)
+    procon.start()
+    return procon, None
+
+
+def serve_worker(address, authkey: bytes, resources):
+    """
+    別のRaspberry Piでワーカーとして待ち受ける (RemoteWorker から接続する)
+    address: (ホスト, ポート)
+    resources: (Procon, Capture) を返すモジュールの関数
+    """
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            with listener.accept() as conn:
+                _logger.info(f"Farm connected: {listener.last_accepted}")
+                _serve(conn, resources)
+
+
+class LocalWorker:
+    """このマシンの子プロセスで実行するワーカー"""
+
+    def __init__(self, name: str, resources=simulated_resources):
+        """
+        resources: 子プロセスで (Procon, Capture) を返すモジュールの関数
+        """
+        self.name = name
+        self.resources = resources
+        self._ctx = multiprocessing.get_context("spawn")
+        self._process = None
+
+    def connect(self):
+        parent, child = self._ctx.Pipe()
+        self._process = self._ctx.Process(target=_serve, args=(child, self.resources), daemon=True)
+        self._process.start()
+        child.close()
+        return parent
+
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def terminate(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join(1.0)
+            self._process = None
+
+
+class RemoteWorker:
+    """別のRaspberry Piの serve_worker() に接続するワーカー"""
+
+    def __init__(self, name: str, address, authkey: bytes):
+        self.name = name
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+
+    def connect(self):
+        self._conn = Client(self.address, authkey=self.authkey)
+        return self._conn
+
+    def alive(self) -> bool:
+        return self._conn is not None and not self._conn.closed
+
+    def terminate(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class _Stats:
+    """工程ごとの時間の集計"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self) -> dict:
+        return {"count": self.count, "mean_s": self.total / self.count if self.count else None, "max_s": self.max}
+
+
+class Farm:
+    """
+    ジョブのキューとワーカーの管理
+    """
+
+    def __init__(self, workers, max_restarts=3, restart_delay=1.0):
+        """
+        workers: ワーカーのリスト (LocalWorker | RemoteWorker)
+        max_restarts: ワーカーを続けて作り直す最大回数 (超えたワーカーは使わない)
+                      ワーカーが落ちずにジョブを終えると数え直す
+        restart_delay: 作り直すまでの待ち時間[s] (続けて作り直した回数に比例して延ばす)
+        """
+        self.workers = list(workers)
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._unfinished = 0
+        self._idle = threading.Condition(self._lock)
+        # restarts: 作り直した回数の合計, failures: 続けて作り直した回数
+        self._worker_info = {w.name: {"state": "idle", "restarts": 0, "failures": 0, "cycles": 0,
+                                      "jobs_done": 0, "jobs_failed": 0}
+                             for w in self.workers}
+        self._job_info = {}
+
+    def submit(self, job: Job):
+        """ジョブをキューに追加する"""
+        with self._lock:
+            self._unfinished += 1
+            self._job_info[job.id] = {"name": job.name, "status": "queued", "cycles": 0, "running_s": 0.0,
+                                      "errors": [], "stages": {}}
+        self._queue.put(job)
+
+    def start(self):
+        """ワーカーごとの割り当てのスレッドを開始する"""
+        self._stop.clear()
+        for worker in self.workers:
+            thread = threading.Thread(target=self._dispatch_loop, args=(worker,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self, timeout=None) -> bool:
+        """
+        全てのジョブが終わるまで待機する
+        Return: 終わった(または使えるワーカーがなくなった)場合はTrue
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished == 0 or not self._usable_workers(), timeout)
+
+    def stop(self):
+        """ワーカーを停止する"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def metrics(self) -> dict:
+        """
+        指標を返す
+        Return: {"workers": {ワーカー名: {...}}, "jobs": {ジョブのid: {"name": ジョブ名, ...}},
+                 "cycles_per_hour": 全体の周回数/時間}
+        """
+        with self._lock:
+            jobs = {}
+            total = 0.0
+            for job_id, info in self._job_info.items():
+                hours = info["running_s"] / 3600
+                rate = info["cycles"] / hours if hours > 0 else None
+                total += rate or 0.0
+                jobs[job_id] = {
+                    "name": info["name"],
+                    "status": info["status"],
+                    "cycles": info["cycles"],
+                    "cycles_per_hour": rate,
+                    "errors": list(info["errors"]),
+                    "stages": {k: v.summary() for k, v in info["stages"].items()},
+                }
+            return {"workers": {k: dict(v) for k, v in self._worker_info.items()}, "jobs": jobs,
+                    "cycles_per_hour": total}
+
+    def _usable_workers(self) -> int:
+        return sum(1 for info in self._worker_info.values() if info["state"] != "failed")
+
+    def _finish(self, job: Job, status: str):
+        with self._lock:
+            self._job_info[job.id]["status"] = status
+            self._unfinished -= 1
+            self._idle.notify_all()
+
+    def _dispatch_loop(self, worker):
+        info = self._worker_info[worker.name]
+        conn = None
+        while not self._stop.is_set():
+            try:
+                job = self._queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+
+            if conn is None:
+                try:
+                    conn = worker.connect()
+                except OSError as e:
+                    _logger.warning(f"Farm worker {worker.name} could not connect: {e}")
+                    self._queue.put(job)
+                    if not self._restart(worker, info):
+                        return
+                    continue
+
+            job.attempts += 1
+            with self._lock:
+                info["state"] = "running"
+                self._job_info[job.id]["status"] = "running"
+            status, crashed = self._run_job(worker, info, conn, job)
+            with self._lock:
+                info["state"] = "idle"
+                if not crashed:
+                    info["failures"] = 0
+
+            if status == "done":
+                with self._lock:
+                    info["jobs_done"] += 1
+                self._finish(job, "done")
+            elif status == "stopped":
+                self._queue.put(job)
+                with self._lock:
+                    self._job_info[job.id]["status"] = "queued"
+            elif job.attempts < job.max_attempts:
+                self._queue.put(job)
+                with self._lock:
+                    self._job_info[job.id]["status"] = "queued"
+            else:
+                with self._lock:
+                    info["jobs_failed"] += 1
+                self._finish(job, "failed")
+
+            if crashed:
+                worker.terminate()
+                conn = None
+                if not self._restart(worker, info):
+                    return
+
+        if conn is not None:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            worker.terminate()
+
+    def _restart(self, worker, info) -> bool:
+        """ワーカーを続けて作り直した回数を数え、上限を超えたら使わない"""
+        with self._lock:
+            info["restarts"] += 1
+            info["failures"] += 1
+            failures = info["failures"]
+            if failures > self.max_restarts:
+                info["state"] = "failed"
+                _logger.error(f"Farm worker {worker.name} failed too many times")
+                self._idle.notify_all()
+                return False
+        self._stop.wait(self.restart_delay * failures)
+        return True
+
+    def _run_job(self, worker, info, conn, job: Job):
+        """
+        ジョブを実行して報告を集計する
+        Return: ("done" | "error" | "stopped", ワーカーが落ちたか)
+        """
+        job_info = self._job_info[job.id]
+        start = time.monotonic()
+        last = start
+        stop_sent = False
+        try:
+            conn.send(job)
+            while True:
+                if self._stop.is_set() and not stop_sent:
+                    conn.send("stop")
+                    stop_sent = True
+                if not conn.poll(0.2):
+                    if not worker.alive():
+                        raise EOFError("worker died")
+                    continue
+                kind, job_id, value = conn.recv()
+                now = time.monotonic()
+                with self._lock:
+                    job_info["running_s"] += now - last
+                    last = now
+                    if kind == "cycle":
+                        job.completed = value
+                        job_info["cycles"] = value
+                        info["cycles"] += 1
+                    elif kind == "stage":
+                        name, seconds = value
+                        job_info["stages"].setdefault(name, _Stats()).add(seconds)
+                    elif kind == "done":
+                        return ("stopped" if stop_sent and (job.cycles is None or value < job.cycles) else "done"), False
+                    elif kind == "error":
+                        job_info["errors"].append(value.strip().splitlines()[-1])
+                        _logger.warning(f"Farm job {job.name} failed on {worker.name}:\n{value}")
+                        return "error", False
+        except (EOFError, OSError) as e:
+            with self._lock:
+                job_info["running_s"] += time.monotonic() - last
+                job_info["errors"].append(f"{worker.name}: {type(e).__name__} {e}")
+            _logger.warning(f"Farm worker {worker.name} lost while running {job.name}: {e}")
+            return "error", True
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+入力から画面表示までの遅延の計測
+
+入力レポートの送信の直前(tick_hooks に常駐するフック)にボタンを押し、その送信時刻から
+キャプチャ画像のROIが変化するまでの時間を繰り返し計測する。
+結果はゲームや画面ごとの名前を付けてJSONに保存し、
+マクロの待ち時間を決める時に suggested_delay() で参照する。
+
+フレームを取得した時刻で判定するため、計測値にはキャプチャの遅延と
+1フレーム分の誤差(resolution)が含まれる。
+"""
+
+import json
+import logging
+import os
+import threading
+
+from .change_detect import ChangeDetector
+from .realtime import JitterStats
+
+_logger = logging.getLogger(__name__)
+
+
+class LatencyProbe:
+    """
+    入力から画面表示までの遅延の計測器
+    """
+
+    def __init__(self, procon, get_frame, roi=None, detector=None):
+        """
+        procon: Procon
+        get_frame: 新しいフレームを返す関数 (読み捨てのない、なるべく新しいフレーム)
+        roi: 変化を監視する範囲 (x, y, w, h) | None (フレーム全体)
+        detector: 変化の検出器 (None: ChangeDetector())
+        """
+        self.procon = procon
+        self.get_frame = get_frame
+        self.roi = roi
+        self.detector = detector if detector is not None else ChangeDetector()
+        self.stats = JitterStats()
+        self.samples = []  # [(遅延[s], 誤差[s]), ...]
+        self._pending = None  # 次の送信の直前に押すボタン名 (Noneの間はフックは何もしない)
+        self._pressed_at = None
+        self._pressed = threading.Event()
+        self._lock = threading.Lock()  # 押す処理と取り消しを排他にする
+        # フックは常駐させ、計測ごとに tick_hooks を変更しない (送信スレッドとの競合を避ける)
+        procon.add_tick_hook(self._on_tick)
+
+    def close(self):
+        """フックを取り除く"""
+        self.procon.remove_tick_hook(self._on_tick)
+
+    def _on_tick(self, procon):
+        """送信の直前にボタンを押す (入力レポートの送信スレッドから呼ばれる)"""
+        if self._pending is None:
+            return
+        with self._lock:
+            btn_key = self._pending
+            if btn_key is None:
+                return
+            procon.set_button_state(btn_key, True)
+            self._pending = None
+            self._pressed_at = procon.clock.monotonic()
+            self._pressed.set()
+
+    def _press(self, btn_key: str, timeout: float) -> bool:
+        """
+        次の入力レポートの送信の直前にボタンを押す
+        Return: 押した場合はTrue (Falseの場合は押していない)
+        """
+        clock = self.procon.clock
+        with self._lock:
+            self._pressed.clear()
+            self._pending = btn_key
+        if clock.virtual:
+            # 仮想時間では送信は clock.sleep() の間に行われる
+            deadline = clock.monotonic() + timeout
+            while not self._pressed.is_set() and clock.monotonic() < deadline:
+                clock.sleep(self.procon.report_period)
+        else:
+            self._pressed.wait(timeout)
+        with self._lock:
+            # 押されたか取り消されたかのどちらかに確定させる
+            self._pending = None
+            return self._pressed.is_set()
+
+    def _poll_frame(self, deadline: float):
+        """
+        フレームを取得する (取得できるまで待機する)
+        Return: フレーム | None (deadlineまでに取得できない場合)
+        """
+        clock = self.procon.clock
+        while True:
+            frame = self.get_frame()
+            if frame is not None:
+                return frame
+            if clock.monotonic() >= deadline:
+                return None
+            clock.sleep(self.procon.report_period)
+
+    def _reference(self, timeout: float):
+        """変化を判定する基準 | None (フレームを取得できない場合)"""
+        frame = self._poll_frame(self.procon.clock.monotonic() + timeout)
+        return None if frame is None else self.detector.signature(frame, self.roi)
+
+    def measure_once(self, btn_key: str, hold_time=0.1, timeout=1.0):
+        """
+        ボタンを1回押して遅延を計測する
+        Return: (遅延[s], 誤差[s]) | None (タイムアウト)
+        """
+        clock = self.procon.clock
+        reference = self._reference(timeout)
+        if reference is None:
+            _logger.warning("No frame for the reference")
+            return None
+
+        if not self._press(btn_key, 1.0):
+            _logger.warning("No input report was sent")
+            return None
+        pressed_at = self._pressed_at
+
+        released = False
+        result = None
+        last_unchanged = pressed_at
+        while clock.monotonic() - pressed_at < timeout:
+            if not released and clock.monotonic() - pressed_at >= hold_time:
+                self.procon.set_button_state(btn_key, False)
+                released = True
+            frame = self._poll_frame(pressed_at + timeout)
+            now = clock.monotonic()
+            if frame is None:
+                break
+            if self.detector.differs(reference, self.detector.signature(frame, self.roi)):
+                result = (now - pressed_at, now - last_unchanged)
+                break
+            last_unchanged = now
+            if clock.virtual:
+                # 仮想時間ではフレームの取得で時間が進まないため、送信1回分進める
+                clock.sleep(self.procon.report_period)
+
+        if not released:
+            clock.sleep(max(0.0, pressed_at + hold_time - clock.monotonic()))
+            self.procon.set_button_state(btn_key, False)
+        if result is not None:
+            self.samples.append(result)
+            self.stats.record(result[0])
+        return result
+
+    def measure(self, btn_key: str, revert_key=None, trials=20, hold_time=0.1, settle_time=0.5, timeout=1.0) -> dict:
+        """
+        遅延を繰り返し計測する
+        btn_key: 画面を変化させるボタン名
+        revert_key: 画面を元に戻すボタン名 (None: 戻さない。"dpad_down"に対する"dpad_up"など)
+        trials: 計測回数
+        hold_time: ボタンを押している時間[s]
+        settle_time: 次の計測までの待ち時間[s]
+        timeout: 変化を待つ最大時間[s]
+        Return: 統計 (summary())
+        """
+        for i in range(trials):
+            if self.measure_once(btn_key, hold_time, timeout) is None:
+                _logger.warning(f"Trial {i}: no change within {timeout}s")
+            self.procon.clock.sleep(settle_time)
+            if revert_key is not None:
+                self.procon.push_button(revert_key, hold_time, settle_time)
+        return self.summary()
+
+    def summary(self) -> dict:
+        """
+        計測結果の統計
+        Return: {"count", "mean", "max", "p50", "p99", "resolution"} (単位: ms)
+        """
+        result = self.stats.summary()
+        if self.samples:
+            result["resolution"] = max(r for _, r in self.samples) * 1000
+        return result
+
+
+def load_results(path: str) -> dict:
+    """保存した計測結果を読み込む"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_result(path: str, name: str, probe: LatencyProbe):
+    """
+    計測結果を名前を付けて保存する (同じ名前の結果は上書きする)
+    name: ゲームや画面の名前
+    """
+    results = load_results(path)
+    results[name] = dict(probe.summary(), samples=[round(t, 6) for t, _ in probe.samples])
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp, path)
+
+
+def suggested_delay(path: str, name: str, percentile="p99", margin=0.05, default=None):
+    """
+    計測結果からマクロの待ち時間を求める
+    percentile: 基準にする統計 ("p50" | "p99" | "max")
+    margin: 追加する余裕[s]
+    default: 計測結果がない場合の値
+    Return: 待ち時間[s]
+    """
+    result = load_results(path).get(name)
+    if result is None or percentile not in result:
+        return default
+    return result[percentile] / 1000 + margin
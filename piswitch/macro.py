@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+マクロ言語
+
+テキストで書いたマクロをバイトコードにコンパイルし、
+入力レポートの送信ごと(1フレームごと)にバイトコードを実行する。
+ボタン操作ごとにPythonの関数を呼ぶ必要がなく、実行中のマクロの差し替えもできる。
+
+書式 (1行に1命令、#以降はコメント):
+    press a [押すフレーム数=3] [離すフレーム数=3]
+    hold a
+    release a
+    stick l|r 角度 半径      # stick l center で中央に戻す
+    wait フレーム数
+    loop 回数
+        ...
+    end
+    label 名前
+    goto 名前
+    if イベント名 goto 名前  # イベントが通知されていれば分岐 (通知は消費される)
+    stop
+"""
+
+import logging
+import math
+import struct
+import sys
+import threading
+
+_logger = logging.getLogger(__name__)
+
+# 命令
+OP_HOLD = 0x01  # HOLD btn
+OP_RELEASE = 0x02  # RELEASE btn
+OP_WAIT = 0x03  # WAIT frames(u16)
+OP_STICK = 0x04  # STICK side x(i16) y(i16)  正規化した位置 (±STICK_SCALE が ±1.0)
+OP_LOOP = 0x05  # LOOP count(u16)
+OP_NEXT = 0x06  # NEXT addr(u16)
+OP_JUMP = 0x07  # JUMP addr(u16)
+OP_IF_EVENT = 0x08  # IF_EVENT event addr(u16)
+OP_STOP = 0x09  # STOP
+
+# 命令ごとのオペランドの形式
+_OPERANDS = {
+    OP_HOLD: struct.Struct("<B"),
+    OP_RELEASE: struct.Struct("<B"),
+    OP_WAIT: struct.Struct("<H"),
+    OP_STICK: struct.Struct("<Bhh"),
+    OP_LOOP: struct.Struct("<H"),
+    OP_NEXT: struct.Struct("<H"),
+    OP_JUMP: struct.Struct("<H"),
+    OP_IF_EVENT: struct.Struct("<BH"),
+    OP_STOP: struct.Struct("<"),
+}
+
+_OP_NAMES = {
+    OP_HOLD: "HOLD",
+    OP_RELEASE: "RELEASE",
+    OP_WAIT: "WAIT",
+    OP_STICK: "STICK",
+    OP_LOOP: "LOOP",
+    OP_NEXT: "NEXT",
+    OP_JUMP: "JUMP",
+    OP_IF_EVENT: "IF_EVENT",
+    OP_STOP: "STOP",
+}
+
+# ボタン: (名前, control_dataのbyte位置, ビットマスク)
+BUTTONS = [
+    ("y", 1, 0x01), ("x", 1, 0x02), ("b", 1, 0x04), ("a", 1, 0x08), ("right_sr", 1, 0x10), ("right_sl", 1, 0x20), ("r", 1, 0x40), ("zr", 1, 0x80),
+    ("minus", 2, 0x01), ("plus", 2, 0x02), ("thumb_r", 2, 0x04), ("thumb_l", 2, 0x08), ("home", 2, 0x10), ("capture", 2, 0x20),
+    ("down", 3, 0x01), ("up", 3, 0x02), ("right", 3, 0x04), ("left", 3, 0x08), ("left_sr", 3, 0x10), ("left_sl", 3, 0x20), ("l", 3, 0x40), ("zl", 3, 0x80),
+]
+_BUTTON_INDEX = {name: i for i, (name, _, _) in enumerate(BUTTONS)}
+
+# スティックのcontrol_dataの位置
+_STICK_OFFSETS = {0: 4, 1: 7}  # 0: 左, 1: 右
+_STICK_NAMES = ("l", "r")
+# スティックの位置の分解能 (実行時に Procon.stick_encoder で較正値を考慮した値に変換する)
+STICK_SCALE = 32767
+
+# 1フレームで実行する命令数の上限 (waitのない無限ループ対策)
+MAX_STEPS_PER_FRAME = 256
+
+MAGIC = b"PSMC"
+VERSION = 2
+
+
+class MacroError(ValueError):
+    """マクロの文法・バイトコードの誤り"""
+
+
+class Macro:
+    """コンパイル済みのマクロ"""
+
+    def __init__(self, code: bytes, events: list):
+        self.code = bytes(code)
+        self.events = list(events)
+
+    def to_bytes(self) -> bytes:
+        """ファイルに保存する形式に変換する"""
+        names = "\n".join(self.events).encode()
+        return MAGIC + struct.pack("<BHH", VERSION, len(names), len(self.code)) + names + self.code
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """to_bytes()の形式から読み込む (検証も行う)"""
+        if data[:4] != MAGIC:
+            raise MacroError("Not a macro file")
+        version, names_len, code_len = struct.unpack_from("<BHH", data, 4)
+        if version != VERSION:
+            raise MacroError(f"Unsupported version: {version}")
+        pos = 4 + 5
+        names = data[pos:pos + names_len].decode()
+        code = data[pos + names_len:pos + names_len + code_len]
+        macro = cls(code, names.split("\n") if names else [])
+        validate(macro)
+        return macro
+
+
+def _button(name: str, lineno: int) -> int:
+    name = name.lower()
+    for prefix in ("button_", "dpad_"):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    if name not in _BUTTON_INDEX:
+        raise MacroError(f"line {lineno}: unknown button: {name}")
+    return _BUTTON_INDEX[name]
+
+
+def _int(value: str, lineno: int, max_value=0xffff) -> int:
+    try:
+        n = int(value, 0)
+    except ValueError:
+        raise MacroError(f"line {lineno}: not a number: {value}") from None
+    if not 0 <= n <= max_value:
+        raise MacroError(f"line {lineno}: out of range: {value}")
+    return n
+
+
+def stick_position(angle: float, radius: float) -> tuple:
+    """角度と半径からスティックの正規化した位置 (±STICK_SCALE) を求める"""
+    x = round(radius * math.cos(math.radians(angle)) * STICK_SCALE)
+    y = round(radius * math.sin(math.radians(angle)) * STICK_SCALE)
+    return min(max(x, -STICK_SCALE), STICK_SCALE), min(max(y, -STICK_SCALE), STICK_SCALE)
+
+
+def compile_macro(source: str) -> Macro:
+    """
+    マクロをバイトコードにコンパイルする
+    source: マクロのテキスト
+    Return: Macro
+    """
+    code = bytearray()
+    events = []
+    labels = {}
+    fixups = []  # (オペランドの位置, ラベル名, 行番号)
+    loops = []  # (ループ先頭の位置, 行番号)
+
+    def emit(op, *operands):
+        code.append(op)
+        code.extend(_OPERANDS[op].pack(*operands))
+
+    for lineno, line in enumerate(source.splitlines(), 1):
+        tokens = line.split("#", 1)[0].split()
+        if not tokens:
+            continue
+        cmd, args = tokens[0].lower(), tokens[1:]
+
+        if cmd == "press" and 1 <= len(args) <= 3:
+            btn = _button(args[0], lineno)
+            hold = _int(args[1], lineno) if len(args) > 1 else 3
+            gap = _int(args[2], lineno) if len(args) > 2 else 3
+            emit(OP_HOLD, btn)
+            emit(OP_WAIT, max(hold, 1))
+            emit(OP_RELEASE, btn)
+            if gap > 0:
+                emit(OP_WAIT, gap)
+        elif cmd == "hold" and len(args) == 1:
+            emit(OP_HOLD, _button(args[0], lineno))
+        elif cmd == "release" and len(args) == 1:
+            emit(OP_RELEASE, _button(args[0], lineno))
+        elif cmd == "stick" and len(args) in (2, 3) and args[0] in ("l", "r"):
+            side = 0 if args[0] == "l" else 1
+            if len(args) == 2:
+                if args[1] != "center":
+                    raise MacroError(f"line {lineno}: invalid stick: {line.strip()}")
+                x, y = stick_position(0, 0)
+            else:
+                try:
+                    x, y = stick_position(float(args[1]), float(args[2]))
+                except ValueError:
+                    raise MacroError(f"line {lineno}: invalid stick: {line.strip()}") from None
+            emit(OP_STICK, side, x, y)
+        elif cmd == "wait" and len(args) == 1:
+            frames = _int(args[0], lineno)
+            if frames > 0:
+                emit(OP_WAIT, frames)
+        elif cmd == "loop" and len(args) == 1:
+            count = _int(args[0], lineno)
+            if count == 0:
+                raise MacroError(f"line {lineno}: loop count must be positive")
+            emit(OP_LOOP, count)
+            loops.append((len(code), lineno))
+        elif cmd == "end" and not args:
+            if not loops:
+                raise MacroError(f"line {lineno}: 'end' without 'loop'")
+            emit(OP_NEXT, loops.pop()[0])
+        elif cmd == "label" and len(args) == 1:
+            if args[0] in labels:
+                raise MacroError(f"line {lineno}: duplicate label: {args[0]}")
+            labels[args[0]] = len(code)
+        elif cmd == "goto" and len(args) == 1:
+            emit(OP_JUMP, 0)
+            fixups.append((len(code) - 2, args[0], lineno))
+        elif cmd == "if" and len(args) == 3 and args[1] == "goto":
+            if args[0] not in events:
+                events.append(args[0])
+            emit(OP_IF_EVENT, events.index(args[0]), 0)
+            fixups.append((len(code) - 2, args[2], lineno))
+        elif cmd == "stop" and not args:
+            emit(OP_STOP)
+        else:
+            raise MacroError(f"line {lineno}: invalid instruction: {line.strip()}")
+
+    if loops:
+        raise MacroError(f"line {loops[-1][1]}: 'loop' without 'end'")
+    for pos, label, lineno in fixups:
+        if label not in labels:
+            raise MacroError(f"line {lineno}: unknown label: {label}")
+        struct.pack_into("<H", code, pos, labels[label])
+    emit(OP_STOP)
+
+    macro = Macro(code, events)
+    validate(macro)
+    return macro
+
+
+def _decode(code: bytes):
+    """バイトコードを (位置, 命令, オペランド) に分解する"""
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        if op not in _OPERANDS:
+            raise MacroError(f"{pc:04x}: unknown opcode 0x{op:02x}")
+        fmt = _OPERANDS[op]
+        if pc + 1 + fmt.size > len(code):
+            raise MacroError(f"{pc:04x}: truncated instruction")
+        yield pc, op, fmt.unpack_from(code, pc + 1)
+        pc += 1 + fmt.size
+
+
+def validate(macro: Macro):
+    """
+    バイトコードを検証する
+    不正な場合はMacroErrorを送出する。
+    """
+    instructions = list(_decode(macro.code))
+    starts = {pc for pc, _, _ in instructions}
+    starts.add(len(macro.code))
+    # 命令ごとに、囲んでいるループ(LOOPの位置)の並びを求める
+    scopes = {len(macro.code): ()}
+    loops = []
+    for pc, op, operands in instructions:
+        if op in (OP_HOLD, OP_RELEASE) and operands[0] >= len(BUTTONS):
+            raise MacroError(f"{pc:04x}: invalid button {operands[0]}")
+        if op == OP_STICK and (operands[0] not in _STICK_OFFSETS or abs(operands[1]) > STICK_SCALE or abs(operands[2]) > STICK_SCALE):
+            raise MacroError(f"{pc:04x}: invalid stick operand {operands}")
+        if op == OP_IF_EVENT and operands[0] >= len(macro.events):
+            raise MacroError(f"{pc:04x}: invalid event {operands[0]}")
+        if op in (OP_NEXT, OP_JUMP, OP_IF_EVENT) and operands[-1] not in starts:
+            raise MacroError(f"{pc:04x}: invalid jump target {operands[-1]:04x}")
+        scopes[pc] = tuple(loops)
+        if op == OP_LOOP:
+            loops.append(pc)
+        elif op == OP_NEXT:
+            if not loops:
+                raise MacroError(f"{pc:04x}: NEXT without LOOP")
+            # NEXTの飛び先は対応するループの本体の先頭 (LOOP命令の直後)
+            if operands[0] != loops[-1] + 1 + _OPERANDS[OP_LOOP].size:
+                raise MacroError(f"{pc:04x}: NEXT does not match LOOP at {loops[-1]:04x}")
+            loops.pop()
+    if loops:
+        raise MacroError("LOOP without NEXT")
+    # ループの本体の外から中へ、中から外へは分岐できない (ループの回数が壊れるため)
+    for pc, op, operands in instructions:
+        if op in (OP_JUMP, OP_IF_EVENT) and scopes[operands[-1]] != scopes[pc]:
+            raise MacroError(f"{pc:04x}: jump {operands[-1]:04x} crosses a loop boundary")
+    if not instructions or instructions[-1][1] not in (OP_STOP, OP_JUMP):
+        raise MacroError("Macro must end with STOP or JUMP")
+
+
+def disassemble(macro: Macro) -> str:
+    """バイトコードを人が読める形式に変換する"""
+    lines = []
+    for pc, op, operands in _decode(macro.code):
+        if op in (OP_HOLD, OP_RELEASE):
+            arg = BUTTONS[operands[0]][0] if operands[0] < len(BUTTONS) else str(operands[0])
+        elif op == OP_STICK:
+            arg = f"{'lr'[operands[0]] if operands[0] < 2 else operands[0]} x={operands[1]} y={operands[2]}"
+        elif op in (OP_NEXT, OP_JUMP):
+            arg = f"{operands[0]:04x}"
+        elif op == OP_IF_EVENT:
+            name = macro.events[operands[0]] if operands[0] < len(macro.events) else str(operands[0])
+            arg = f"{name} {operands[1]:04x}"
+        else:
+            arg = " ".join(str(v) for v in operands)
+        lines.append(f"{pc:04x}: {_OP_NAMES[op]:<8} {arg}".rstrip())
+    return "\n".join(lines)
+
+
+class MacroRunner:
+    """
+    マクロの実行器
+    ProconBase.add_tick_hook() で登録すると、入力レポートの送信ごとに1フレーム分実行される。
+    """
+
+    def __init__(self, macro: Macro = None):
+        self.macro = None
+        self.running = False
+        self.frames = 0
+        self._code = b""
+        self._pc = 0
+        self._wait = 0
+        self._loops = []
+        self._events = []
+        self._event_flags = []
+        self._pending = None
+        self._lock = threading.Lock()
+        self.finished = threading.Event()
+        if macro is not None:
+            self.load(macro)
+
+    def load(self, macro: Macro):
+        """
+        マクロを読み込む
+        実行中の場合は、次のフレームの先頭で差し替える。
+        """
+        with self._lock:
+            self._pending = macro
+            self.finished.clear()
+
+    def stop(self):
+        """マクロを停止する (押しているボタンはそのまま)"""
+        self.running = False
+
+    def set_event(self, name: str):
+        """イベントを通知する (if イベント名 goto ... で分岐する)"""
+        if name in self._events:
+            self._event_flags[self._events.index(name)] = True
+
+    def __call__(self, procon):
+        """1フレーム分を実行する (入力レポートの送信スレッドから呼ばれる)"""
+        if self._pending is not None:
+            with self._lock:
+                self._swap(self._pending)
+                self._pending = None
+        if not self.running:
+            return
+        self.frames += 1
+        if self._wait > 0:
+            self._wait -= 1
+            if self._wait > 0:
+                return
+        self._step(procon)
+
+    def _swap(self, macro: Macro):
+        self.macro = macro
+        self._code = macro.code
+        self._events = macro.events
+        self._event_flags = [False] * len(macro.events)
+        self._pc = 0
+        self._wait = 0
+        self._loops = []
+        self.frames = 0
+        self.running = True
+
+    def _step(self, procon):
+        data = procon.control_data
+        code = self._code
+        pc = self._pc
+        for _ in range(MAX_STEPS_PER_FRAME):
+            op = code[pc]
+            if op == OP_HOLD:
+                _, offset, mask = BUTTONS[code[pc + 1]]
+                data[offset] |= mask
+                pc += 2
+            elif op == OP_RELEASE:
+                _, offset, mask = BUTTONS[code[pc + 1]]
+                data[offset] &= ~mask & 0xff
+                pc += 2
+            elif op == OP_WAIT:
+                self._wait = code[pc + 1] | (code[pc + 2] << 8)
+                self._pc = pc + 3
+                return
+            elif op == OP_STICK:
+                side, x, y = _OPERANDS[OP_STICK].unpack_from(code, pc + 1)
+                offset = _STICK_OFFSETS[side]
+                # 較正値を考慮して、他の方法で指定した場合と同じ値にする
+                data[offset:offset + 3] = procon.stick_encoder.encode_bytes(_STICK_NAMES[side], x / STICK_SCALE, y / STICK_SCALE)
+                pc += 6
+            elif op == OP_LOOP:
+                self._loops.append(code[pc + 1] | (code[pc + 2] << 8))
+                pc += 3
+            elif op == OP_NEXT:
+                if not self._loops:
+                    # 検証済みのマクロでは起きないが、送信スレッドを止めないように停止する
+                    _logger.error(f"Macro stopped: NEXT without LOOP at {pc:04x}")
+                    self.running = False
+                    self.finished.set()
+                    self._pc = pc
+                    return
+                self._loops[-1] -= 1
+                if self._loops[-1] > 0:
+                    pc = code[pc + 1] | (code[pc + 2] << 8)
+                else:
+                    self._loops.pop()
+                    pc += 3
+            elif op == OP_JUMP:
+                pc = code[pc + 1] | (code[pc + 2] << 8)
+            elif op == OP_IF_EVENT:
+                event = code[pc + 1]
+                if self._event_flags[event]:
+                    self._event_flags[event] = False
+                    pc = code[pc + 2] | (code[pc + 3] << 8)
+                else:
+                    pc += 4
+            else:  # OP_STOP
+                self.running = False
+                self.finished.set()
+                self._pc = pc
+                return
+        self._pc = pc
+
+
+if __name__ == "__main__":
+    # 使い方: python -m piswitch.macro マクロファイル [出力ファイル]
+    if len(sys.argv) < 2:
+        print("usage: python -m piswitch.macro SOURCE [OUTPUT]")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        compiled = compile_macro(f.read())
+    print(disassemble(compiled))
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "wb") as f:
+            f.write(compiled.to_bytes())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ネットワーク経由の入力
+
+別のマシンからUDP(またはWebSocket)で送られた入力の差分パケットを受け取り、
+ジッタバッファで到着間隔の揺らぎを吸収してから、入力レポートの送信に合わせて反映する。
+古いパケットや順序が入れ替わったパケットは捨て、片道の遅延と損失を記録する。
+片道の遅延は送信側と受信側の時計(time.time_ns)が合っている前提で計算する。
+
+パケットの形式 (34bytes):
+    "PS", バージョン(u8), フラグ(u8), シーケンス番号(u32), 送信時刻[ns](u64),
+    マスク(9bytes), 値(9bytes)
+    値は control_data[1:10] (ボタンとスティック) の全ての状態で、受信側は新しいパケットの値で
+    置き換える。そのため途中のパケットが失われても、次に届いたパケットで正しい状態に戻る。
+    マスクは前のパケットから変化したbit (記録用)。
+    スティックの値は較正を考慮しない線形な12bitの値 (0x800が中心) で、受信側が
+    Procon.stick_encoder で較正値を考慮した値に変換してから反映する。
+"""
+
+import logging
+import socket
+import struct
+import threading
+import time
+
+from .realtime import JitterStats
+from .stick import linear_position, unpack_stick
+
+_logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("<2sBBIQ")
+MAGIC = b"PS"
+VERSION = 1
+STATE_LEN = 9  # control_data[1:10]
+PACKET_LEN = HEADER.size + STATE_LEN * 2
+FLAG_KEYFRAME = 0x01  # 全ての状態を含むパケット
+
+# 何も押していない状態 (スティックは線形な値の中心)
+NEUTRAL_STATE = bytes.fromhex("000000000880000880")
+
+
+def encode_packet(seq: int, mask: bytes, value: bytes, timestamp_ns=None, flags=0) -> bytes:
+    """差分パケットを作る"""
+    if timestamp_ns is None:
+        timestamp_ns = time.time_ns()
+    return HEADER.pack(MAGIC, VERSION, flags, seq & 0xffffffff, timestamp_ns) + bytes(mask) + bytes(value)
+
+
+def decode_packet(data: bytes):
+    """
+    差分パケットを読み込む
+    Return: (シーケンス番号, 送信時刻[ns], フラグ, マスク, 値) | None (不正なパケット)
+    """
+    if len(data) != PACKET_LEN:
+        return None
+    magic, version, flags, seq, ts = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    mask = data[HEADER.size:HEADER.size + STATE_LEN]
+    value = data[HEADER.size + STATE_LEN:]
+    return seq, ts, flags, mask, value
+
+
+class NetInputClient:
+    """
+    入力の送信側
+    毎回全ての状態と前回からの変化(マスク)を送り、keyframe_intervalごとにキーフレームの印を付ける。
+    状態が変わらなくても定期的に send() を呼ぶと、最後のパケットが失われた場合にも補われる。
+    """
+
+    def __init__(self, host: str, port: int, keyframe_interval=20):
+        self.addr = (host, port)
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self._last = None
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, state: bytes):
+        """
+        状態を送信する
+        state: control_data[1:10] と同じ形式の9bytes
+        """
+        self.seq += 1
+        if self._last is None or self.seq % self.keyframe_interval == 0:
+            packet = encode_packet(self.seq, b"\xff" * STATE_LEN, state, flags=FLAG_KEYFRAME)
+        else:
+            mask = bytes(a ^ b for a, b in zip(self._last, state))
+            packet = encode_packet(self.seq, mask, state)
+        self._last = bytes(state)
+        self._sock.sendto(packet, self.addr)
+
+    def close(self):
+        self._sock.close()
+
+
+class JitterBuffer:
+    """
+    適応型のジッタバッファ
+    片道の遅延の最小値と揺らぎ(RFC 3550 の推定)から再生時刻を決める。
+    """
+
+    def __init__(self, margin=2.0, max_delay_ns=100_000_000):
+        """
+        margin: 揺らぎの何倍だけ遅らせるか
+        max_delay_ns: 揺らぎによる遅延の上限[ns]
+        """
+        self.margin = margin
+        self.max_delay_ns = max_delay_ns
+        self.jitter_ns = 0.0
+        self.base_transit_ns = None
+        self._last_transit = None
+        self._packets = []  # [(再生時刻, シーケンス番号, マスク, 値)]
+
+    def delay_ns(self) -> int:
+        """現在の追加の遅延[ns]"""
+        return int(min(self.jitter_ns * self.margin, self.max_delay_ns))
+
+    def push(self, seq: int, sent_ns: int, recv_ns: int, mask: bytes, value: bytes):
+        transit = recv_ns - sent_ns
+        if self._last_transit is not None:
+            self.jitter_ns += (abs(transit - self._last_transit) - self.jitter_ns) / 16
+        self._last_transit = transit
+        if self.base_transit_ns is None or transit < self.base_transit_ns:
+            self.base_transit_ns = transit
+        playout = sent_ns + self.base_transit_ns + self.delay_ns()
+        self._packets.append((playout, seq, mask, value))
+
+    def pop_ready(self, now_ns: int) -> list:
+        """再生時刻を過ぎたパケットをシーケンス番号順に返す"""
+        ready = [p for p in self._packets if p[0] <= now_ns]
+        if not ready:
+            return []
+        self._packets = [p for p in self._packets if p[0] > now_ns]
+        ready.sort(key=lambda p: p[1])
+        return ready
+
+
+class NetInputServer:
+    """
+    入力の受信側
+    ProconBase.add_tick_hook() で登録すると、送信の直前に受信した入力を反映する。
+    """
+
+    def __init__(self, host="0.0.0.0", port=5600, jitter_buffer=None):
+        self.host = host
+        self.port = port
+        self.buffer = jitter_buffer if jitter_buffer is not None else JitterBuffer()
+        self.latency = JitterStats()  # 片道の遅延
+        self.received = 0
+        self.lost = 0
+        self.dropped = 0  # 古い・順序が入れ替わったパケット
+        self.invalid = 0
+        self._state = bytearray(NEUTRAL_STATE)
+        self._dirty = False
+        self._last_recv_seq = None
+        self._last_applied_seq = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        """UDPでの受信を開始する"""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((self.host, self.port))
+        self._sock.settimeout(0.1)
+        self.port = self._sock.getsockname()[1]
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._recv_loop, daemon=True)
+        self._thread.start()
+
+    def start_websocket(self, host="0.0.0.0", port=5601):
+        """WebSocketでの受信を開始する (websocketsパッケージが必要)"""
+        import asyncio
+        import websockets  # 使用時に読み込む
+
+        async def handler(ws):
+            async for message in ws:
+                if isinstance(message, bytes):
+                    self.feed(message, time.time_ns())
+
+        async def serve():
+            async with websockets.serve(handler, host, port):
+                while not self._stop.is_set():
+                    await asyncio.sleep(0.1)
+
+        threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+
+    def stop(self):
+        """受信を停止する"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def feed(self, data: bytes, recv_ns: int):
+        """受信したパケットを処理する"""
+        packet = decode_packet(data)
+        if packet is None:
+            self.invalid += 1
+            return
+        seq, sent_ns, _, mask, value = packet
+        with self._lock:
+            self.received += 1
+            if seq <= self._last_applied_seq or (self._last_recv_seq is not None and seq <= self._last_recv_seq):
+                self.dropped += 1
+                return
+            if self._last_recv_seq is not None and seq > self._last_recv_seq + 1:
+                self.lost += seq - self._last_recv_seq - 1
+            self._last_recv_seq = seq
+            self.latency.record((recv_ns - sent_ns) / 1e9)
+            self.buffer.push(seq, sent_ns, recv_ns, mask, value)
+
+    def stats(self) -> dict:
+        """受信の統計"""
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "dropped": self.dropped,
+            "invalid": self.invalid,
+            "jitter_ms": self.buffer.jitter_ns / 1e6,
+            "buffer_delay_ms": self.buffer.delay_ns() / 1e6,
+            "latency_ms": self.latency.summary(),
+        }
+
+    def __call__(self, procon):
+        """送信の直前に入力を反映する (入力レポートの送信スレッドから呼ばれる)"""
+        with self._lock:
+            for _, seq, _, value in self.buffer.pop_ready(time.time_ns()):
+                if seq <= self._last_applied_seq:
+                    continue
+                # 値は全ての状態なので、失われたパケットの分もここで反映される
+                self._state[:] = value
+                self._last_applied_seq = seq
+                self._dirty = True
+            if self._dirty:
+                state = self._state
+                procon.control_data[1:4] = state[0:3]
+                encoder = procon.stick_encoder
+                for stick, i in (("l", 3), ("r", 6)):
+                    x, y = unpack_stick(state[i:i + 3])
+                    procon.control_data[i + 1:i + 4] = encoder.encode_bytes(stick, linear_position(x), linear_position(y))
+                self._dirty = False
+
+    def _recv_loop(self):
+        while not self._stop.is_set():
+            try:
+                data = self._sock.recv(PACKET_LEN + 1)
+            except socket.timeout:
+                continue
+            except OSError:
+                _logger.exception("UDP receive error")
+                return
+            self.feed(data, time.time_ns())
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+通知の送信
+
+メッセージや画像は上限付きのキューに積み、1つのワーカースレッドが
+使い回しのクライアントで送信する。
+連続したメッセージはまとめて送り、送信間隔の下限を守る。
+送信先はバックエンドとして差し替えられ、テスト用にファイルやHTTPへの送信も用意している。
+"""
+
+import abc
+import base64
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+from datetime import datetime
+
+_logger = logging.getLogger(__name__)
+
+
+class NotifyBackend(abc.ABC):
+    """
+    通知の送信先
+    send_text() と send_image() を実装していない場合は、作成した時点で TypeError になる。
+    """
+
+    @abc.abstractmethod
+    def send_text(self, text: str):
+        """メッセージを送信する"""
+
+    @abc.abstractmethod
+    def send_image(self, text: str, data: bytes, filename: str):
+        """画像を送信する"""
+
+
+class SlackBackend(NotifyBackend):
+    """Slackへの送信 (slack_sdkが必要)"""
+
+    def __init__(self, token: str, channel: str):
+        self.token = token
+        self.channel = channel
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import slack_sdk  # 使用時に読み込む
+            self._client = slack_sdk.WebClient(token=self.token)
+        return self._client
+
+    def send_text(self, text: str):
+        self.client.chat_postMessage(text=text, channel=self.channel)
+
+    def send_image(self, text: str, data: bytes, filename: str):
+        self.client.files_upload_v2(channel=self.channel, file=data, filename=filename, initial_comment=text)
+
+
+class FileBackend(NotifyBackend):
+    """ローカルのディレクトリへの保存 (Slackの代わりの動作確認用)"""
+
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+        os.makedirs(dir_path, exist_ok=True)
+
+    def send_text(self, text: str):
+        with open(os.path.join(self.dir_path, "messages.log"), "a") as f:
+            f.write(f"[{datetime.now():%Y/%m/%d %H:%M:%S}] {text}\n")
+
+    def send_image(self, text: str, data: bytes, filename: str):
+        name, ext = os.path.splitext(filename)
+        path = os.path.join(self.dir_path, f"{name}_{datetime.now():%Y%m%d_%H%M%S_%f}{ext}")
+        with open(path, "wb") as f:
+            f.write(data)
+        self.send_text(f"{text} ({os.path.basename(path)})")
+
+
+class HttpBackend(NotifyBackend):
+    """HTTPでJSONをPOSTする (Webhookなど)"""
+
+    def __init__(self, url: str, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, payload: dict):
+        req = urllib.request.Request(self.url,
+                                     data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as res:
+            res.read()
+
+    def send_text(self, text: str):
+        self._post({"text": text})
+
+    def send_image(self, text: str, data: bytes, filename: str):
+        self._post({"text": text, "filename": filename, "image": base64.b64encode(data).decode()})
+
+
+class Notifier:
+    """
+    通知の送信キュー
+    """
+
+    def __init__(self, backend: NotifyBackend, maxsize=32, min_interval=1.0):
+        """
+        backend: 送信先
+        maxsize: キューの最大長 (溢れた通知は捨てる)
+        min_interval: 送信間隔の下限[s]
+        """
+        self.backend = backend
+        self.min_interval = min_interval
+        self.sent = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._last_sent = 0.0
+        self._thread = threading.Thread(target=self._send_loop, daemon=True)
+        self._thread.start()
+
+    def notify(self, text: str) -> bool:
+        """
+        メッセージを送信する
+        Return: キューに積めた場合はTrue
+        """
+        return self._put((text, None, None))
+
+    def notify_image(self, text: str, data: bytes, filename="ss.jpg") -> bool:
+        """
+        画像を送信する
+        data: 画像のデータ (JPEGなど)
+        Return: キューに積めた場合はTrue
+        """
+        return self._put((text, bytes(data), filename))
+
+    def close(self, timeout=10.0):
+        """キューに残った通知を送信してから停止する"""
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _put(self, item) -> bool:
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            _logger.warning(f"Notification dropped: {item[0]}")
+            return False
+
+    def _send_loop(self):
+        pending = []
+        while True:
+            item = pending.pop() if pending else self._queue.get()
+            if item is None:
+                return
+            # 送信間隔を空ける (待っている間に積まれたメッセージもまとめて送る)
+            wait = self._last_sent + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            text, data, filename = item
+            if data is None:
+                # 続けて積まれたメッセージは1つにまとめる (同じ内容は1回だけ)
+                texts = [text]
+                while True:
+                    try:
+                        nxt = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if nxt is None or nxt[1] is not None:
+                        pending.append(nxt)
+                        break
+                    texts.append(nxt[0])
+                text = "\n".join(dict.fromkeys(texts))
+            self._send(text, data, filename)
+
+    def _send(self, text: str, data, filename):
+        try:
+            if data is None:
+                self.backend.send_text(text)
+            else:
+                self.backend.send_image(text, data, filename)
+            self.sent += 1
+        except Exception:
+            _logger.exception("Failed to send notification")
+        self._last_sent = time.monotonic()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OCRサービス
+
+二値化済みのROIをハッシュ化し、同じ画像に対しては前回の結果を返す(LRUキャッシュ)。
+キャッシュにない画像は専用のプロセスプールでTesseractに渡す。
+recognize() は結果を待つため、呼び出し元のスレッド(コントローラの操作など)を止めたくない場合は
+submit() (concurrent.futures.Future) か recognize_async() (asyncio) を使う。
+所持金などの数字だけの欄は、文字ごとのテンプレートで認識する
+DigitRecognizer を使うとTesseractを使わずに済む。
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from . import bitimage
+from .profiler import PROFILER
+
+_logger = logging.getLogger(__name__)
+
+# ワーカープロセス内で使うOCRツール
+_ocr_tool = None
+
+
+def _tesseract(img, lang: str, layout: int) -> str:
+    """ワーカープロセスで実行されるOCR処理"""
+    global _ocr_tool
+    import pyocr
+    import pyocr.builders
+    from PIL import Image
+
+    if _ocr_tool is None:
+        tools = pyocr.get_available_tools()
+        if len(tools) == 0:
+            raise RuntimeError("Do not find OCR tools")
+        _ocr_tool = tools[0]
+    return _ocr_tool.image_to_string(Image.fromarray(img),
+                                     lang=lang,
+                                     builder=pyocr.builders.TextBuilder(tesseract_layout=layout))
+
+
+def image_key(img) -> bytes:
+    """二値化済みの画像からキャッシュのキーを作る"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.asarray(img.shape, dtype=np.int32).tobytes())
+    h.update(bitimage.pack(img).tobytes())
+    return h.digest()
+
+
+class OcrService:
+    """
+    キャッシュ付きのOCRサービス
+    """
+
+    def __init__(self, lang="jpn", layout=6, cache_size=256, max_workers=1, debug_dir=None):
+        """
+        lang: Tesseractの言語
+        layout: Tesseractのレイアウト (tesseract_layout)
+        cache_size: キャッシュする結果の数
+        max_workers: OCRを行うプロセス数
+        debug_dir: 認識した画像を保存するディレクトリ (None: 保存しない)
+        """
+        self.lang = lang
+        self.layout = layout
+        self.cache_size = cache_size
+        self.max_workers = max_workers
+        self.debug_dir = debug_dir
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, img, name=None) -> Future:
+        """
+        OCRを非同期で実行する
+        img: 二値化済みの画像
+        name: デバッグ用の保存名
+        Return: 認識した文字列を返すFuture
+        """
+        if self.debug_dir is not None and name is not None:
+            cv2.imwrite(os.path.join(self.debug_dir, f"{name}.png"), img)
+
+        key = image_key(img)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(self._cache[key])
+                return future
+            if key in self._pending:
+                self.hits += 1
+                return self._pending[key]
+
+            self.misses += 1
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            future = self._executor.submit(_tesseract, np.ascontiguousarray(img), self.lang, self.layout)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._store(key, f))
+        return future
+
+    def recognize(self, img, name=None, timeout=None) -> str:
+        """
+        OCRを実行して結果を待つ (結果が出るまで呼び出し元のスレッドを止める)
+        img: 二値化済みの画像
+        name: デバッグ用の保存名
+        timeout: 待機する最大時間[s]
+        Return: 認識した文字列
+        """
+        with PROFILER.span("ocr", "recognition", name=name):
+            return self.submit(img, name).result(timeout)
+
+    async def recognize_async(self, img, name=None) -> str:
+        """
+        OCRを実行して結果を待つ (asyncio用。待つ間もイベントループを止めない)
+        img: 二値化済みの画像
+        name: デバッグ用の保存名
+        Return: 認識した文字列
+        """
+        return await asyncio.wrap_future(self.submit(img, name))
+
+    def _store(self, key: bytes, future: Future):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._cache[key] = future.result()
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def close(self):
+        """ワーカープロセスを停止する"""
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+class DigitRecognizer:
+    """
+    文字ごとのテンプレートによる数字の認識
+    白文字・黒背景に二値化された1行の画像を対象とする。
+    """
+
+    GLYPH_SIZE = (12, 16)  # (w, h)
+
+    def __init__(self, min_score=0.85):
+        """
+        min_score: 文字として認める最低の一致率
+        """
+        self.min_score = min_score
+        self.chars = []
+        self.glyphs = np.empty((0, self.GLYPH_SIZE[0] * self.GLYPH_SIZE[1] // 8), dtype=np.uint8)
+
+    @staticmethod
+    def segment(binary) -> list:
+        """
+        画像を文字ごとに切り出す
+        binary: 二値化済みの画像
+        Return: 文字の画像のリスト (左から順)
+        """
+        cols = np.flatnonzero(binary.any(axis=0))
+        if cols.size == 0:
+            return []
+        breaks = np.flatnonzero(np.diff(cols) > 1)
+        starts = np.concatenate(([cols[0]], cols[breaks + 1]))
+        ends = np.concatenate((cols[breaks], [cols[-1]])) + 1
+        result = []
+        for s, e in zip(starts, ends):
+            part = binary[:, s:e]
+            rows = np.flatnonzero(part.any(axis=1))
+            result.append(part[rows[0]:rows[-1] + 1])
+        return result
+
+    def _normalize(self, glyph):
+        return bitimage.pack(cv2.resize(glyph, self.GLYPH_SIZE, interpolation=cv2.INTER_NEAREST))
+
+    def learn(self, binary, text: str):
+        """
+        正解の文字列を与えて文字のテンプレートを登録する
+        binary: 二値化済みの画像
+        text: 画像に写っている文字列 (空白を除く)
+        """
+        glyphs = self.segment(binary)
+        if len(glyphs) != len(text):
+            raise ValueError(f"{len(glyphs)} glyphs found for {text!r}")
+        for c, glyph in zip(text, glyphs):
+            packed = self._normalize(glyph)
+            if c in self.chars:
+                self.glyphs[self.chars.index(c)] = packed
+            else:
+                self.chars.append(c)
+                self.glyphs = np.vstack([self.glyphs, packed])
+
+    def recognize(self, binary):
+        """
+        文字列を認識する
+        binary: 二値化済みの画像
+        Return: 認識した文字列 | None (認識できない文字があった場合)
+        """
+        if not self.chars:
+            return None
+        size = self.GLYPH_SIZE[0] * self.GLYPH_SIZE[1]
+        text = []
+        with PROFILER.span("digits", "recognition"):
+            for glyph in self.segment(binary):
+                diff = bitimage.popcount(np.bitwise_xor(self.glyphs, self._normalize(glyph))).sum(axis=1)
+                best = int(np.argmin(diff))
+                if 1.0 - diff[best] / size < self.min_score:
+                    return None
+                text.append(self.chars[best])
+        return "".join(text)
+
+    def recognize_int(self, binary):
+        """
+        数値を認識する (数字以外の文字は無視する)
+        binary: 二値化済みの画像
+        Return: 認識した数値 | None
+        """
+        text = self.recognize(binary)
+        if text is None:
+            return None
+        digits = "".join(c for c in text if c.isdigit())
+        return int(digits) if digits else None
+
+    def save(self, path: str):
+        """文字のテンプレートを保存する"""
+        with open(path, "wb") as f:
+            np.savez(f, chars=np.array(self.chars), glyphs=self.glyphs)
+
+    @classmethod
+    def load(cls, path: str, min_score=0.85):
+        """save()で保存した文字のテンプレートを読み込む"""
+        recognizer = cls(min_score)
+        with np.load(path) as data:
+            recognizer.chars = [str(c) for c in data["chars"]]
+            recognizer.glyphs = data["glyphs"]
+        return recognizer
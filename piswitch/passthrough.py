@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ゲームパッドのパススルー
+
+Linuxのevdevデバイス(ゲームパッドなど)の入力を読み込み、
+事前に作った対応表でプロコンのボタン・スティックの状態に変換して、
+次の入力レポートで送信する。
+入力イベントの発生から送信までの遅延を記録する。
+テストでは SyntheticSource で入力イベントを与えられる。
+"""
+
+import select
+import threading
+import time
+from collections import deque
+
+from .macro import BUTTONS
+from .realtime import JitterStats
+
+# evdevのイベントの種類
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+
+# evdevのコード (linux/input-event-codes.h)
+CODES = {
+    "BTN_SOUTH": 0x130, "BTN_EAST": 0x131, "BTN_NORTH": 0x133, "BTN_WEST": 0x134,
+    "BTN_TL": 0x136, "BTN_TR": 0x137, "BTN_TL2": 0x138, "BTN_TR2": 0x139,
+    "BTN_SELECT": 0x13a, "BTN_START": 0x13b, "BTN_MODE": 0x13c, "BTN_THUMBL": 0x13d, "BTN_THUMBR": 0x13e,
+    "BTN_Z": 0x135,
+    "BTN_DPAD_UP": 0x220, "BTN_DPAD_DOWN": 0x221, "BTN_DPAD_LEFT": 0x222, "BTN_DPAD_RIGHT": 0x223,
+    "ABS_X": 0x00, "ABS_Y": 0x01, "ABS_Z": 0x02, "ABS_RX": 0x03, "ABS_RY": 0x04, "ABS_RZ": 0x05,
+    "ABS_HAT0X": 0x10, "ABS_HAT0Y": 0x11,
+}
+
+# 標準の対応表 (任天堂の配置: 下がB、右がA)
+# ボタン: "コード名": "ボタン名"
+# 軸: "コード名": ("lx" | "ly" | "rx" | "ry", 反転するか)
+#      "コード名": ("hat", "負側のボタン名", "正側のボタン名")
+#      "コード名": ("trigger", "ボタン名")
+DEFAULT_MAPPING = {
+    "BTN_SOUTH": "b", "BTN_EAST": "a", "BTN_NORTH": "x", "BTN_WEST": "y",
+    "BTN_TL": "l", "BTN_TR": "r", "BTN_TL2": "zl", "BTN_TR2": "zr",
+    "BTN_SELECT": "minus", "BTN_START": "plus", "BTN_MODE": "home", "BTN_Z": "capture",
+    "BTN_THUMBL": "thumb_l", "BTN_THUMBR": "thumb_r",
+    "BTN_DPAD_UP": "up", "BTN_DPAD_DOWN": "down", "BTN_DPAD_LEFT": "left", "BTN_DPAD_RIGHT": "right",
+    "ABS_X": ("lx", False), "ABS_Y": ("ly", True), "ABS_RX": ("rx", False), "ABS_RY": ("ry", True),
+    "ABS_HAT0X": ("hat", "left", "right"), "ABS_HAT0Y": ("hat", "up", "down"),
+    "ABS_Z": ("trigger", "zl"), "ABS_RZ": ("trigger", "zr"),
+}
+
+# 対応表の種類
+_KIND_BUTTON = 0
+_KIND_AXIS = 1
+_KIND_HAT = 2
+_KIND_TRIGGER = 3
+
+# スティックの軸: (スティック, x | y)
+_AXES = {"lx": ("l", 0), "ly": ("l", 1), "rx": ("r", 0), "ry": ("r", 1)}
+# スティックのcontrol_dataの位置
+_STICK_OFFSETS = {"l": 4, "r": 7}
+
+_BUTTON_BITS = {name: (offset, mask) for name, offset, mask in BUTTONS}
+
+
+def compile_mapping(mapping=None, absinfo=None) -> dict:
+    """
+    対応表を (種類, コード) をキーとする表に変換する
+    mapping: 対応表 (None: DEFAULT_MAPPING)
+    absinfo: 軸ごとの範囲 {コード: (最小値, 最大値)} (指定がない軸は -32768~32767)
+    Return: {(種類, コード): 変換方法}
+    """
+    mapping = DEFAULT_MAPPING if mapping is None else mapping
+    absinfo = absinfo or {}
+    table = {}
+    for name, target in mapping.items():
+        code = CODES[name] if isinstance(name, str) else name
+        if isinstance(target, str):
+            table[(EV_KEY, code)] = (_KIND_BUTTON,) + _BUTTON_BITS[target]
+            continue
+        lo, hi = absinfo.get(code, (-32768, 32767))
+        if target[0] == "hat":
+            table[(EV_ABS, code)] = (_KIND_HAT, _BUTTON_BITS[target[1]], _BUTTON_BITS[target[2]])
+        elif target[0] == "trigger":
+            table[(EV_ABS, code)] = (_KIND_TRIGGER,) + _BUTTON_BITS[target[1]] + ((lo + hi) / 2,)
+        else:
+            stick, component = _AXES[target[0]]
+            scale = 2.0 / (hi - lo)
+            table[(EV_ABS, code)] = (_KIND_AXIS, stick, component, lo, scale, target[1])
+    return table
+
+
+def mapped_bits(table: dict) -> tuple:
+    """
+    対応表が変更するボタンのビットとスティック
+    table: compile_mapping() の結果
+    Return: (control_data[0:4] のマスク, スティックのタプル)
+    """
+    mask = bytearray(4)
+    sticks = set()
+    for entry in table.values():
+        kind = entry[0]
+        if kind == _KIND_AXIS:
+            sticks.add(entry[1])
+        elif kind == _KIND_HAT:
+            for offset, bit in entry[1:]:
+                mask[offset] |= bit
+        else:
+            mask[entry[1]] |= entry[2]
+    return bytes(mask), tuple(sorted(sticks))
+
+
+class SyntheticSource:
+    """テスト用の入力イベントの発生源"""
+
+    def __init__(self, time_func=time.time):
+        self.time_func = time_func
+        self._events = deque()
+
+    def push(self, ev_type: int, code: int, value: int, timestamp=None):
+        """入力イベントを追加する"""
+        if timestamp is None:
+            timestamp = self.time_func()
+        self._events.append((timestamp, ev_type, code, value))
+
+    def fileno(self):
+        return None
+
+    def read(self) -> list:
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+    def absinfo(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class EvdevSource:
+    """evdevデバイスからの入力イベントの読み込み (python-evdevが必要)"""
+
+    def __init__(self, path: str, grab=False):
+        """
+        path: デバイスのパス (/dev/input/eventX)
+        grab: 他のプログラムに入力を渡さない
+        """
+        import evdev  # 使用時に読み込む
+        self.device = evdev.InputDevice(path)
+        if grab:
+            self.device.grab()
+
+    def fileno(self):
+        return self.device.fd
+
+    def read(self) -> list:
+        try:
+            return [(e.timestamp(), e.type, e.code, e.value) for e in self.device.read()]
+        except BlockingIOError:
+            return []
+
+    def absinfo(self) -> dict:
+        caps = self.device.capabilities(absinfo=True).get(EV_ABS, [])
+        return {code: (info.min, info.max) for code, info in caps}
+
+    def close(self):
+        self.device.close()
+
+
+class Passthrough:
+    """
+    入力イベントをプロコンの入力に変換する
+    ProconBase.add_tick_hook() で登録すると、送信の直前に状態を反映する。
+    対応表にあるボタンのビットとスティックだけを変更するため、charging_grip や
+    Procon.set_button_state() で押した対応表にないボタンはそのまま残る。
+    スティックは正規化した位置として保持し、反映する時に Procon.stick_encoder で較正値を考慮した値にする。
+    """
+
+    def __init__(self, source, mapping=None, time_func=time.time):
+        """
+        source: 入力イベントの発生源 (EvdevSource | SyntheticSource)
+        mapping: 対応表 (None: DEFAULT_MAPPING)
+        time_func: 遅延の計測に使う時計 (入力イベントの時刻と同じ基準)
+        """
+        self.source = source
+        self.table = compile_mapping(mapping, source.absinfo())
+        self._mask, self._mapped_sticks = mapped_bits(self.table)
+        self.time_func = time_func
+        self.latency = JitterStats()
+        self._state = bytearray(4)  # control_data[0:4] (ボタン)
+        self._sticks = {"l": [0.0, 0.0], "r": [0.0, 0.0]}  # 正規化した位置 (-1~1)
+        self._sticks_dirty = False
+        self._dirty = False
+        self._first_event_time = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """入力イベントの読み込みを開始する"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """入力イベントの読み込みを停止する"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self):
+        """発生した入力イベントを読み込んで反映する"""
+        for event in self.source.read():
+            self.apply(*event)
+
+    def apply(self, timestamp: float, ev_type: int, code: int, value: int):
+        """入力イベントを1つ反映する"""
+        entry = self.table.get((ev_type, code))
+        if entry is None:
+            return
+        state = self._state
+        with self._lock:
+            kind = entry[0]
+            if kind == _KIND_BUTTON:
+                _, offset, mask = entry
+                if value:
+                    state[offset] |= mask
+                else:
+                    state[offset] &= ~mask & 0xff
+            elif kind == _KIND_AXIS:
+                _, stick, component, lo, scale, invert = entry
+                v = min(max((value - lo) * scale - 1.0, -1.0), 1.0)
+                self._sticks[stick][component] = -v if invert else v
+                self._sticks_dirty = True
+            elif kind == _KIND_HAT:
+                _, (neg_offset, neg_mask), (pos_offset, pos_mask) = entry
+                state[neg_offset] &= ~neg_mask & 0xff
+                state[pos_offset] &= ~pos_mask & 0xff
+                if value < 0:
+                    state[neg_offset] |= neg_mask
+                elif value > 0:
+                    state[pos_offset] |= pos_mask
+            else:  # _KIND_TRIGGER
+                _, offset, mask, threshold = entry
+                if value > threshold:
+                    state[offset] |= mask
+                else:
+                    state[offset] &= ~mask & 0xff
+            self._dirty = True
+            if self._first_event_time is None:
+                self._first_event_time = timestamp
+
+    def __call__(self, procon):
+        """送信の直前に状態を反映する (入力レポートの送信スレッドから呼ばれる)"""
+        if self._thread is None:
+            self.poll()
+        if not self._dirty:
+            return
+        control_data = procon.control_data
+        mask = self._mask
+        with self._lock:
+            for i in range(1, 4):
+                control_data[i] = (control_data[i] & ~mask[i] & 0xff) | (self._state[i] & mask[i])
+            if self._sticks_dirty:
+                encoder = procon.stick_encoder
+                for stick in self._mapped_sticks:
+                    x, y = self._sticks[stick]
+                    offset = _STICK_OFFSETS[stick]
+                    control_data[offset:offset + 3] = encoder.encode_bytes(stick, x, y)
+                self._sticks_dirty = False
+            self._dirty = False
+            first = self._first_event_time
+            self._first_event_time = None
+        self.latency.record(self.time_func() - first)
+
+    def _read_loop(self):
+        fd = self.source.fileno()
+        while not self._stop.is_set():
+            if fd is not None:
+                r, _, _ = select.select([fd], [], [], 0.1)
+                if not r:
+                    continue
+            else:
+                self._stop.wait(0.001)
+            self.poll()
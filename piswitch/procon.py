@@ -6,8 +6,9 @@ Proconクラスの定義
 """
 
 import math
-import time
+import threading
 from .procon_base import ProconBase
+from .profiler import PROFILER
 
 
 def combine_12bit_values(val1: int, val2: int) -> int:
@@ -24,10 +25,28 @@ def combine_12bit_values(val1: int, val2: int) -> int:
     return data
 
 
+class PressUntilResult:
+    """press_until()の結果"""
+
+    def __init__(self):
+        self.matched = False  # 条件を満たしたかどうか
+        self.elapsed = None  # 条件を満たすまでの時間[s]
+        self.actions = 0  # 実行した操作の数
+        self.frames = 0  # 判定したフレームの数
+        self.frame = None  # 条件を満たしたフレーム
+
+    def __repr__(self):
+        return f"PressUntilResult(matched={self.matched}, elapsed={self.elapsed}, actions={self.actions}, frames={self.frames})"
+
+
 class Procon(ProconBase):
 
-    def __init__(self, body_color="ff0000", button_color="ffff00", left_grip_color="00ff00", right_grip_color="0000ff"):
-        super().__init__()
+    def __init__(self, body_color="ff0000", button_color="ffff00", left_grip_color="00ff00", right_grip_color="0000ff", **kwargs):
+        """
+        body_color, button_color, left_grip_color, right_grip_color: コントローラの色 (RRGGBB)
+        kwargs: ProconBaseの引数
+        """
+        super().__init__(**kwargs)
 
         # ボタン名をより一般的な名前に変換する辞書
         self.btn_key_dict = {
@@ -75,16 +94,15 @@ class Procon(ProconBase):
             print("Invalid button key: " + btn_key)
 
 
-    def move_stick(self, stick: str, angle: float, radius: float):
+    def set_stick(self, stick: str, x: float, y: float):
         """
-        左右のJoyスティックを動かす
+        左右のJoyスティックを正規化した位置に動かす
+        SPI ROMの較正値を考慮し、ゲーム内で指定した位置になるようにする。
         stick: "l" | "r"
-        angle: 角度(0~360)
-        radius: 半径(0~1.0)
+        x, y: -1.0~1.0 (右・上が正)
         """
-        x = round((1.0 + radius * math.cos(math.radians(angle))) * 2047.5)
-        y = round((1.0 + radius * math.sin(math.radians(angle))) * 2047.5)
-        analog = combine_12bit_values(x, y)
+        PROFILER.instant("stick", "input", stick=stick, x=x, y=y)
+        analog = self.stick_encoder.encode_bytes(stick, x, y)
         if stick == "l":
             self.control.analog[0] = analog[0]
             self.control.analog[1] = analog[1]
@@ -94,6 +112,15 @@ class Procon(ProconBase):
             self.control.analog[4] = analog[1]
             self.control.analog[5] = analog[2]
 
+    def move_stick(self, stick: str, angle: float, radius: float):
+        """
+        左右のJoyスティックを動かす
+        stick: "l" | "r"
+        angle: 角度(0~360)
+        radius: 半径(0~1.0)
+        """
+        self.set_stick(stick, radius * math.cos(math.radians(angle)), radius * math.sin(math.radians(angle)))
+
     def move_left_stick(self, angle: float, radius: float):
         """
         左Joyスティックを動かす
@@ -118,12 +145,91 @@ class Procon(ProconBase):
         delay_time: ボタンを離してから次のボタンを押すまでの時間
         repeat_count: ボタンを押す回数
         """
-        self.control.charging_grip = 1
-        self.set_button_state(btn_key, True)
-        time.sleep(hold_time)
-        self.set_button_state(btn_key, False)
-        time.sleep(delay_time)
+        with PROFILER.span("push_button", "input", button=btn_key):
+            self.control.charging_grip = 1
+            self.set_button_state(btn_key, True)
+            self.clock.sleep(hold_time)
+            self.set_button_state(btn_key, False)
+            self.clock.sleep(delay_time)
 
         if repeat_count > 1:
             # 残りの回数を再帰的に呼び出す
-            self.push(btn_key, hold_time, delay_time, repeat_count - 1)
+            self.push_button(btn_key, hold_time, delay_time, repeat_count - 1)
+
+    def press_until(self, actions, predicate, get_frame, timeout=30.0, poll_interval=None) -> PressUntilResult:
+        """
+        画面が条件を満たすまでボタンを押す
+        新しいフレームが届くたびに条件を判定し、満たした時点で残りの操作を取りやめる。
+        actions: [(ボタン名, 押す時間, 離してから次の操作までの時間), ...]
+        predicate: フレームを受け取り、条件を満たすとTrueを返す関数
+        get_frame: 最新のフレームを返す関数 (前回と同じオブジェクト・Noneの場合は判定しない)
+        timeout: 最大時間[s]
+        poll_interval: 新しいフレームがない時に次に確認するまでの時間[s] (None: 入力レポートの周期)
+        Return: PressUntilResult
+        """
+        poll_interval = self.report_period if poll_interval is None else poll_interval
+        clock = self.clock
+        result = PressUntilResult()
+        done = threading.Event()
+        start = clock.monotonic()
+        deadline = start + timeout
+        last = [None]  # 最後に判定したフレーム
+
+        def check() -> bool:
+            """新しいフレームが届いていれば判定する (Return: 新しいフレームがあった場合はTrue)"""
+            frame = get_frame()
+            if frame is None or frame is last[0]:
+                return False
+            last[0] = frame
+            result.frames += 1
+            if predicate(frame):
+                result.elapsed = clock.monotonic() - start
+                result.frame = frame
+                result.matched = True
+            return True
+
+        def watch():
+            while not done.is_set() and not result.matched and clock.monotonic() < deadline:
+                if not check():
+                    # 新しいフレームが届くまで待つ (空回りしない)
+                    clock.sleep(poll_interval)
+
+        def wait_until(t: float):
+            """時刻tまで、または条件を満たすまで待機する"""
+            t = min(t, deadline)
+            while not result.matched:
+                if clock.virtual:
+                    # 仮想時間では時計を1つのスレッドで進めるため、ここで判定する
+                    check()
+                    if result.matched:
+                        break
+                remaining = t - clock.monotonic()
+                if remaining <= 0:
+                    break
+                clock.sleep(min(poll_interval, remaining))
+
+        watcher = None
+        if not clock.virtual:
+            # フレームの取得は待たされることがあるため、ボタン操作とは別のスレッドで行う
+            watcher = threading.Thread(target=watch, daemon=True)
+            watcher.start()
+
+        with PROFILER.span("press_until", "input", actions=len(actions)):
+            self.control.charging_grip = 1
+            for btn_key, hold_time, delay_time in actions:
+                if result.matched or clock.monotonic() >= deadline:
+                    break
+                self.set_button_state(btn_key, True)
+                # 少なくとも1回はボタンを押した状態のレポートを送る
+                self.wait_report(1.0)
+                wait_until(clock.monotonic() + hold_time)
+                self.set_button_state(btn_key, False)
+                result.actions += 1
+                wait_until(clock.monotonic() + delay_time)
+
+            # 操作を使い切っても、タイムアウトまでは判定を続ける
+            wait_until(deadline)
+        done.set()
+        if watcher is not None:
+            watcher.join(1.0)
+        return result
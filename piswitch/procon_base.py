@@ -5,16 +5,18 @@ Proconの基本クラス
 """
 import logging
 import threading
-import time
 from ctypes import LittleEndianStructure, c_uint8
 
 from .procon_usb_gadget import ProconUsbGadget
+from .clock import Clock
+from .realtime import JitterStats
+from .profiler import PROFILER
+from .report import create_reports, MODE_STANDARD
+from .stick import StickEncoder
+from .eventlog import EventLog, EV_MAC_ADDR, EV_HANDSHAKE, EV_BAUDRATE, EV_REPORT_ON, EV_REPORT_OFF, EV_UART, EV_SPI_MISS, EV_UNKNOWN
 
-# DEBUG, INFO, WARNING, ERROR, CRITICAL
+# ログの出力先やレベルは利用側で設定する (import時には設定しない)
 _logger = logging.getLogger(__name__)
-_logger.setLevel(logging.DEBUG)
-_logger.addHandler(logging.StreamHandler())
-# _logger.propagate = True
 
 class ProconControlStruct(LittleEndianStructure):
     # コントロールデータ構造体 (11bytes)
@@ -28,17 +30,46 @@ class ProconControlStruct(LittleEndianStructure):
 
 class ProconBase:
 
-    def __init__(self, mac_addr="00005e00535f"):
+    def __init__(self, mac_addr="00005e00535f", event_log=None, realtime=None, gadget=None, clock=None):
+        """
+        mac_addr: MACアドレス
+        event_log: 通信のイベントログ (None: piswitch.procon_base のロガーでINFOが有効な場合のみ出力)
+        realtime: 送受信スレッドのリアルタイム実行設定 (piswitch.realtime.RealtimeProfile | None)
+        gadget: 送受信先 (None: USB Gadget。テストでは piswitch.fake_gadget.FakeGadget、
+                通信を記録する場合は piswitch.trace.TracingGadget で包む)
+        clock: 時計 (None: 実時間。シミュレーションでは piswitch.clock.VirtualClock)
+        """
         self.mac_addr = mac_addr
+        self.clock = clock if clock is not None else Clock()
+        if event_log is None:
+            # ロガーがINFOを出力しない場合は、イベントを積まず書き出しのスレッドも作らない
+            event_log = EventLog(_logger if _logger.isEnabledFor(logging.INFO) else None)
+        self.events = event_log
+        self.realtime = realtime
 
         self.control_data = bytearray.fromhex("810000000008800008800c")
         self.control = ProconControlStruct.from_buffer(self.control_data)
         self.counter = 0
         self.player_lights = 0
 
+        # 入力レポートの送信回数 (送信ごとにreport_condで通知する)
+        self.report_count = 0
+        self.report_cond = threading.Condition()
+
+        # 入力レポートの送信 (40Hz)
+        self.report_period = 1 / 40
+        # 入力レポートの形式ごとの作成器 (送信バッファは作成器ごとに使い回す)
+        self.reports = create_reports()
+        self.report = self.reports[MODE_STANDARD]
+        self.jitter = JitterStats()
+        # 送信の直前に毎回呼ばれる関数 (hook(procon) の形。マクロの実行などに使う。例外を送出したものは取り除く)
+        # 送信ごとに複製しないよう不変のタプルにし、add_tick_hook()/remove_tick_hook() で作り直す
+        self.tick_hooks = ()
+        self._tick_hooks_lock = threading.Lock()
+
         self.input_looping = False
         self.close_req_flag = False
-        self.gadget = ProconUsbGadget("procon")
+        self.gadget = gadget if gadget is not None else ProconUsbGadget("procon")
 
         self.spi_rom = {
             0x60:
@@ -60,9 +91,21 @@ class ProconBase:
                                   "0040 0040 eaff 0f00 0700 e73b e73b e73b")
         }
 
+        # スティックの較正値を考慮した変換 (SPI ROMの較正値が変わると作り直す)
+        self.stick_encoder = StickEncoder(self.spi_rom)
+        # スティックの初期値は較正値の中心
+        self.control_data[4:10] = self.stick_encoder.neutral()
+
     def start(self):
         """プロコンを起動"""
         self.gadget.open()
+        self.events.start()
+
+        if self.clock.virtual:
+            # 仮想時間では、ハンドシェイクを省略して入力レポートの送信を
+            # 時計のタイマーで行う (clock.sleep() の間に送信される)
+            self.start_input_reports()
+            return True
 
         # self.reset_magic_packet()
 
@@ -75,15 +118,20 @@ class ProconBase:
                 st = True
                 break
             # 通信が始まるまで待機
-            time.sleep(0.1)
+            self.clock.sleep(0.1)
         return st
 
     def close(self):
         """プロコンを停止する"""
         self.input_looping = False
         self.close_req_flag = True
-        time.sleep(0.5)
+        if self.clock.virtual:
+            self.clock.cancel(self.virtual_tick)
+        self.clock.sleep(0.5)
         self.gadget.close()
+        self.events.stop()
+        if self.realtime is not None:
+            self.realtime.stop_streaming()
 
     def send_usb(self, send_buf: bytearray, max_packet_size: int) -> bool:
         """
@@ -131,9 +179,9 @@ class ProconBase:
     def reset_magic_packet(self):
         # reset magic packet
         self.send_hid(0x81, 0x03, bytes([]))
-        time.sleep(0.05)
+        self.clock.sleep(0.05)
         self.send_hid(0x81, 0x01, bytes([0x00, 0x03]))
-        time.sleep(0.05)
+        self.clock.sleep(0.05)
 
     def countup_loop(self):
         """
@@ -143,14 +191,121 @@ class ProconBase:
         """
         while not self.close_req_flag:
             self.counter = (self.counter + 2) % 256
-            time.sleep(1 / 40)
+            self.clock.sleep(1 / 40)
+
+    def start_input_reports(self):
+        """入力レポートの送信を開始する"""
+        if self.input_looping:
+            return
+        self.input_looping = True
+        if self.clock.virtual:
+            self.clock.call_every(self.report_period, self.virtual_tick)
+        else:
+            threading.Thread(target=self.send_input_loop, daemon=True).start()
+
+    def stop_input_reports(self):
+        """入力レポートの送信を停止する"""
+        self.input_looping = False
+        if self.clock.virtual:
+            self.clock.cancel(self.virtual_tick)
 
     def send_input_loop(self):
+        """
+        入力レポートを一定周期で送信する
+        予定時刻からの遅れはjitterに記録する。
+        """
+        if self.realtime is not None:
+            self.realtime.apply_to_current_thread()
+            self.realtime.start_streaming()
+
+        next_time = self.clock.monotonic()
         while self.input_looping and not self.close_req_flag:
-            buf = self.control_data
-            # 0x30: コントローラー入力のみ
-            self.send_hid(0x30, self.counter, buf)
-            time.sleep(1 / 40)
+            now = self.clock.monotonic()
+            self.jitter.record(now - next_time)
+
+            self.send_report()
+
+            next_time += self.report_period
+            now = self.clock.monotonic()
+            if next_time < now:
+                # 大きく遅れた場合は周期を合わせ直す
+                next_time = now
+            if self.realtime is not None:
+                self.realtime.idle(now)
+            self.clock.sleep(next_time - self.clock.monotonic())
+
+    def add_tick_hook(self, hook):
+        """
+        送信の直前に毎回呼ばれる関数を登録する
+        hook: hook(procon) の形の関数
+        """
+        with self._tick_hooks_lock:
+            self.tick_hooks = self.tick_hooks + (hook,)
+
+    def remove_tick_hook(self, hook) -> bool:
+        """
+        登録した関数を取り除く
+        Return: 登録されていた場合はTrue
+        """
+        with self._tick_hooks_lock:
+            hooks = list(self.tick_hooks)
+            if hook not in hooks:
+                return False
+            hooks.remove(hook)
+            self.tick_hooks = tuple(hooks)
+            return True
+
+    def send_report(self):
+        """入力レポートを1回送信する"""
+        if PROFILER.enabled:
+            PROFILER.instant("report", "tick", counter=self.counter)
+        # 送信中に登録・削除されても、この送信では参照したタプルのフックを呼ぶ
+        for hook in self.tick_hooks:
+            try:
+                hook(self)
+            except Exception:
+                # 1つのフックの誤りで入力レポートの送信を止めない
+                _logger.exception(f"Tick hook failed and was removed: {hook!r}")
+                self.remove_tick_hook(hook)
+        # 送信ごとに1回だけ参照するため、形式の切り替えは送信の間に反映される
+        report = self.report
+        self.gadget.send(report.encode(self))
+        with self.report_cond:
+            self.report_count += 1
+            self.report_cond.notify_all()
+
+    def virtual_tick(self):
+        """仮想時間での入力レポートの送信 (countup_loopとsend_input_loopの1周期分)"""
+        if self.input_looping and not self.close_req_flag:
+            self.counter = (self.counter + 2) % 256
+            self.send_report()
+
+    def wait_report(self, timeout=None) -> bool:
+        """
+        次の入力レポートが送信されるまで待機する
+        timeout: 待機する最大時間[s]
+        Return: 送信された場合はTrue
+        """
+        if self.clock.virtual:
+            n = self.report_count
+            self.clock.sleep(self.report_period if timeout is None else min(timeout, self.report_period))
+            return self.report_count != n
+        with self.report_cond:
+            n = self.report_count
+            return self.report_cond.wait_for(lambda: self.report_count != n, timeout)
+
+    def set_input_report_mode(self, mode: int) -> bool:
+        """
+        入力レポートの形式を切り替える
+        mode: 0x30 (標準) | 0x31 (NFC/IR) | 0x3F (簡易HID) など
+        Return: 対応している形式の場合はTrue
+        """
+        report = self.reports.get(mode)
+        if report is None:
+            self.events.emit(EV_UNKNOWN, mode)
+            return False
+        self.report = report
+        return True
 
     def read_spi_rom(self, spi_addr: bytes, data_len):
         """SPIでのROMの読み込み"""
@@ -158,8 +313,8 @@ class ProconBase:
             addr1 = spi_addr[1]
             addr2 = spi_addr[0]
             return self.spi_rom[addr1][addr2:addr2 + data_len]
-        except IndexError:
-            _logger.error(f"{spi_addr}({data_len}) is not found")
+        except (IndexError, KeyError):
+            self.events.emit(EV_SPI_MISS, data_len, spi_addr)
             return None
 
     def player_lights_str(self):
@@ -169,31 +324,32 @@ class ProconBase:
         """
         UARTでの対話
         """
+        self.events.emit(EV_UART, subcmd, data)
         if subcmd == 0x01:
-            _logger.info(f">>> [UART] Bluetooth manual pairing: {data.hex()}")
+            # Bluetooth manual pairing
             self.send_uart(0x81, subcmd, [0x03, 0x01])
         elif subcmd == 0x02:
-            _logger.info(f">>> [UART] Request device info")
+            # Request device info
             self.send_uart(0x82, subcmd, bytes.fromhex("0421 03 02" + self.mac_addr[::-1] + "03 02"))
         elif subcmd == 0x30:
             # Set player lights
             self.player_lights = data[0]
-            _logger.info(f">>> [UART] Set player lights: {self.player_lights_str()}")
             self.send_uart(0x80, subcmd, [])
         elif subcmd == 0x03:
-            _logger.info(f">>> [UART] Set input report mode: {data[0]}")
+            # Set input report mode
+            self.set_input_report_mode(data[0])
             self.send_uart(0x80, subcmd, [])
         elif subcmd == 0x08:
-            _logger.info(f">>> [UART] Set shipment low power state: {data[0]}")
+            # Set shipment low power state
             self.send_uart(0x80, subcmd, [])
         elif subcmd == 0x38:
-            _logger.info(f">>> [UART] 0x38: {data.hex()}")
+            # Set HOME light
             self.send_uart(0x80, subcmd, [])
         elif subcmd == 0x40:
-            _logger.info(f">>> [UART] Enable IMU: {data.hex()}")
+            # Enable IMU
             self.send_uart(0x80, subcmd, [])
         elif subcmd == 0x48:
-            _logger.info(f">>> [UART] Enable vibration: {data[0]}")
+            # Enable vibration
             self.send_uart(0x80, subcmd, [])
         elif subcmd == 0x04:
             # Trigger buttons elapsed time
@@ -208,45 +364,54 @@ class ProconBase:
             rom_data = self.read_spi_rom(spi_addr, data_len)
             if rom_data != None:
                 self.send_spi(spi_addr, rom_data)
-        else:
-            _logger.debug(">>> [UART]", subcmd, data.hex())
+        # それ以外のサブコマンドには応答しない (イベントログにのみ記録)
 
     def interact_loop(self):
         """
         対話の繰り返し
         """
+        if self.realtime is not None:
+            self.realtime.apply_to_current_thread()
+
         while not self.close_req_flag:
             try:
-                data = self.gadget.recv(128)
-                if data[0] == 0x80:
-                    if data[1] == 0x01:
-                        _logger.info(f">>> Requested MAC addr")
-                        self.send_hid(0x81, data[1], bytes.fromhex("0003" + self.mac_addr))
-                    elif data[1] == 0x02:
-                        _logger.info(f">>> Handshake")
-                        self.send_hid(0x81, data[1], [])
-                    elif data[1] == 0x03:
-                        _logger.info(f">>> baudrate setting {data[2:].hex()}")
-                    elif data[1] == 0x04:
-                        _logger.info(f">>> Enable USB HID Joystick report")
-                        self.input_looping = True
-                        threading.Thread(target=self.send_input_loop, daemon=True).start()
-                    elif data[1] == 0x05:
-                        _logger.info(f">>> Disable USB HID Joystick report")
-                        self.input_looping = False
-                        self.reset_magic_packet()
-                    else:
-                        _logger.info(f">>> {data.hex()}")
-                elif data[0] == 0x01 and len(data) > 16:  # UARTで届いた
-                    subcmd = data[10]
-                    self.uart_interact(subcmd, data[11:])
-                elif data[0] == 0x10 and len(data) == 10:
-                    pass
-                else:
-                    _logger.info(f">>> {data.hex()}")
+                # 受信できるまで待機する (空回りしない)
+                if not self.gadget.wait_readable(0.1):
+                    continue
+                self.handle_packet(self.gadget.recv(128))
             except BlockingIOError as e:
                 # print("except5:", e)
                 pass
             # except Exception as e:
             #     print("except2:", e)
-            #     os._exit(1)
+
+    def handle_packet(self, data: bytes):
+        """
+        ホストから受信したパケットを1つ処理する
+        """
+        if data[0] == 0x80:
+            if data[1] == 0x01:
+                self.events.emit(EV_MAC_ADDR)
+                self.send_hid(0x81, data[1], bytes.fromhex("0003" + self.mac_addr))
+            elif data[1] == 0x02:
+                self.events.emit(EV_HANDSHAKE)
+                self.send_hid(0x81, data[1], [])
+            elif data[1] == 0x03:
+                self.events.emit(EV_BAUDRATE, 0, data[2:])
+            elif data[1] == 0x04:
+                self.events.emit(EV_REPORT_ON)
+                self.start_input_reports()
+            elif data[1] == 0x05:
+                self.events.emit(EV_REPORT_OFF)
+                self.stop_input_reports()
+                self.reset_magic_packet()
+            else:
+                self.events.emit(EV_UNKNOWN, 0, data)
+        elif data[0] == 0x01 and len(data) > 16:  # UARTで届いた
+            subcmd = data[10]
+            with PROFILER.span("uart", "protocol", subcmd=subcmd):
+                self.uart_interact(subcmd, data[11:])
+        elif data[0] == 0x10 and len(data) == 10:
+            pass
+        else:
+            self.events.emit(EV_UNKNOWN, 0, data)
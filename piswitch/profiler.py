@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+処理時間の計測 (Chrome trace-event 形式)
+
+ボタン操作・UART応答・入力レポートの送信・キャプチャ・OCRなどの区間(span)を
+スレッドごとのリングバッファに記録し、Chrome trace-event のJSONとして書き出す。
+chrome://tracing や Perfetto で開くと、入力・送信・フレーム取得・画像認識が
+1つのタイムラインに並ぶ。
+
+無効の間(初期状態)は span() が何もしないオブジェクトを返すだけなので、
+計測箇所を残したままでも負荷はほとんどない。
+
+    from piswitch.profiler import PROFILER
+    PROFILER.enable()
+    ...
+    PROFILER.export_chrome("trace.json")
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class _NullSpan:
+    """無効の時の区間 (何もしない)"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("ring", "name", "cat", "args", "start")
+
+    def __init__(self, ring, name, cat, args):
+        self.ring = ring
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.monotonic_ns()
+        self.ring.append(("X", self.name, self.cat, self.start // 1000, (end - self.start) // 1000, self.args))
+        return False
+
+
+class Profiler:
+    """
+    区間の記録
+    """
+
+    def __init__(self, maxlen=65536):
+        """
+        maxlen: スレッドごとのリングバッファの最大長 (溢れた場合は古いものから捨てる)
+        """
+        self.maxlen = maxlen
+        self.enabled = False
+        self._local = threading.local()
+        self._rings = []  # [(スレッドID, スレッド名, リングバッファ), ...]
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _ring(self) -> deque:
+        ring = getattr(self._local, "ring", None)
+        if ring is None:
+            ring = deque(maxlen=self.maxlen)
+            self._local.ring = ring
+            thread = threading.current_thread()
+            with self._lock:
+                self._rings.append((thread.native_id, thread.name, ring))
+        return ring
+
+    def span(self, name: str, cat="", **args):
+        """
+        区間を記録する (with文で使う)
+        name: 区間の名前
+        cat: 分類 ("input" | "protocol" | "capture" | "recognition" など)
+        args: 付加情報
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self._ring(), name, cat, args)
+
+    def instant(self, name: str, cat="", **args):
+        """瞬間のイベントを記録する (入力レポートの送信・フレームの到着など)"""
+        if self.enabled:
+            self._ring().append(("i", name, cat, time.monotonic_ns() // 1000, 0, args))
+
+    def clear(self):
+        """記録を破棄する"""
+        with self._lock:
+            for _, _, ring in self._rings:
+                ring.clear()
+
+    def events(self) -> list:
+        """記録を trace-event の形式で返す"""
+        pid = os.getpid()
+        result = []
+        with self._lock:
+            rings = list(self._rings)
+        for tid, thread_name, ring in rings:
+            result.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}})
+            for ph, name, cat, ts, dur, args in list(ring):
+                event = {"name": name, "cat": cat, "ph": ph, "ts": ts, "pid": pid, "tid": tid}
+                if ph == "X":
+                    event["dur"] = dur
+                else:
+                    event["s"] = "t"
+                if args:
+                    event["args"] = args
+                result.append(event)
+        return result
+
+    def export_chrome(self, path: str):
+        """記録を Chrome trace-event のJSONファイルに書き出す"""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, f)
+
+
+# 共通の計測器 (piswitchの各モジュールが記録する)
+PROFILER = Profiler()
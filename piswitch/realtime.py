@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+コントローラのスレッドのリアルタイム実行設定
+
+入力レポートの送信と受信のスレッドを指定したCPUコアに固定し、
+権限があれば SCHED_FIFO で実行する。
+送信中はPythonの循環GCの自動実行を止め、送信の合間に定期的に回収する
+(通常は世代0、何回かに1回は世代1まで、より長い間隔で全世代)。
+GCはプロセス全体で止まるため、他のスレッドで作られた循環参照もこの回収で解放される。
+送信タイミングの遅れ(ジッタ)を記録して、設定の効果を確認できるようにする。
+"""
+
+import gc
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+
+_logger = logging.getLogger(__name__)
+
+
+class RealtimeProfile:
+    """
+    リアルタイム実行の設定
+    """
+
+    def __init__(self, cpu=None, priority=50, gc_interval=5.0, gc_gen1_every=10, gc_full_interval=60.0):
+        """
+        cpu: 固定するCPUコアの番号 (None: 固定しない)
+        priority: SCHED_FIFOの優先度 (1~99, None: 変更しない)
+        gc_interval: 送信中に世代0のGCを行う間隔[s] (None: GCを止めない)
+        gc_gen1_every: 何回に1回、世代1までのGCにするか
+        gc_full_interval: 送信中に全世代のGCを行う間隔[s]
+        """
+        self.cpu = cpu
+        self.priority = priority
+        self.gc_interval = gc_interval
+        self.gc_gen1_every = gc_gen1_every
+        self.gc_full_interval = gc_full_interval
+        self.streaming = False
+        self._gc_was_enabled = True
+        self._last_collect = 0.0
+        self._last_full = 0.0
+        self._collections = 0
+
+    def apply_to_current_thread(self) -> bool:
+        """
+        呼び出したスレッドにCPUの固定とスケジューリングを設定する
+        Return: 全ての設定に成功した場合はTrue
+        """
+        ok = True
+        tid = threading.get_native_id()
+        if self.cpu is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(tid, {self.cpu})
+            except OSError as e:
+                _logger.warning(f"Could not pin thread to CPU {self.cpu}: {e}")
+                ok = False
+        if self.priority is not None and hasattr(os, "sched_setscheduler"):
+            try:
+                os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(self.priority))
+            except OSError as e:
+                # 権限がない場合は通常のスケジューリングのまま
+                _logger.warning(f"Could not set SCHED_FIFO: {e}")
+                ok = False
+        return ok
+
+    def start_streaming(self):
+        """入力レポートの送信を始める時に呼ぶ (GCを止める)"""
+        if self.gc_interval is None or self.streaming:
+            return
+        self.streaming = True
+        self._gc_was_enabled = gc.isenabled()
+        gc.collect()
+        # 起動時に作られたオブジェクトはGCの対象から外す
+        gc.freeze()
+        gc.disable()
+        self._last_collect = self._last_full = time.monotonic()
+        self._collections = 0
+
+    def stop_streaming(self):
+        """入力レポートの送信を終える時に呼ぶ (GCを元に戻す)"""
+        if not self.streaming:
+            return
+        self.streaming = False
+        gc.unfreeze()
+        if self._gc_was_enabled:
+            gc.enable()
+
+    def idle(self, now: float):
+        """
+        送信の合間に呼ぶ
+        gc_intervalごとに世代0 (gc_gen1_every回に1回は世代1まで) のGCを行い、
+        gc_full_intervalごとに全世代のGCを行う。1回の呼び出しで行うGCは1回だけにする。
+        now: 現在時刻 (time.monotonic())
+        """
+        if not self.streaming or now - self._last_collect < self.gc_interval:
+            return
+        if now - self._last_full >= self.gc_full_interval:
+            gc.collect()
+            self._last_full = now
+        else:
+            self._collections += 1
+            gc.collect(1 if self._collections % self.gc_gen1_every == 0 else 0)
+        self._last_collect = now
+
+
+class JitterStats:
+    """
+    送信タイミングの遅れの記録
+    直近のmaxlen回分を固定長のバッファに保持する。
+    """
+
+    def __init__(self, maxlen=4096):
+        self.maxlen = maxlen
+        self.count = 0
+        self._values = array("d", bytes(8 * maxlen))
+
+    def record(self, lateness: float):
+        """
+        予定時刻からの遅れを記録する
+        lateness: 遅れ[s]
+        """
+        self._values[self.count % self.maxlen] = lateness
+        self.count += 1
+
+    def summary(self) -> dict:
+        """
+        遅れの統計を返す
+        Return: {"count", "mean", "max", "p50", "p99"} (単位: ms)
+        """
+        n = min(self.count, self.maxlen)
+        if n == 0:
+            return {"count": 0}
+        values = sorted(self._values[:n])
+        return {
+            "count": self.count,
+            "mean": sum(values) / n * 1000,
+            "max": values[-1] * 1000,
+            "p50": values[n // 2] * 1000,
+            "p99": values[min(n - 1, math.ceil(n * 0.99) - 1)] * 1000,
+        }
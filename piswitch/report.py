@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+入力レポートの作成
+
+UARTのサブコマンド0x03(Set input report mode)で指定された形式ごとに、
+送信バッファを事前に確保した作成器を用意する。
+ProconBase は送信のたびに現在の作成器を1回だけ参照するため、
+形式の切り替えは送信と送信の間でまとめて反映される。
+
+USB Gadgetのレポート長は64bytesのため、0x31のNFC/IRのデータは
+64bytesに収まる範囲までしか送らない。
+"""
+
+# 入力レポートの形式
+MODE_STANDARD = 0x30  # 標準 (ボタン・スティック・6軸センサー)
+MODE_NFC_IR = 0x31  # 標準 + NFC/IRのデータ
+MODE_SIMPLE_HID = 0x3F  # 簡易HID (ボタン・HAT・スティック)
+
+REPORT_LENGTH = 64
+
+# 0x3Fのボタン: (control_dataの位置, ビット, 0x3Fの位置, ビット)
+_SIMPLE_HID_BUTTONS = [
+    (1, 2, 1, 0),  # B
+    (1, 3, 1, 1),  # A
+    (1, 0, 1, 2),  # Y
+    (1, 1, 1, 3),  # X
+    (3, 6, 1, 4),  # L
+    (1, 6, 1, 5),  # R
+    (3, 7, 1, 6),  # ZL
+    (1, 7, 1, 7),  # ZR
+    (2, 0, 2, 0),  # -
+    (2, 1, 2, 1),  # +
+    (2, 3, 2, 2),  # 左スティック押し込み
+    (2, 2, 2, 3),  # 右スティック押し込み
+    (2, 4, 2, 4),  # HOME
+    (2, 5, 2, 5),  # キャプチャ
+    (3, 5, 2, 6),  # SL (左)
+    (1, 5, 2, 6),  # SL (右)
+    (3, 4, 2, 7),  # SR (左)
+    (1, 4, 2, 7),  # SR (右)
+]
+
+# 十字キー (下, 上, 右, 左 のビット) からHATの値への変換 (8: 中立)
+_HAT = [8] * 16
+for _bits, _value in [(0b0010, 0), (0b0110, 1), (0b0100, 2), (0b0101, 3),
+                      (0b0001, 4), (0b1001, 5), (0b1000, 6), (0b1010, 7)]:
+    _HAT[_bits] = _value
+
+
+def _build_button_tables():
+    """control_dataの1byteから0x3Fのボタン2bytesへの変換表を作る"""
+    tables = {}
+    for src in (1, 2, 3):
+        table = []
+        for v in range(256):
+            b1 = b2 = 0
+            for s, s_bit, d, d_bit in _SIMPLE_HID_BUTTONS:
+                if s == src and v >> s_bit & 1:
+                    if d == 1:
+                        b1 |= 1 << d_bit
+                    else:
+                        b2 |= 1 << d_bit
+            table.append((b1, b2))
+        tables[src] = table
+    return tables
+
+
+_BUTTON_TABLES = _build_button_tables()
+
+
+class StandardReport:
+    """0x30: 標準の入力レポート"""
+
+    report_id = MODE_STANDARD
+
+    def __init__(self):
+        self.buf = bytearray(REPORT_LENGTH)
+        self.buf[0] = self.report_id
+
+    def encode(self, procon) -> bytearray:
+        buf = self.buf
+        buf[1] = procon.counter
+        buf[2:13] = procon.control_data
+        return buf
+
+
+class NfcIrReport(StandardReport):
+    """0x31: 標準 + NFC/IRのデータ (データなし)"""
+
+    report_id = MODE_NFC_IR
+
+    def __init__(self):
+        super().__init__()
+        self.buf[49] = 0xff  # NFC/IR MCU: データなし
+
+
+class SimpleHidReport:
+    """0x3F: 簡易HIDの入力レポート"""
+
+    report_id = MODE_SIMPLE_HID
+
+    def __init__(self):
+        self.buf = bytearray(REPORT_LENGTH)
+        self.buf[0] = self.report_id
+
+    def encode(self, procon) -> bytearray:
+        buf = self.buf
+        cd = procon.control_data
+        t1, t2, t3 = _BUTTON_TABLES[1][cd[1]], _BUTTON_TABLES[2][cd[2]], _BUTTON_TABLES[3][cd[3]]
+        buf[1] = t1[0] | t2[0] | t3[0]
+        buf[2] = t1[1] | t2[1] | t3[1]
+        buf[3] = _HAT[cd[3] & 0x0f]
+        # スティック: 12bitを16bitに広げる (Yは下が正)
+        for i, offset in enumerate((4, 7)):
+            x = cd[offset] | (cd[offset + 1] & 0x0f) << 8
+            y = 4095 - (cd[offset + 1] >> 4 | cd[offset + 2] << 4)
+            x = x << 4 | x >> 8
+            y = y << 4 | y >> 8
+            buf[4 + i * 4] = x & 0xff
+            buf[5 + i * 4] = x >> 8
+            buf[6 + i * 4] = y & 0xff
+            buf[7 + i * 4] = y >> 8
+        return buf
+
+
+def create_reports() -> dict:
+    """
+    入力レポートの形式ごとの作成器を作る
+    Return: {サブコマンド0x03の引数: 作成器}
+    """
+    standard = StandardReport()
+    nfc_ir = NfcIrReport()
+    return {
+        0x00: nfc_ir,  # NFC/IRのポーリング
+        0x01: nfc_ir,  # NFC/IRのポーリング (設定)
+        0x02: nfc_ir,  # NFC/IRのデータ
+        MODE_STANDARD: standard,
+        MODE_NFC_IR: nfc_ir,
+        MODE_SIMPLE_HID: SimpleHidReport(),
+    }
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+解像度に依存しないROIの登録
+
+ROIを画面の大きさに対する割合(0~1)で登録しておき、実際のフレームの大きさに合わせて
+画素の座標に変換する。ROIごとに必要な細かさ(1280x720に対する倍率)を指定すると、
+Capture はそれを満たす最も低い解像度・形式を選ぶ。
+テンプレートや DigitRecognizer は1280x720の画像で作っているため、低い解像度で
+切り出したROIは1280x720での大きさに拡大して返す。
+
+YUYVのフレームをそのまま(RGBに変換せずに)受け取った場合、グレースケールは
+輝度(Y)をROIの部分だけ取り出せばよいため、フレーム全体の変換が不要になる。
+
+    rois = RoiRegistry()
+    rois.add_pixels("money", 1111, 16, 120, 24, scale=1.0)  # 1280x720での座標
+    cap = Capture(rois=rois)
+    images = cap.read_rois()  # {"money": グレースケールの画像}
+"""
+
+import cv2
+import numpy as np
+
+# 座標の基準の大きさ (デモの座標は1280x720で決めている)
+BASE_SIZE = (1280, 720)
+# 基準と同じ縦横比とみなす誤差
+ASPECT_TOLERANCE = 0.01
+
+# 選べるキャプチャの解像度・形式 (w, h, fourcc)
+DEFAULT_MODES = [
+    (640, 360, "YUYV"),
+    (960, 540, "YUYV"),
+    (1280, 720, "YUYV"),
+    (1920, 1080, "MJPG"),
+]
+
+
+class Roi:
+    """画面の大きさに対する割合で表したROI"""
+
+    __slots__ = ("name", "x", "y", "w", "h", "scale")
+
+    def __init__(self, name: str, x: float, y: float, w: float, h: float, scale=1.0):
+        """
+        x, y, w, h: 画面の大きさに対する割合 (0~1)
+        scale: 必要な細かさ (1280x720に対する倍率。小さい文字のOCRは1.0、有無の判定は0.5など)
+        """
+        self.name = name
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.scale = scale
+
+    def pixels(self, size) -> tuple:
+        """
+        画素の座標に変換する
+        size: フレームの大きさ (w, h)
+        Return: (x, y, w, h)
+        """
+        fw, fh = size
+        x = int(round(self.x * fw))
+        y = int(round(self.y * fh))
+        w = max(1, min(int(round(self.w * fw)), fw - x))
+        h = max(1, min(int(round(self.h * fh)), fh - y))
+        return x, y, w, h
+
+
+class RoiRegistry:
+    """
+    ROIの登録
+    """
+
+    def __init__(self):
+        self.rois = {}
+
+    def add(self, name: str, x: float, y: float, w: float, h: float, scale=1.0) -> Roi:
+        """割合でROIを登録する"""
+        roi = Roi(name, x, y, w, h, scale)
+        self.rois[name] = roi
+        return roi
+
+    def add_pixels(self, name: str, x: int, y: int, w: int, h: int, scale=1.0, base_size=BASE_SIZE) -> Roi:
+        """
+        画素の座標でROIを登録する
+        base_size: 座標の基準の大きさ (w, h)
+        """
+        bw, bh = base_size
+        return self.add(name, x / bw, y / bh, w / bw, h / bh, scale)
+
+    def get(self, name: str) -> Roi:
+        return self.rois[name]
+
+    def pixels(self, name: str, size) -> tuple:
+        """ROIをフレームの大きさ (w, h) での画素の座標に変換する"""
+        return self.rois[name].pixels(size)
+
+    def required_scale(self, names=None) -> float:
+        """登録したROIに必要な細かさの最大"""
+        names = self.rois.keys() if names is None else names
+        return max((self.rois[n].scale for n in names), default=0.0)
+
+    def choose_mode(self, modes=None) -> tuple:
+        """
+        必要な細かさを満たす最も画素数の少ないキャプチャの解像度・形式を選ぶ
+        ROIは画面に対する割合のため、縦横比が基準と異なる形式 (4:3など) は
+        他に選べる形式がない場合だけ使う。
+        modes: 選べる (w, h, fourcc) のリスト (None: DEFAULT_MODES)
+        Return: (w, h, fourcc)
+        """
+        modes = DEFAULT_MODES if modes is None else modes
+        scale = self.required_scale()
+        aspect = BASE_SIZE[0] / BASE_SIZE[1]
+        same_aspect = [m for m in modes if abs(m[0] / m[1] - aspect) <= aspect * ASPECT_TOLERANCE]
+        candidates = same_aspect or modes
+        usable = [m for m in candidates if m[0] >= BASE_SIZE[0] * scale and m[1] >= BASE_SIZE[1] * scale]
+        if not usable:
+            return max(candidates, key=lambda m: m[0] * m[1])
+        return min(usable, key=lambda m: m[0] * m[1])
+
+    def extract(self, frame, names=None, gray=True, yuyv=False, out=None, base_size=BASE_SIZE) -> dict:
+        """
+        登録したROIだけを切り出す (フレーム全体は変換しない)
+        frame: BGRのフレーム (h, w, 3) | YUYVのフレーム (h, w, 2)
+        names: 切り出すROIの名前 (None: 全て)
+        gray: グレースケールにする
+        yuyv: frameがYUYVのフレームかどうか
+        out: 書き込み先の {名前: 画像} (None: 毎回新しい画像を返す)
+             同じ辞書を渡すと画像を使い回すため、前回返した画像は上書きされる。
+        base_size: 切り出した画像をこの大きさ (w, h) のフレームでのROIの大きさにする
+                   (None: frameの解像度のまま)
+        Return: {名前: 画像}
+        """
+        size = (frame.shape[1], frame.shape[0])
+        names = self.rois.keys() if names is None else names
+        result = {}
+        for name in names:
+            roi = self.rois[name]
+            x, y, w, h = roi.pixels(size)
+            if yuyv:
+                if gray:
+                    # 輝度(Y)がそのままグレースケール
+                    crop = frame[y:y + h, x:x + w, 0]
+                else:
+                    # YUYVは2画素で色を共有するため、偶数の位置・幅に広げてから変換する
+                    x0 = x & ~1
+                    x1 = min((x + w + 1) & ~1, size[0])
+                    bgr = cv2.cvtColor(np.ascontiguousarray(frame[y:y + h, x0:x1]), cv2.COLOR_YUV2BGR_YUYV)
+                    crop = bgr[:, x - x0:x - x0 + w]
+            else:
+                crop = frame[y:y + h, x:x + w]
+                if gray:
+                    crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            if base_size is not None and tuple(base_size) != size:
+                _, _, bw, bh = roi.pixels(base_size)
+                if (bw, bh) != (w, h):
+                    # 基準の解像度で作ったテンプレートと同じ大きさにする
+                    crop = cv2.resize(crop, (bw, bh), interpolation=cv2.INTER_LINEAR if bw > w else cv2.INTER_AREA)
+            result[name] = _store(out, name, crop)
+        return result
+
+
+def _store(out, name: str, src):
+    """
+    切り出した画像を返す画像にする
+    out: 使い回す {名前: 画像} | None (新しい配列にコピーする)
+    """
+    if out is None:
+        return src.copy() if src.base is not None else src
+    buf = out.get(name)
+    if buf is None or buf.shape != src.shape or buf.dtype != src.dtype:
+        buf = np.empty(src.shape, src.dtype)
+        out[name] = buf
+    np.copyto(buf, src)
+    return buf
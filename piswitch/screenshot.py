@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+スクリーンショットのエンコード
+
+キャプチャしたフレームを受け取り、縮小とJPEGなどへのエンコードを
+ワーカースレッドで行って、バイト列のまま利用者(通知・保存など)に渡す。
+SDカードへの書き込みと読み直しを挟まない。
+"""
+
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+
+class ScreenshotEncoder:
+    """
+    スクリーンショットのエンコーダ
+    """
+
+    def __init__(self, scale=0.5, quality=85, ext=".jpg", maxsize=4):
+        """
+        scale: 縮小率
+        quality: JPEGの画質 (0~100)
+        ext: エンコードする形式 (".jpg" | ".png" | ".webp")
+        maxsize: エンコード待ちのフレームの最大数 (溢れた場合は捨てる)
+        """
+        self.scale = scale
+        self.quality = quality
+        self.ext = ext
+        self.consumers = []
+        self._resized = None
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+
+    def add_consumer(self, consumer):
+        """
+        エンコードした画像を受け取る関数を追加する
+        consumer: consumer(data: bytes) の形の関数
+        """
+        self.consumers.append(consumer)
+
+    def encode(self, frame) -> bytes:
+        """
+        フレームを縮小してエンコードする (呼び出したスレッドで実行)
+        frame: フレーム
+        Return: エンコードした画像
+        """
+        if self.scale != 1.0:
+            h, w = frame.shape[:2]
+            size = (int(w * self.scale), int(h * self.scale))
+            # 縮小先のバッファは使い回す
+            shape = (size[1], size[0]) + frame.shape[2:]
+            if self._resized is None or self._resized.shape != shape or self._resized.dtype != frame.dtype:
+                self._resized = np.empty(shape, frame.dtype)
+            cv2.resize(frame, size, dst=self._resized, interpolation=cv2.INTER_AREA)
+            frame = self._resized
+
+        params = []
+        if self.ext in (".jpg", ".jpeg"):
+            params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        elif self.ext == ".webp":
+            params = [int(cv2.IMWRITE_WEBP_QUALITY), self.quality]
+        ret, buf = cv2.imencode(self.ext, frame, params)
+        if not ret:
+            raise ValueError(f"Could not encode frame as {self.ext}")
+        return buf.tobytes()
+
+    def submit(self, frame, *consumers) -> bool:
+        """
+        フレームのエンコードを依頼する
+        frame: フレーム (エンコードが終わるまで書き換えないこと)
+        consumers: この画像だけを受け取る関数
+        Return: 受け付けた場合はTrue
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._encode_loop, daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait((frame, consumers))
+            return True
+        except queue.Full:
+            _logger.warning("Screenshot dropped")
+            return False
+
+    def close(self):
+        """残ったフレームをエンコードしてから停止する"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _encode_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            frame, consumers = item
+            try:
+                data = self.encode(frame)
+            except Exception:
+                _logger.exception("Failed to encode screenshot")
+                continue
+            for consumer in self.consumers + list(consumers):
+                try:
+                    consumer(data)
+                except Exception:
+                    _logger.exception("Screenshot consumer error")
+
+
+def archive_consumer(dir_path: str, prefix="ss", ext=".jpg"):
+    """
+    エンコードした画像をディレクトリに保存する関数を返す
+    dir_path: 保存先のディレクトリ
+    """
+    os.makedirs(dir_path, exist_ok=True)
+
+    def save(data: bytes):
+        path = os.path.join(dir_path, f"{prefix}_{datetime.now():%Y%m%d_%H%M%S_%f}{ext}")
+        with open(path, "wb") as f:
+            f.write(data)
+
+    return save
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+画面全体からのテンプレートの探索
+
+決め打ちの座標ではなく、画面のどこに表示されていてもテンプレートを見つける。
+フレームごとに縮小画像のピラミッドを作り、最も粗い段で
+cv2.matchTemplate を使って候補を探してから、細かい段では候補の周辺だけを照合する。
+テンプレートのピラミッドはテンプレートごとにキャッシュする。
+同じフレームで複数のテンプレートを探す場合は、frame_id (フレームの番号など) を渡すと
+フレームのピラミッドを使い回す。
+
+    searcher = TemplateSearcher()
+    match = searcher.find(gray, templates.get("egg"), min_score=0.9)
+    if match is not None:
+        print(match.x, match.y, match.score)
+"""
+
+import math
+import time
+
+import cv2
+import numpy as np
+
+
+class Match:
+    """見つかった位置 (フレームの座標)"""
+
+    __slots__ = ("x", "y", "w", "h", "score")
+
+    def __init__(self, x: int, y: int, w: int, h: int, score: float):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.score = score
+
+    @property
+    def roi(self):
+        return (self.x, self.y, self.w, self.h)
+
+    def __repr__(self):
+        return f"Match(x={self.x}, y={self.y}, w={self.w}, h={self.h}, score={self.score:.3f})"
+
+
+def build_pyramid(gray, levels: int) -> list:
+    """縮小画像のピラミッドを作る ([0]: 元の大きさ)"""
+    pyramid = [gray]
+    for _ in range(levels - 1):
+        h, w = pyramid[-1].shape[:2]
+        if min(h, w) < 2:
+            break
+        pyramid.append(cv2.resize(pyramid[-1], (w // 2, h // 2), interpolation=cv2.INTER_AREA))
+    return pyramid
+
+
+def _scale_bounds(bounds, level: int) -> tuple:
+    """
+    範囲 (x0, y0, x1, y1) をピラミッドの段の座標にする
+    始点は切り捨て、終点は切り上げて、縮小で範囲が狭まらないようにする
+    """
+    scale = 2 ** level
+    x0, y0, x1, y1 = bounds
+    return x0 // scale, y0 // scale, math.ceil(x1 / scale), math.ceil(y1 / scale)
+
+
+class TemplateSearcher:
+    """
+    粗い段から細かい段へのテンプレートの探索
+    """
+
+    def __init__(self, levels=3, min_template_size=8, coarse_margin=0.15, refine_radius=2):
+        """
+        levels: ピラミッドの段数
+        min_template_size: 最も粗い段でのテンプレートの最小の辺の長さ (これより小さくなる段は使わない)
+        coarse_margin: 粗い段で候補とする一致率の余裕 (min_score - coarse_margin 以上を候補にする)
+        refine_radius: 細かい段で候補の周りを探す範囲[px]
+        """
+        self.levels = levels
+        self.min_template_size = min_template_size
+        self.coarse_margin = coarse_margin
+        self.refine_radius = refine_radius
+        self._frame_id = None
+        self._frame_pyramid = None
+        self._templates = {}  # {(名前, ROI, 閾値): (更新日時, ピラミッド)}
+
+    def frame_pyramid(self, gray, frame_id=None) -> list:
+        """
+        フレームのピラミッド
+        frame_id: フレームを識別する値 (前回と同じなら作り直さない。None: 毎回作る)
+                  フレームのバッファは使い回されることがあるため、配列そのものでは判定しない
+        """
+        if frame_id is None or frame_id != self._frame_id or self._frame_pyramid is None:
+            self._frame_pyramid = build_pyramid(gray, self.levels)
+            self._frame_id = frame_id
+        return self._frame_pyramid
+
+    def template_pyramid(self, template) -> list:
+        """テンプレートのピラミッド (テンプレートが更新されるまでキャッシュする)"""
+        key = (template.name, tuple(template.roi) if template.roi is not None else None, template.threshold)
+        cached = self._templates.get(key)
+        if cached is None or cached[0] != template.mtime:
+            cached = (template.mtime, build_pyramid(template.gray, self.levels))
+            self._templates[key] = cached
+        return cached[1]
+
+    def find(self, gray, template, min_score=0.9, area=None, budget=None, frame_id=None):
+        """
+        最も一致する位置を探す
+        gray: グレースケールのフレーム
+        template: piswitch.template.Template
+        min_score: 一致とみなす一致率 (cv2.TM_CCOEFF_NORMED)
+        area: 探す範囲 (x, y, w, h) | None (フレーム全体)
+        budget: 探索に使う最大時間[s] (None: 無制限。超えた場合はそれまでの最良の結果を返す)
+        frame_id: フレームを識別する値 (frame_pyramid() を参照)
+        Return: Match | None
+        """
+        matches = self.find_all(gray, template, min_score, area, max_results=1, budget=budget, frame_id=frame_id)
+        return matches[0] if matches else None
+
+    def find_all(self, gray, template, min_score=0.9, area=None, max_results=5, budget=None, frame_id=None) -> list:
+        """
+        一致する位置を一致率の高い順に探す
+        max_results: 最大の数
+        Return: [Match, ...]
+        """
+        deadline = None if budget is None else time.monotonic() + budget
+        frame_pyr = self.frame_pyramid(gray, frame_id)
+        tmpl_pyr = self.template_pyramid(template)
+        th, tw = template.gray.shape[:2]
+        ax, ay, aw, ah = area if area is not None else (0, 0, gray.shape[1], gray.shape[0])
+
+        # テンプレートが小さくなりすぎない最も粗い段
+        top = 0
+        for level in range(1, min(len(frame_pyr), len(tmpl_pyr))):
+            if min(tmpl_pyr[level].shape[:2]) < self.min_template_size:
+                break
+            top = level
+
+        area = (ax, ay, ax + aw, ay + ah)
+        candidates = self._coarse_candidates(frame_pyr[top], tmpl_pyr[top], _scale_bounds(area, top),
+                                             min_score - self.coarse_margin, max_results * 2)
+
+        results = []
+        for score, x, y in candidates:
+            if deadline is not None and time.monotonic() > deadline and results:
+                break
+            for level in range(top - 1, -1, -1):
+                score, x, y = self._refine(frame_pyr[level], tmpl_pyr[level], x * 2, y * 2,
+                                           _scale_bounds(area, level))
+            if score >= min_score and not any(abs(m.x - x) < tw // 2 and abs(m.y - y) < th // 2 for m in results):
+                results.append(Match(x, y, tw, th, score))
+        results.sort(key=lambda m: m.score, reverse=True)
+        return results[:max_results]
+
+    def _coarse_candidates(self, image, tmpl, bounds, threshold: float, count: int) -> list:
+        """
+        粗い段で一致率の高い位置を重ならないように選ぶ
+        bounds: この段での探す範囲 (x0, y0, x1, y1)
+        """
+        ax, ay, ax1, ay1 = bounds
+        region = image[ay:ay1, ax:ax1]
+        th, tw = tmpl.shape[:2]
+        if region.shape[0] < th or region.shape[1] < tw:
+            return []
+        result = cv2.matchTemplate(region, tmpl, cv2.TM_CCOEFF_NORMED)
+        candidates = []
+        for _ in range(count):
+            _, score, _, (x, y) = cv2.minMaxLoc(result)
+            if score < threshold:
+                break
+            candidates.append((score, ax + x, ay + y))
+            # 選んだ位置の周りは候補から外す
+            result[max(0, y - th // 2):y + th // 2 + 1, max(0, x - tw // 2):x + tw // 2 + 1] = -1.0
+        return candidates
+
+    def _refine(self, image, tmpl, x: int, y: int, bounds):
+        """
+        細かい段で候補の周りだけを照合する
+        bounds: この段での探す範囲 (x0, y0, x1, y1)。この外にはみ出す位置は選ばない
+        """
+        r = self.refine_radius
+        th, tw = tmpl.shape[:2]
+        bx0, by0, bx1, by1 = bounds
+        bx1 = min(bx1, image.shape[1])
+        by1 = min(by1, image.shape[0])
+        x0 = min(max(x - r, bx0), max(bx1 - tw, bx0))
+        y0 = min(max(y - r, by0), max(by1 - th, by0))
+        patch = image[y0:min(y0 + th + 2 * r, by1), x0:min(x0 + tw + 2 * r, bx1)]
+        if patch.shape[0] < th or patch.shape[1] < tw:
+            return -1.0, x, y
+        result = cv2.matchTemplate(patch, tmpl, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (dx, dy) = cv2.minMaxLoc(result)
+        return float(np.float32(score)), x0 + dx, y0 + dy
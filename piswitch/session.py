@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+セッションの記録と画像認識の回帰テスト
+
+SessionRecorder は、キャプチャしたフレームとコントローラの入力の変化を
+同じ時計の時刻付きで記録する。前回保存したフレームと内容が完全に同じ
+フレームは保存せず、タイムラインから前回のフレームを参照する。
+フレームのエンコードと書き込みはワーカースレッドで行う。
+
+認識結果の正解(ラベル)を annotate() で付けておくと、run_regression() で
+複数のセッションのフレームを認識関数にプロセスプールで並列に与え、
+正解率とフレームごとの処理時間を集計できる。
+
+    python -m piswitch.session ラベル=モジュール:関数 ... セッションのディレクトリ ...
+
+ディレクトリの構成:
+    timeline.jsonl: {"t", "frame"} | {"t", "control"} | {"t", "frame", "label", "value"} の各行
+                    (書き込みに失敗したフレームを参照する行には "missing": true が付く)
+    frames/000000.png ...: 保存したフレーム
+"""
+
+import bisect
+import hashlib
+import importlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from .clock import Clock
+
+_logger = logging.getLogger(__name__)
+
+TIMELINE = "timeline.jsonl"
+FRAMES_DIR = "frames"
+
+
+class SessionRecorder:
+    """
+    フレームと入力のタイムラインの記録
+    ProconBase.add_tick_hook() で登録すると、入力の変化を記録する。
+    """
+
+    def __init__(self, dir_path: str, detector=None, ext=".png", clock=None, maxsize=16):
+        """
+        dir_path: 保存先のディレクトリ
+        detector: 同じフレームかどうかの判定 (None: 内容が完全に一致する場合のみ同じとみなす)
+                  ChangeDetector などを渡すと小さな変化は同じとみなすため、
+                  小さなROIの認識を回帰テストする場合は使わないこと
+        ext: フレームの形式 (".png": 可逆 | ".jpg")
+        clock: 時計 (None: 実時間。Procon と同じ時計を使う)
+        maxsize: 書き込み待ちのフレームの最大数 (溢れた場合はフレームを捨てる)
+        """
+        self.dir_path = dir_path
+        self.detector = detector
+        self.ext = ext
+        self.clock = clock if clock is not None else Clock()
+        self.frame_count = 0  # 保存したフレームの数
+        self.dropped = 0
+        self._last_id = None
+        self._last_signature = None
+        self._last_control = None
+        self._failed = set()  # 書き込みに失敗したフレームの番号 (書き込みのスレッドが追加する)
+        self._queue = queue.Queue()
+        self._frame_slots = threading.Semaphore(maxsize)
+        os.makedirs(os.path.join(dir_path, FRAMES_DIR), exist_ok=True)
+        self._file = open(os.path.join(dir_path, TIMELINE), "a")
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def add_frame(self, frame, t=None):
+        """
+        フレームを記録する
+        frame: フレーム (書き込みが終わるまで書き換えないこと)
+        t: 時刻[s] (None: 現在時刻)
+        Return: タイムラインで参照するフレームの番号 | None (捨てた場合)
+        """
+        if t is None:
+            t = self.clock.monotonic()
+        signature = self._signature(frame)
+        if (self._last_id is not None and self._last_id not in self._failed
+                and not self._differs(self._last_signature, signature)):
+            self._put({"t": t, "frame": self._last_id})
+            return self._last_id
+
+        if not self._frame_slots.acquire(blocking=False):
+            self.dropped += 1
+            _logger.warning("Session frame dropped")
+            return None
+        frame_id = self.frame_count
+        self._put({"t": t, "frame": frame_id}, frame)
+        self.frame_count += 1
+        self._last_id = frame_id
+        self._last_signature = signature
+        return frame_id
+
+    def _signature(self, frame):
+        if self.detector is not None:
+            return self.detector.signature(frame)
+        return frame.shape, hashlib.blake2b(frame.tobytes(), digest_size=16).digest()
+
+    def _differs(self, sig1, sig2) -> bool:
+        if self.detector is not None:
+            return self.detector.differs(sig1, sig2)
+        return sig1 != sig2
+
+    def annotate(self, label: str, value, frame_id=None):
+        """
+        フレームに認識結果の正解を付ける
+        label: ラベル名 (認識関数に対応させる名前)
+        value: 正解の値 (JSONにできる値)
+        frame_id: フレームの番号 (None: 最後に記録したフレーム)
+        """
+        if frame_id is None:
+            frame_id = self._last_id
+        self._put({"t": self.clock.monotonic(), "frame": frame_id, "label": label, "value": value})
+
+    def __call__(self, procon):
+        """入力の変化を記録する (入力レポートの送信スレッドから呼ばれる)"""
+        control = procon.control_data[1:10]
+        if control != self._last_control:
+            self._last_control = bytes(control)
+            self._put({"t": self.clock.monotonic(), "control": control.hex()})
+
+    def close(self):
+        """残りを書き込んでから停止する"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._file.close()
+
+    def _put(self, entry: dict, frame=None):
+        # タイムラインは捨てず、呼び出したスレッドも止めない
+        self._queue.put_nowait((entry, frame))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            entry, frame = item
+            if frame is not None:
+                path = os.path.join(self.dir_path, FRAMES_DIR, f"{entry['frame']:06d}{self.ext}")
+                try:
+                    if not cv2.imwrite(path, frame):
+                        raise OSError(f"cv2.imwrite failed: {path}")
+                except Exception:
+                    _logger.exception("Failed to write session frame")
+                    self._failed.add(entry["frame"])
+                finally:
+                    self._frame_slots.release()
+            if entry.get("frame") in self._failed:
+                # 後の行も同じ番号を参照するため、行は残して欠けていることを記録する
+                entry["missing"] = True
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+
+class Session:
+    """記録したセッションの読み込み"""
+
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+        self.frames = []  # [(時刻, フレームの番号), ...]
+        self.controls = []  # [(時刻, control_data[1:10]), ...]
+        self.labels = []  # [(フレームの番号, ラベル名, 正解), ...]
+        self.missing = set()  # 書き込みに失敗したフレームの番号
+        with open(os.path.join(dir_path, TIMELINE)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # 書き込み途中の行
+                if entry.get("missing"):
+                    self.missing.add(entry["frame"])
+                    continue
+                if "label" in entry:
+                    self.labels.append((entry["frame"], entry["label"], entry["value"]))
+                elif "control" in entry:
+                    self.controls.append((entry["t"], bytes.fromhex(entry["control"])))
+                else:
+                    self.frames.append((entry["t"], entry["frame"]))
+        self._control_times = [t for t, _ in self.controls]
+
+    def frame_path(self, frame_id: int) -> str:
+        """フレームのファイルのパス"""
+        for ext in (".png", ".jpg"):
+            path = os.path.join(self.dir_path, FRAMES_DIR, f"{frame_id:06d}{ext}")
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"Frame {frame_id} not found in {self.dir_path}")
+
+    def load_frame(self, frame_id: int):
+        """フレームを読み込む"""
+        return cv2.imread(self.frame_path(frame_id))
+
+    def control_at(self, t: float):
+        """時刻tの入力 (control_data[1:10]) | None (記録前)"""
+        i = bisect.bisect_right(self._control_times, t)
+        return self.controls[i - 1][1] if i > 0 else None
+
+
+def _evaluate(func, path: str):
+    """ワーカープロセスで実行される認識処理"""
+    frame = cv2.imread(path)
+    start = time.perf_counter()
+    actual = func(frame)
+    return actual, time.perf_counter() - start
+
+
+def run_regression(session_dirs, recognizers: dict, max_workers=None) -> dict:
+    """
+    記録したセッションで画像認識の回帰テストを行う
+    session_dirs: セッションのディレクトリのリスト
+    recognizers: {ラベル名: 認識関数} (フレームを受け取り結果を返す、モジュールの関数)
+    max_workers: プロセス数 (None: CPUの数)
+    Return: {ラベル名: {"total", "correct", "accuracy", "mean_ms", "max_ms", "failures"}}
+        failures: [(ディレクトリ, フレームの番号, 正解, 結果), ...]
+    """
+    tasks = []
+    for dir_path in session_dirs:
+        session = Session(dir_path)
+        for frame_id, label, expected in session.labels:
+            if frame_id in session.missing:
+                _logger.warning(f"{dir_path}: frame {frame_id} is missing ('{label}' skipped)")
+            elif label in recognizers and frame_id is not None:
+                tasks.append((label, dir_path, frame_id, session.frame_path(frame_id), expected))
+
+    report = {label: {"total": 0, "correct": 0, "failures": [], "_times": []} for label in recognizers}
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(_evaluate, recognizers[label], path)
+                   for label, _, _, path, _ in tasks]
+        for (label, dir_path, frame_id, _, expected), future in zip(tasks, futures):
+            r = report[label]
+            r["total"] += 1
+            try:
+                actual, elapsed = future.result()
+            except Exception as e:
+                actual, elapsed = f"{type(e).__name__}: {e}", None
+            if elapsed is not None:
+                r["_times"].append(elapsed)
+            if actual == expected:
+                r["correct"] += 1
+            else:
+                r["failures"].append((dir_path, frame_id, expected, actual))
+
+    for r in report.values():
+        times = r.pop("_times")
+        r["accuracy"] = r["correct"] / r["total"] if r["total"] else None
+        r["mean_ms"] = sum(times) / len(times) * 1000 if times else None
+        r["max_ms"] = max(times) * 1000 if times else None
+    return report
+
+
+if __name__ == "__main__":
+    # 使い方: python -m piswitch.session ラベル=モジュール:関数 ... セッションのディレクトリ ...
+    recognizers = {}
+    dirs = []
+    for arg in sys.argv[1:]:
+        if "=" in arg:
+            label, target = arg.split("=", 1)
+            module_name, func_name = target.split(":")
+            recognizers[label] = getattr(importlib.import_module(module_name), func_name)
+        else:
+            dirs.append(arg)
+    if not recognizers or not dirs:
+        print("usage: python -m piswitch.session LABEL=MODULE:FUNC ... SESSION_DIR ...")
+        sys.exit(1)
+    for label, r in run_regression(dirs, recognizers).items():
+        print(f"{label}: {r['correct']}/{r['total']} accuracy={r['accuracy']} "
+              f"mean={r['mean_ms']}ms max={r['max_ms']}ms")
+        for dir_path, frame_id, expected, actual in r["failures"]:
+            print(f"  {dir_path} #{frame_id}: expected={expected!r} actual={actual!r}")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+スティックの較正を考慮した値の変換
+
+Switchは、SPI ROMで通知された較正値(中心・上下の幅)とデッドゾーンを使って
+スティックの値を正規化する。この逆変換をすることで、
+正規化した位置(-1~1)を指定すると、ゲーム内で同じ位置になる12bitの値を求める。
+
+較正値の場所:
+    0x603D: 左スティックの工場出荷時の較正値 (9bytes: 上側の幅, 中心, 下側の幅)
+    0x6046: 右スティックの工場出荷時の較正値 (9bytes: 中心, 下側の幅, 上側の幅)
+    0x8010/0x801B: 左右のユーザー較正値 (先頭2bytesが b2 a1 の場合のみ有効)
+    0x6086/0x6098: 左右のスティックのパラメータ (デッドゾーン)
+
+デッドゾーンは中心からの距離で判定されるため、向きを保ったまま半径だけを外側に写す。
+較正値はSPI ROMの該当部分が変わった時だけ読み直す。
+スティックの値を設定する処理 (Procon.set_stick、マクロ、パススルー、ネットワーク経由の入力) は
+全てこの変換を通すため、どの方法で指定しても同じ位置はゲーム内で同じ値になる。
+"""
+
+import math
+
+# 変換表の分解能 (片側の段階数)
+STEPS = 1024
+
+_USER_MAGIC = b"\xb2\xa1"
+
+
+def pack_stick(x: int, y: int) -> bytes:
+    """(x, y) の12bitの値を control_data の3bytesにする"""
+    return bytes((x & 0xff, ((y << 4) & 0xf0) | ((x >> 8) & 0x0f), (y >> 4) & 0xff))
+
+
+def unpack_stick(data) -> tuple:
+    """control_data の3bytesを (x, y) の12bitの値にする"""
+    return ((data[1] << 8) & 0xf00) | data[0], (data[2] << 4) | (data[1] >> 4)
+
+
+def linear_position(value: int) -> float:
+    """較正を考慮しない線形な12bitの値 (0x800が中心) を正規化した位置 (-1~1) にする"""
+    return min(max((value - 2048) / 2047, -1.0), 1.0)
+
+
+def _decode_12bit_pairs(data) -> list:
+    """9bytesを (x, y) の12bitの値3組に分解する"""
+    values = []
+    for i in range(0, 9, 3):
+        values.append((((data[i + 1] << 8) & 0xf00) | data[i], (data[i + 2] << 4) | (data[i + 1] >> 4)))
+    return values
+
+
+class StickCalibration:
+    """
+    1本のスティックの較正値
+    center, above, below: (x, y) の中心と、中心から上側・下側への幅
+    deadzone: 中心からの距離がこれ未満の場合、Switchは0とみなす
+    """
+
+    def __init__(self, center=(2048, 2048), above=(2047, 2047), below=(2048, 2048), deadzone=0):
+        self.center = center
+        self.above = above
+        self.below = below
+        self.deadzone = deadzone
+
+    @classmethod
+    def from_spi(cls, spi_rom: dict, stick: str):
+        """
+        SPI ROMから較正値を読み込む
+        stick: "l" | "r"
+        """
+        rom60 = spi_rom[0x60]
+        rom80 = spi_rom.get(0x80, b"")
+        if stick == "l":
+            user = rom80[0x10:0x1b]
+            data = user[2:] if user[:2] == _USER_MAGIC else rom60[0x3d:0x46]
+            above, center, below = _decode_12bit_pairs(data)
+            params = rom60[0x86:0x98]
+        else:
+            user = rom80[0x1b:0x26]
+            data = user[2:] if user[:2] == _USER_MAGIC else rom60[0x46:0x4f]
+            center, below, above = _decode_12bit_pairs(data)
+            params = rom60[0x98:0xaa]
+        deadzone = ((params[4] << 8) & 0xf00) | params[3]
+        return cls(center, above, below, deadzone)
+
+    def offset(self, axis: int, v: float) -> float:
+        """
+        正規化した値を中心からの幅に変換する (較正の逆変換。デッドゾーンは考慮しない)
+        axis: 0 (x) | 1 (y)
+        v: -1.0~1.0
+        """
+        return v * (self.above[axis] if v >= 0 else self.below[axis])
+
+    def build_table(self, axis: int) -> list:
+        """
+        軸ごとの変換表を作る (デッドゾーンは考慮しない)
+        axis: 0 (x) | 1 (y)
+        Return: 正規化した値 (-1~1 を 0~2*STEPS に対応) から12bitの値への変換表
+        """
+        center = self.center[axis]
+        return [min(max(round(center + self.offset(axis, i / STEPS - 1.0)), 0), 4095) for i in range(2 * STEPS + 1)]
+
+    def encode(self, x: float, y: float) -> tuple:
+        """
+        正規化した位置を12bitの値に変換する
+        デッドゾーンは中心からの距離で判定されるため、向きを保ったまま半径だけを
+        [デッドゾーン, 最大] の範囲に写す (連続で単調な変換になる)。
+        x, y: -1.0~1.0 (右・上が正)
+        Return: (x, y) の12bitの値
+        """
+        r = math.hypot(x, y)
+        if r == 0:
+            return self.center
+        if r > 1.0:
+            x, y, r = x / r, y / r, 1.0
+        ox = self.offset(0, x)
+        oy = self.offset(1, y)
+        if self.deadzone > 0:
+            # この向きでの最大の半径から、デッドゾーンの外側に収まるように縮める
+            radius = math.hypot(ox, oy)
+            max_radius = radius / r
+            target = self.deadzone + r * (max_radius - self.deadzone)
+            ox *= target / radius
+            oy *= target / radius
+        return (min(max(round(self.center[0] + ox), 0), 4095),
+                min(max(round(self.center[1] + oy), 0), 4095))
+
+
+class StickEncoder:
+    """
+    正規化した位置からスティックの12bitの値への変換
+    """
+
+    def __init__(self, spi_rom: dict):
+        """
+        spi_rom: ProconBase.spi_rom (参照を保持し、変更を検出する)
+        """
+        self.spi_rom = spi_rom
+        self._source = None
+        self._calibrations = {}
+        self.refresh()
+
+    def _calibration_source(self) -> bytes:
+        rom60 = self.spi_rom[0x60]
+        rom80 = self.spi_rom.get(0x80, b"")
+        return bytes(rom60[0x3d:0x4f]) + bytes(rom60[0x86:0xaa]) + bytes(rom80[0x10:0x26])
+
+    def refresh(self) -> bool:
+        """
+        SPI ROMの較正値が変わっていれば読み直す
+        Return: 読み直した場合はTrue
+        """
+        source = self._calibration_source()
+        if source == self._source:
+            return False
+        self._source = source
+        for stick in ("l", "r"):
+            self._calibrations[stick] = StickCalibration.from_spi(self.spi_rom, stick)
+        return True
+
+    def encode(self, stick: str, x: float, y: float) -> tuple:
+        """
+        正規化した位置を12bitの値に変換する
+        stick: "l" | "r"
+        x, y: -1.0~1.0 (右・上が正)
+        Return: (x, y) の12bitの値
+        """
+        self.refresh()
+        return self._calibrations[stick].encode(x, y)
+
+    def encode_bytes(self, stick: str, x: float, y: float) -> bytes:
+        """正規化した位置を control_data の3bytesに変換する"""
+        return pack_stick(*self.encode(stick, x, y))
+
+    def neutral(self) -> bytes:
+        """左右のスティックが中央にある時の control_data[4:10]"""
+        return self.encode_bytes("l", 0.0, 0.0) + self.encode_bytes("r", 0.0, 0.0)
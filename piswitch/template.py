@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+テンプレート画像のキャッシュ
+
+画像認識で使うテンプレート画像を一度だけ読み込み、
+比較にそのまま使える形(グレースケール・二値化・ビットパック)で保持する。
+元ファイルの更新日時が変わった場合は自動で読み込み直す。
+前処理済みのテンプレートは1つのバンドルファイルにまとめて保存でき、
+起動時はバンドルから読み込むことでPNGのデコードを省略できる。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from . import bitimage
+
+_logger = logging.getLogger(__name__)
+
+
+class Template:
+    """前処理済みのテンプレート画像"""
+
+    def __init__(self, name: str, roi, threshold: int, gray, mtime=None, binary=None, packed=None):
+        self.name = name
+        self.roi = roi
+        self.threshold = threshold
+        self.gray = gray
+        if binary is None:
+            _, binary = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+        self.binary = binary
+        self.packed = bitimage.pack(binary) if packed is None else packed
+        self.mtime = mtime
+        self.checked_at = 0.0
+
+    @property
+    def shape(self):
+        return self.gray.shape
+
+    @property
+    def size(self):
+        return self.gray.size
+
+    def match(self, gray, threshold=None) -> float:
+        """
+        テンプレートと同じ大きさの画像との一致率を返す
+        gray: グレースケール画像
+        threshold: 画像の二値化の閾値 (None: テンプレートと同じ)
+        Return: 0.0~1.0
+        """
+        if threshold is None:
+            threshold = self.threshold
+        return bitimage.match_ratio(self.packed, bitimage.binarize_pack(gray, threshold), self.size)
+
+    def predicate(self, x: int, y: int, min_score=0.95):
+        """
+        フレームの(x, y)にテンプレートが表示されているかを判定する関数を返す
+        Procon.press_until() の条件として使う。
+        x, y: テンプレートの左上の位置
+        min_score: 一致とみなす一致率
+        """
+        h, w = self.shape
+        return lambda gray: self.match(gray[y:y + h, x:x + w]) > min_score
+
+
+class TemplateRegistry:
+    """
+    テンプレート画像のレジストリ
+    テンプレートは (名前, ROI, 二値化の閾値) をキーとしてキャッシュする。
+    """
+
+    def __init__(self, base_dir: str, reload_interval=1.0):
+        """
+        base_dir: テンプレート画像のディレクトリ
+        reload_interval: 更新日時を確認する間隔[s]
+        """
+        self.base_dir = base_dir
+        self.reload_interval = reload_interval
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def path(self, name: str) -> str:
+        """テンプレート名から画像ファイルのパスを返す"""
+        if not os.path.splitext(name)[1]:
+            name += ".png"
+        return os.path.join(self.base_dir, name)
+
+    def get(self, name: str, roi=None, threshold=127) -> Template:
+        """
+        テンプレートを取得する
+        name: テンプレート名 (img/egg.png なら "egg")
+        roi: 画像から切り出す領域 (x, y, w, h) | None
+        threshold: 二値化の閾値
+        Return: Template
+        """
+        key = (name, tuple(roi) if roi is not None else None, threshold)
+        tmpl = self._cache.get(key)
+        now = time.monotonic()
+        if tmpl is not None and now - tmpl.checked_at < self.reload_interval:
+            return tmpl
+
+        with self._lock:
+            tmpl = self._cache.get(key)
+            mtime = self._mtime(name)
+            if tmpl is None or (mtime is not None and mtime != tmpl.mtime):
+                if tmpl is not None:
+                    _logger.info(f"Reload template: {name}")
+                tmpl = self._load(name, key[1], threshold, mtime)
+                self._cache[key] = tmpl
+            tmpl.checked_at = now
+        return tmpl
+
+    def clear(self):
+        """キャッシュを破棄する"""
+        with self._lock:
+            self._cache.clear()
+
+    def _mtime(self, name: str):
+        try:
+            return os.stat(self.path(name)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self, name: str, roi, threshold: int, mtime) -> Template:
+        gray = cv2.imread(self.path(name), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise FileNotFoundError(f"Template not found: {self.path(name)}")
+        if roi is not None:
+            x, y, w, h = roi
+            gray = gray[y:y + h, x:x + w].copy()
+        return Template(name, roi, threshold, gray, mtime)
+
+    def save_bundle(self, path: str):
+        """
+        キャッシュ済みのテンプレートを1つのファイル(.npz)に保存する
+        path: 保存先のパス
+        """
+        with self._lock:
+            entries = list(self._cache.values())
+        meta = []
+        arrays = {}
+        for i, tmpl in enumerate(entries):
+            meta.append({"name": tmpl.name, "roi": tmpl.roi, "threshold": tmpl.threshold, "mtime": tmpl.mtime})
+            arrays[f"gray_{i}"] = tmpl.gray
+            arrays[f"binary_{i}"] = tmpl.binary
+            arrays[f"packed_{i}"] = tmpl.packed
+        arrays["meta"] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    def load_bundle(self, path: str) -> int:
+        """
+        save_bundle()で保存したテンプレートを読み込む
+        元ファイルが更新されている場合は、次回のget()で読み込み直される。
+        path: バンドルファイルのパス
+        Return: 読み込んだテンプレートの数
+        """
+        with np.load(path) as bundle:
+            meta = json.loads(bundle["meta"].tobytes().decode())
+            with self._lock:
+                for i, m in enumerate(meta):
+                    roi = tuple(m["roi"]) if m["roi"] is not None else None
+                    tmpl = Template(m["name"], roi, m["threshold"], bundle[f"gray_{i}"], m["mtime"],
+                                    binary=bundle[f"binary_{i}"], packed=bundle[f"packed_{i}"])
+                    self._cache[(m["name"], roi, m["threshold"])] = tmpl
+        return len(meta)
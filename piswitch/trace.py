@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+USB通信の記録と解析
+
+TracingGadget で送受信先を包むと、送受信した全てのパケットを時刻付きで記録する。
+記録は固定長のリングバッファに保持し、ファイルを指定した場合は
+バックグラウンドのスレッドで追記する (通信処理のスレッドでは書き込まない)。
+
+記録したファイルは、後からパケットの意味の解読、サブコマンドごとの
+応答時間の集計、ProconBase への再送(リプレイ)による再現に使う。
+
+    python -m piswitch.trace decode|latency|replay ファイル
+
+ファイルの形式: 先頭に MAGIC、続いて (時刻[s], 向き, データ長) + データ の繰り返し
+"""
+
+import logging
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+from .eventlog import UART_SUBCMD_NAMES
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = b"PSTR\x01"
+RECORD = struct.Struct("<dBH")
+
+# 向き
+DIR_IN = 0x00  # プロコン→ホスト (send)
+DIR_OUT = 0x01  # ホスト→プロコン (recv)
+
+_DIR_NAMES = {DIR_IN: "IN ", DIR_OUT: "OUT"}
+
+# 0x80の命令
+_USB_CMD_NAMES = {
+    0x01: "Request MAC addr",
+    0x02: "Handshake",
+    0x03: "Baudrate",
+    0x04: "Enable USB HID Joystick report",
+    0x05: "Disable USB HID Joystick report",
+}
+
+
+class TracingGadget:
+    """
+    送受信を記録する送受信先
+    送受信以外は包んだ送受信先にそのまま渡す。
+    """
+
+    def __init__(self, gadget, path=None, maxlen=65536, interval=0.1):
+        """
+        gadget: 包む送受信先 (ProconUsbGadget | FakeGadget)
+        path: 記録を追記するファイル (None: メモリ上のリングバッファのみ)
+        maxlen: リングバッファの最大長 (溢れた場合は古いものから捨てる)
+        interval: 書き出しの間隔[s]
+        """
+        self.gadget = gadget
+        self.path = path
+        self.interval = interval
+        self.ring = deque(maxlen=maxlen)
+        self._pending = deque(maxlen=maxlen)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __getattr__(self, name):
+        return getattr(self.gadget, name)
+
+    def _record(self, direction: int, data):
+        record = (time.monotonic(), direction, bytes(data))
+        self.ring.append(record)
+        if self.path is not None:
+            self._pending.append(record)
+
+    def open(self):
+        self.gadget.open()
+        if self.path is not None and self._thread is None:
+            with open(self.path, "ab") as f:
+                if f.tell() == 0:
+                    f.write(MAGIC)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self.gadget.close()
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def send(self, data):
+        self._record(DIR_IN, data)
+        return self.gadget.send(data)
+
+    def recv(self, max_len=128):
+        data = self.gadget.recv(max_len)
+        self._record(DIR_OUT, data)
+        return data
+
+    def flush(self):
+        """書き出し待ちの記録をファイルに追記する"""
+        records = []
+        while self._pending:
+            records.append(self._pending.popleft())
+        if records:
+            with open(self.path, "ab") as f:
+                f.write(b"".join(RECORD.pack(t, d, len(data)) + data for t, d, data in records))
+
+    def dump(self, path: str):
+        """リングバッファの内容をファイルに保存する"""
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(b"".join(RECORD.pack(t, d, len(data)) + data for t, d, data in list(self.ring)))
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+
+def read_trace(path: str) -> list:
+    """
+    記録を読み込む
+    Return: [(時刻[s], 向き, データ), ...]
+    """
+    with open(path, "rb") as f:
+        buf = f.read()
+    if not buf.startswith(MAGIC):
+        raise ValueError(f"Not a trace file: {path}")
+    records = []
+    pos = len(MAGIC)
+    while pos + RECORD.size <= len(buf):
+        t, direction, n = RECORD.unpack_from(buf, pos)
+        pos += RECORD.size
+        if pos + n > len(buf):
+            break  # 書き込み途中の記録
+        records.append((t, direction, buf[pos:pos + n]))
+        pos += n
+    return records
+
+
+def decode_packet(direction: int, data: bytes) -> str:
+    """パケットの意味を文字列にする"""
+    if not data:
+        return "(empty)"
+    report_id = data[0]
+    if direction == DIR_OUT:
+        if report_id == 0x80 and len(data) > 1:
+            return f"0x80 {_USB_CMD_NAMES.get(data[1], f'0x{data[1]:02x}')}"
+        if report_id == 0x01 and len(data) > 10:
+            subcmd = data[10]
+            name = UART_SUBCMD_NAMES.get(subcmd, f"0x{subcmd:02x}")
+            return f"0x01 UART {name}: {bytes(data[11:16]).hex()}"
+        if report_id == 0x10:
+            return "0x10 Rumble"
+    else:
+        if report_id == 0x81 and len(data) > 1:
+            return f"0x81 Reply {_USB_CMD_NAMES.get(data[1], f'0x{data[1]:02x}')}"
+        if report_id == 0x21 and len(data) > 14:
+            subcmd = data[14]
+            name = UART_SUBCMD_NAMES.get(subcmd, f"0x{subcmd:02x}")
+            return f"0x21 UART reply {name} (ack 0x{data[13]:02x})"
+        if report_id in (0x30, 0x31, 0x3f):
+            return f"0x{report_id:02x} Input report: {bytes(data[1:13]).hex()}"
+    return f"0x{report_id:02x} Unknown: {bytes(data[:16]).hex()}"
+
+
+def _request_key(direction: int, data: bytes):
+    """要求と応答を対応付けるキー (対応しないパケットはNone)"""
+    if direction == DIR_OUT:
+        if data[0] == 0x80 and len(data) > 1 and data[1] in (0x01, 0x02):
+            return ("usb", data[1])
+        if data[0] == 0x01 and len(data) > 10:
+            return ("uart", data[10])
+    else:
+        if data[0] == 0x81 and len(data) > 1:
+            return ("usb", data[1])
+        if data[0] == 0x21 and len(data) > 14:
+            return ("uart", data[14])
+    return None
+
+
+def _request_name(key) -> str:
+    if key[0] == "usb":
+        return f"0x80 {_USB_CMD_NAMES.get(key[1], f'0x{key[1]:02x}')}"
+    return f"UART {UART_SUBCMD_NAMES.get(key[1], f'0x{key[1]:02x}')}"
+
+
+def reply_latencies(records: list) -> dict:
+    """
+    要求から応答までの時間を集計する
+    Return: {要求の名前: [応答時間[s], ...]} (応答のない要求は None)
+    """
+    waiting = {}
+    result = {}
+    for t, direction, data in records:
+        key = _request_key(direction, data)
+        if key is None:
+            continue
+        name = _request_name(key)
+        if direction == DIR_OUT:
+            if key in waiting:
+                result.setdefault(name, []).append(None)  # 前の要求に応答がなかった
+            waiting[key] = t
+        elif key in waiting:
+            result.setdefault(name, []).append(t - waiting.pop(key))
+    for key in waiting:
+        result.setdefault(_request_name(key), []).append(None)
+    return result
+
+
+def replay(records: list, procon=None) -> list:
+    """
+    記録した受信パケットを ProconBase に同じ間隔で与え、応答を記録と比べる
+    procon: 再生先 (None: FakeGadget と VirtualClock を使った ProconBase)
+    Return: [(時刻[s], 要求の説明, 記録の応答, 再生の応答), ...] (一致しなかったもの)
+    """
+    from .clock import VirtualClock
+    from .fake_gadget import FakeGadget
+    from .procon_base import ProconBase
+
+    if procon is None:
+        clock = VirtualClock()
+        procon = ProconBase(gadget=FakeGadget(clock), clock=clock)
+    if not records:
+        return []
+
+    def replies(packets):
+        # 入力レポートは比べず、UART応答はカウンターと入力の部分を除いて比べる
+        result = []
+        for p in packets:
+            if p[0] == 0x81:
+                result.append(bytes(p))
+            elif p[0] == 0x21:
+                result.append(bytes(p[:1] + p[13:]))
+        return result
+
+    base = records[0][0]
+    mismatches = []
+    out = [(i, r) for i, r in enumerate(records) if r[1] == DIR_OUT]
+    for n, (i, (t, _, data)) in enumerate(out):
+        end = out[n + 1][0] if n + 1 < len(out) else len(records)
+        expected = replies([d for _, direction, d in records[i + 1:end] if direction == DIR_IN])
+
+        procon.clock.sleep(max(0.0, t - base - procon.clock.monotonic()))
+        sent_before = len(procon.gadget.sent)
+        procon.handle_packet(bytes(data))
+        actual = replies([bytes(d)[:64] for _, d in procon.gadget.sent[sent_before:]])
+        if actual != expected:
+            mismatches.append((t - base, decode_packet(DIR_OUT, data), expected, actual))
+    return mismatches
+
+
+if __name__ == "__main__":
+    # 使い方: python -m piswitch.trace decode|latency|replay ファイル
+    if len(sys.argv) != 3 or sys.argv[1] not in ("decode", "latency", "replay"):
+        print("usage: python -m piswitch.trace decode|latency|replay TRACE")
+        sys.exit(1)
+    records = read_trace(sys.argv[2])
+    if sys.argv[1] == "decode":
+        base = records[0][0] if records else 0.0
+        for t, direction, data in records:
+            print(f"{t - base:10.6f} {_DIR_NAMES[direction]} {decode_packet(direction, data)}")
+    elif sys.argv[1] == "latency":
+        for name, values in reply_latencies(records).items():
+            done = [v for v in values if v is not None]
+            missing = len(values) - len(done)
+            if done:
+                print(f"{name}: n={len(done)} mean={sum(done) / len(done) * 1000:.2f}ms "
+                      f"max={max(done) * 1000:.2f}ms missing={missing}")
+            else:
+                print(f"{name}: no reply ({missing})")
+    else:
+        mismatches = replay(records)
+        for t, request, expected, actual in mismatches:
+            print(f"{t:10.6f} {request}\n  trace : {expected}\n  replay: {actual}")
+        print(f"{len(mismatches)} mismatches")
@@ -7,12 +7,12 @@ Raspberry Pi 4B での動作を想定している。
 
 import logging
 import os
+import select
+import time
 
 from . import treecreater
 
 _logger = logging.getLogger(__name__)
-_logger.setLevel(logging.WARNING)
-_logger.addHandler(logging.StreamHandler())
 
 
 class UsbGadget:
@@ -68,6 +68,18 @@ class UsbGadget:
 
         return True
 
+    def wait_readable(self, timeout=None) -> bool:
+        """
+        受信できるデータが届くまで待機する
+        timeout: 待機する最大時間[s]
+        Return: 受信できる場合はTrue
+        """
+        if self.conn_sock_file is None:
+            time.sleep(timeout or 0)
+            return False
+        r, _, _ = select.select([self.conn_sock_file], [], [], timeout)
+        return bool(r)
+
     def recv(self, max_len=128):
         """
         データを受信する
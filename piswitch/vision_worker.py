@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+別プロセスでの画像認識
+
+キャプチャ・二値化・テンプレートマッチング・OCRを、コントローラのプロセスとは
+別のワーカープロセスで実行する。フレームは共有メモリのリングバッファで渡し、
+認識結果は値が変わった時だけパイプで送り返す。
+コントローラのプロセスは入力レポートの送受信だけに専念でき、
+画像処理の負荷でGILを取り合って送信タイミングが乱れることがなくなる。
+
+認識処理(タスク)は ctx を受け取って値を返す関数で、ワーカープロセスに渡すため
+pickleできること (モジュールの関数や、このモジュールの ChangeTask などのクラス)。
+ctx.frame はBGRのフレーム、ctx.gray はグレースケール (最初に参照した時に変換する)。
+"""
+
+import logging
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+
+class FrameRing:
+    """
+    共有メモリ上のフレームのリングバッファ
+    書き込みは1つのプロセスから行う。各スロットのシーケンス番号が奇数の間は書き込み中で、
+    読み込みの前後でシーケンス番号が変わっていなければ正しく読み込めている。
+    """
+
+    def __init__(self, shape=(720, 1280, 3), slots=4, name=None):
+        """
+        shape: フレームの形
+        slots: スロット数
+        name: 既存の共有メモリの名前 (None: 新しく作る)
+        """
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.owner = name is None
+        header_size = 8 * (1 + slots)
+        frame_size = int(np.prod(self.shape))
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner,
+                                              size=header_size + frame_size * slots if self.owner else 0)
+        # [最新のフレーム番号, スロットごとのシーケンス番号...]
+        self._header = np.ndarray((1 + slots,), np.int64, self.shm.buf, 0)
+        self._frames = np.ndarray((slots,) + self.shape, np.uint8, self.shm.buf, header_size)
+        if self.owner:
+            self._header[0] = -1
+            self._header[1:] = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def latest(self) -> int:
+        """最新のフレーム番号 (-1: まだない)"""
+        return int(self._header[0])
+
+    def write(self, frame) -> int:
+        """
+        フレームを書き込む
+        Return: フレーム番号
+        """
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match {self.shape}")
+        n = int(self._header[0]) + 1
+        slot = 1 + n % self.slots
+        self._header[slot] = 2 * n + 1
+        np.copyto(self._frames[slot - 1], frame)
+        self._header[slot] = 2 * n + 2
+        self._header[0] = n
+        return n
+
+    def read_latest(self, out=None):
+        """
+        最新のフレームをコピーして読み込む
+        out: コピー先 (None: 新しく確保する)
+        Return: (フレーム, フレーム番号) | (None, -1)
+        """
+        for _ in range(4):
+            n = int(self._header[0])
+            if n < 0:
+                break
+            slot = 1 + n % self.slots
+            seq = int(self._header[slot])
+            if seq != 2 * n + 2:
+                continue  # 書き込み中に次のフレームに追い越された
+            if out is None:
+                out = np.empty(self.shape, np.uint8)
+            np.copyto(out, self._frames[slot - 1])
+            if int(self._header[slot]) == seq:
+                return out, n
+        return None, -1
+
+    def close(self):
+        self._header = None
+        self._frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class FrameContext:
+    """タスクに渡すフレーム (グレースケールは1回だけ変換する)"""
+
+    def __init__(self, frame, number: int):
+        self.frame = frame
+        self.number = number
+        self._gray = None
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            import cv2
+            self._gray = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+
+class ChangeTask:
+    """ROIの変化の回数を返すタスク (変化するたびに結果が送られる)"""
+
+    def __init__(self, roi=None, tolerance=12):
+        self.roi = roi
+        self.tolerance = tolerance
+        self._detector = None
+        self._count = 0
+
+    def __call__(self, ctx):
+        if self._detector is None:
+            from .change_detect import ChangeDetector
+            self._detector = ChangeDetector(tolerance=self.tolerance)
+        if self._detector.changed(ctx.gray, self.roi):
+            self._count += 1
+        return self._count
+
+
+class TemplateTask:
+    """テンプレートが(x, y)に表示されているかどうかを返すタスク"""
+
+    def __init__(self, base_dir: str, name: str, x: int, y: int, roi=None, threshold=127, min_score=0.95):
+        self.base_dir = base_dir
+        self.name = name
+        self.x = x
+        self.y = y
+        self.roi = roi
+        self.threshold = threshold
+        self.min_score = min_score
+        self._registry = None
+
+    def __call__(self, ctx):
+        if self._registry is None:
+            from .template import TemplateRegistry
+            self._registry = TemplateRegistry(self.base_dir)
+        template = self._registry.get(self.name, self.roi, self.threshold)
+        h, w = template.shape
+        return template.match(ctx.gray[self.y:self.y + h, self.x:self.x + w]) > self.min_score
+
+
+class OcrTask:
+    """ROIをTesseractで認識した文字列を返すタスク (同じ画像は認識し直さない)"""
+
+    def __init__(self, roi, threshold=127, invert=False, lang="jpn", layout=6):
+        self.roi = roi
+        self.threshold = threshold
+        self.invert = invert
+        self.lang = lang
+        self.layout = layout
+        self._last_key = None
+        self._last_text = None
+
+    def __call__(self, ctx):
+        import cv2
+        from .ocr import _tesseract, image_key
+        x, y, w, h = self.roi
+        mode = cv2.THRESH_BINARY_INV if self.invert else cv2.THRESH_BINARY
+        _, binary = cv2.threshold(ctx.gray[y:y + h, x:x + w], self.threshold, 255, mode)
+        key = image_key(binary)
+        if key != self._last_key:
+            self._last_key = key
+            self._last_text = _tesseract(binary, self.lang, self.layout)
+        return self._last_text
+
+
+def _worker_main(ring_name, shape, slots, tasks, new_frame, stop, conn):
+    """ワーカープロセス: 新しいフレームごとにタスクを実行し、変わった結果を送る"""
+    ring = FrameRing(shape, slots, name=ring_name)
+    frame = np.empty(ring.shape, np.uint8)
+    last_number = -1
+    last_values = {}
+    try:
+        while not stop.is_set():
+            if not new_frame.wait(0.1):
+                continue
+            new_frame.clear()
+            frame, number = ring.read_latest(frame)
+            if frame is None:
+                frame = np.empty(ring.shape, np.uint8)
+                continue
+            if number == last_number:
+                continue
+            last_number = number
+            ctx = FrameContext(frame, number)
+            for name, task in tasks.items():
+                try:
+                    value = task(ctx)
+                except Exception as e:
+                    conn.send((name, number, None, f"{type(e).__name__}: {e}"))
+                    continue
+                if name not in last_values or last_values[name] != value:
+                    last_values[name] = value
+                    conn.send((name, number, value, None))
+    finally:
+        ring.close()
+        conn.close()
+
+
+def _capture_main(device_id, ring_name, shape, slots, new_frame, stop):
+    """キャプチャプロセス: キャプチャデバイスのフレームをリングバッファに書き込む"""
+    import cv2
+    ring = FrameRing(shape, slots, name=ring_name)
+    cap = cv2.VideoCapture(device_id)
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('Y', 'U', 'Y', 'V'))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, shape[1])
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, shape[0])
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    try:
+        while not stop.is_set():
+            ret, frame = cap.read()
+            if ret and frame.shape == ring.shape:
+                ring.write(frame)
+                new_frame.set()
+    finally:
+        cap.release()
+        ring.close()
+
+
+class VisionWorker:
+    """
+    別プロセスでの画像認識
+    """
+
+    def __init__(self, tasks: dict, shape=(720, 1280, 3), slots=4):
+        """
+        tasks: {名前: タスク}
+        shape: フレームの形
+        slots: リングバッファのスロット数
+        """
+        self.tasks = tasks
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.results = {}  # {名前: (フレーム番号, 値)}
+        self.errors = {}  # {名前: (フレーム番号, エラー)}
+        self.ring = None
+        self._callbacks = []
+        self._cond = threading.Condition()
+        # コントローラのプロセスのスレッドを引き継がないようにspawnで起動する
+        self._ctx = multiprocessing.get_context("spawn")
+        self._new_frame = self._ctx.Event()
+        self._stop = self._ctx.Event()
+        self._processes = []
+        self._conn = None
+        self._thread = None
+
+    def start(self, device_id=None):
+        """
+        ワーカープロセスを起動する
+        device_id: キャプチャデバイス (None: submit() でフレームを渡す)
+        """
+        self.ring = FrameRing(self.shape, self.slots)
+        self._stop.clear()
+        recv_conn, send_conn = self._ctx.Pipe(duplex=False)
+        self._conn = recv_conn
+        worker = self._ctx.Process(target=_worker_main, daemon=True,
+                                   args=(self.ring.name, self.shape, self.slots, self.tasks,
+                                         self._new_frame, self._stop, send_conn))
+        worker.start()
+        send_conn.close()
+        self._processes.append(worker)
+        if device_id is not None:
+            capture = self._ctx.Process(target=_capture_main, daemon=True,
+                                        args=(device_id, self.ring.name, self.shape, self.slots,
+                                              self._new_frame, self._stop))
+            capture.start()
+            self._processes.append(capture)
+        self._thread = threading.Thread(target=self._recv_loop, daemon=True)
+        self._thread.start()
+
+    def add_callback(self, callback):
+        """
+        結果を受け取る関数を追加する (受信スレッドから呼ばれる)
+        callback: callback(名前, フレーム番号, 値) の形の関数
+        """
+        self._callbacks.append(callback)
+
+    def submit(self, frame) -> int:
+        """
+        フレームを渡す (キャプチャデバイスを使わない場合)
+        Return: フレーム番号
+        """
+        n = self.ring.write(frame)
+        self._new_frame.set()
+        return n
+
+    def get_frame(self):
+        """最新のフレームのコピー | None"""
+        return self.ring.read_latest()[0]
+
+    def latest(self, name: str, default=None):
+        """タスクの最新の結果"""
+        result = self.results.get(name)
+        return default if result is None else result[1]
+
+    def wait_for(self, name: str, predicate=bool, timeout=None, after=-1):
+        """
+        タスクの結果が条件を満たすまで待機する
+        predicate: 値を受け取り、条件を満たすとTrueを返す関数
+        after: このフレーム番号より後の結果だけを対象にする
+        Return: 条件を満たした値 | None (タイムアウト)
+        """
+        def ready():
+            result = self.results.get(name)
+            return result is not None and result[0] > after and predicate(result[1])
+
+        with self._cond:
+            if not self._cond.wait_for(ready, timeout):
+                return None
+            return self.results[name][1]
+
+    def close(self):
+        """ワーカープロセスを停止する"""
+        self._stop.set()
+        for process in self._processes:
+            process.join(2.0)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def _recv_loop(self):
+        while True:
+            try:
+                name, number, value, error = self._conn.recv()
+            except (EOFError, OSError):
+                return
+            if error is not None:
+                self.errors[name] = (number, error)
+                _logger.warning(f"Vision task {name} failed: {error}")
+                continue
+            with self._cond:
+                self.results[name] = (number, value)
+                self._cond.notify_all()
+            for callback in self._callbacks:
+                try:
+                    callback(name, number, value)
+                except Exception:
+                    _logger.exception("Vision callback error")
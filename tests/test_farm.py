@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+複数のワーカーでのジョブの実行 (子プロセスの simulated_resources で実行する)
+
+ジョブの関数はワーカーの子プロセスで名前から読み込まれるため、このモジュールに置く。
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.farm import Farm, Job, LocalWorker, simulated_resources
+
+
+def grind(ctx):
+    """Aを押して1周とする"""
+    while ctx.running():
+        with ctx.stage("press"):
+            ctx.procon.push_button("button_a", hold_time=0.05, delay_time=0.05)
+        ctx.cycle()
+
+
+def fail_once(ctx, marker):
+    """初回だけ例外で失敗する"""
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        raise RuntimeError("first attempt")
+    grind(ctx)
+
+
+def always_fail(ctx):
+    raise RuntimeError("always")
+
+
+def crash_once(ctx, marker, after=2):
+    """初回だけ after 周した後にワーカーのプロセスごと落ちる"""
+    while ctx.running():
+        if ctx.cycles == after and not os.path.exists(marker):
+            open(marker, "w").close()
+            os._exit(1)
+        ctx.procon.push_button("button_a", hold_time=0.05, delay_time=0.05)
+        ctx.cycle()
+
+
+def run_farm(jobs, workers=1, **kwargs):
+    farm = Farm([LocalWorker(f"w{i}", simulated_resources) for i in range(workers)], restart_delay=0.0, **kwargs)
+    for job in jobs:
+        farm.submit(job)
+    farm.start()
+    try:
+        assert farm.join(timeout=60.0)
+        return farm.metrics()
+    finally:
+        farm.stop()
+
+
+def test_jobs_are_done_up_to_cycle_limit():
+    jobs = [Job("a", grind, cycles=3), Job("a", grind, cycles=2)]
+    metrics = run_farm(jobs, workers=2)
+    # 同じ名前のジョブも別々に集計する
+    assert {k: (v["name"], v["status"], v["cycles"]) for k, v in metrics["jobs"].items()} == {
+        jobs[0].id: ("a", "done", 3), jobs[1].id: ("a", "done", 2)}
+    assert metrics["jobs"][jobs[0].id]["stages"]["press"]["count"] == 3
+    assert sum(w["cycles"] for w in metrics["workers"].values()) == 5
+
+
+def test_error_is_retried(tmp_path):
+    job = Job("retry", fail_once, args=(str(tmp_path / "failed"),), cycles=2)
+    metrics = run_farm([job])
+    info = metrics["jobs"][job.id]
+    assert (info["status"], info["cycles"]) == ("done", 2)
+    assert info["errors"] == ["RuntimeError: first attempt"]
+    assert job.attempts == 2
+
+
+def test_error_fails_after_max_attempts():
+    job = Job("broken", always_fail, max_attempts=2)
+    metrics = run_farm([job])
+    assert metrics["jobs"][job.id]["status"] == "failed"
+    assert metrics["jobs"][job.id]["errors"] == ["RuntimeError: always"] * 2
+    assert metrics["workers"]["w0"]["jobs_failed"] == 1
+
+
+def test_crashed_worker_is_restarted_and_job_resumes(tmp_path):
+    farm = Farm([LocalWorker("w0", simulated_resources)], max_restarts=1, restart_delay=0.0)
+    jobs = [Job(f"crash{i}", crash_once, args=(str(tmp_path / f"crash{i}"),), cycles=5) for i in range(2)]
+    farm.start()
+    try:
+        # max_restarts=1 でも、ワーカーが落ちずにジョブを終えれば数え直すため2回目も作り直せる
+        for job in jobs:
+            farm.submit(job)
+            assert farm.join(timeout=60.0)
+        metrics = farm.metrics()
+    finally:
+        farm.stop()
+    for job in jobs:
+        info = metrics["jobs"][job.id]
+        # 落ちる前の2周を数えたまま続けるため、上限を超えて回らない
+        assert (info["status"], info["cycles"]) == ("done", 5)
+        assert job.completed == 5
+    worker = metrics["workers"]["w0"]
+    assert (worker["state"], worker["restarts"], worker["failures"]) == ("idle", 2, 0)
+    assert worker["cycles"] == 10  # ジョブごとに 落ちる前の2周 + 再開後の3周
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+import piswitch で重いパッケージを読み込まず、短時間で読み込めることの確認
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+# import piswitch.procon にかけてよい時間[s] (現状は数十ms。重いパッケージを読み込むと超える)
+IMPORT_TIME_LIMIT = 0.3
+sys.path.insert(0, ROOT)
+import piswitch
+
+
+def test_import_is_stdlib_only():
+    code = "import sys, piswitch; print(sorted(m for m in ('cv2', 'numpy', 'PIL') if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "[]"
+
+
+def test_lazy_submodules_exist():
+    for name in piswitch._LAZY_SUBMODULES:
+        assert os.path.exists(os.path.join(ROOT, "piswitch", f"{name}.py")), name
+
+
+def test_procon_import_time_is_bounded():
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import piswitch.procon"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    # "import time: self [us] | cumulative | imported package" の行から piswitch 以下の時間を集計する
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            cumulative[fields[2].strip()] = int(fields[1]) / 1e6
+    total = cumulative["piswitch"] + cumulative["piswitch.procon"]
+    slowest = sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:5]
+    assert total < IMPORT_TIME_LIMIT, f"import piswitch.procon took {total:.3f}s: {slowest}"
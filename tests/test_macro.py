@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+マクロのコンパイル・逆アセンブル・検証と実行
+"""
+
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.fake_gadget import FakeGadget
+from piswitch.macro import (OP_JUMP, OP_LOOP, OP_NEXT, OP_STOP, OP_WAIT, Macro, MacroError, MacroRunner,
+                            compile_macro, disassemble, validate)
+from piswitch.procon import Procon
+
+SOURCE = """
+label top
+press a 2 1
+loop 2
+    hold b
+    wait 1
+    release b
+end
+stick l 90 1.0
+if done goto finish
+goto top
+label finish
+stick l center
+"""
+
+DISASSEMBLY = """\
+0000: HOLD     a
+0002: WAIT     2
+0005: RELEASE  a
+0007: WAIT     1
+000a: LOOP     2
+000d: HOLD     b
+000f: WAIT     1
+0012: RELEASE  b
+0014: NEXT     000d
+0017: STICK    l x=0 y=32767
+001d: IF_EVENT done 0024
+0021: JUMP     0000
+0024: STICK    l x=0 y=0
+002a: STOP"""
+
+
+def test_compile_and_disassemble():
+    macro = compile_macro(SOURCE)
+    assert macro.events == ["done"]
+    assert disassemble(macro) == DISASSEMBLY
+
+
+def test_round_trip_through_bytes():
+    macro = compile_macro(SOURCE)
+    loaded = Macro.from_bytes(macro.to_bytes())
+    assert loaded.code == macro.code
+    assert loaded.events == macro.events
+    assert disassemble(loaded) == DISASSEMBLY
+
+
+@pytest.mark.parametrize("source, message", [
+    ("goto nowhere", "unknown label"),
+    ("loop 2\nlabel inner\nwait 1\nend\ngoto inner", "crosses a loop boundary"),
+    ("label outer\nloop 2\ngoto outer\nend", "crosses a loop boundary"),
+    ("loop 2\nwait 1", "'loop' without 'end'"),
+    ("end", "'end' without 'loop'"),
+    ("press nothing", "unknown button"),
+])
+def test_invalid_source_is_rejected(source, message):
+    with pytest.raises(MacroError, match=message):
+        compile_macro(source)
+
+
+@pytest.mark.parametrize("code, message", [
+    # 命令の途中への分岐
+    (bytes([OP_WAIT, 1, 0, OP_JUMP]) + struct.pack("<H", 1), "invalid jump target"),
+    # 範囲外への分岐
+    (bytes([OP_JUMP]) + struct.pack("<H", 0x100), "invalid jump target"),
+    # 対応するLOOPのないNEXT
+    (bytes([OP_NEXT]) + struct.pack("<H", 0) + bytes([OP_STOP]), "NEXT without LOOP"),
+    # LOOPの本体の先頭以外に戻るNEXT
+    (bytes([OP_WAIT, 1, 0, OP_LOOP, 2, 0, OP_NEXT]) + struct.pack("<H", 0) + bytes([OP_STOP]), "does not match LOOP"),
+    (bytes([OP_WAIT, 1, 0]), "must end with STOP or JUMP"),
+    (bytes([0xee]), "unknown opcode"),
+])
+def test_invalid_bytecode_is_rejected(code, message):
+    with pytest.raises(MacroError, match=message):
+        validate(Macro(code, []))
+
+
+def test_from_bytes_validates():
+    data = bytearray(compile_macro("wait 1").to_bytes())
+    data[-1] = 0xee
+    with pytest.raises(MacroError):
+        Macro.from_bytes(bytes(data))
+
+
+def test_runner_executes_one_frame_per_call():
+    procon = Procon(gadget=FakeGadget())
+    runner = MacroRunner(compile_macro("press a 2 1\nloop 2\nhold b\nwait 1\nrelease b\nend\nstick l 90 1.0"))
+    states = []
+    while not runner.finished.is_set():
+        runner(procon)
+        states.append((procon.control.button_a, procon.control.button_b, bytes(procon.control_data[4:7])))
+    neutral = procon.stick_encoder.encode_bytes("l", 0.0, 0.0)
+    up = procon.stick_encoder.encode_bytes("l", 0.0, 1.0)
+    # WAIT n は n フレーム後に次の命令へ進む。ループの2回目は同じフレームで離して押し直す
+    assert states == [(1, 0, neutral), (1, 0, neutral), (0, 0, neutral), (0, 1, neutral), (0, 1, neutral), (0, 0, up)]
+    assert not runner.running
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+ネットワーク経由の入力の送受信 (localhostでの往復)
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.fake_gadget import FakeGadget
+from piswitch.netinput import NetInputClient, NetInputServer, encode_packet, NEUTRAL_STATE, STATE_LEN
+from piswitch.procon import Procon
+
+
+def state_with(button_a: bool) -> bytes:
+    state = bytearray(NEUTRAL_STATE)
+    if button_a:
+        state[0] |= 0x08
+    return bytes(state)
+
+
+def wait_applied(server, procon, expected: bytes, timeout=2.0) -> bool:
+    """ボタンが expected と同じになるまで反映する (スティックは較正値の中心になる)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        server(procon)
+        if bytes(procon.control_data[1:4]) == expected[0:3]:
+            assert bytes(procon.control_data[4:10]) == procon.stick_encoder.neutral()
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def test_udp_round_trip():
+    server = NetInputServer(host="127.0.0.1", port=0)
+    server.start()
+    client = NetInputClient("127.0.0.1", server.port)
+    procon = Procon(gadget=FakeGadget())
+    try:
+        client.send(state_with(True))
+        assert wait_applied(server, procon, state_with(True))
+        client.send(state_with(False))
+        assert wait_applied(server, procon, state_with(False))
+        stats = server.stats()
+        assert stats["received"] == 2
+        assert stats["lost"] == 0
+        assert stats["invalid"] == 0
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_lost_release_is_recovered():
+    server = NetInputServer()
+    procon = Procon(gadget=FakeGadget())
+    now = time.time_ns()
+    changed = b"\x08" + bytes(STATE_LEN - 1)
+    server.feed(encode_packet(1, b"\xff" * STATE_LEN, state_with(True), now), now)
+    assert wait_applied(server, procon, state_with(True))
+    # seq 2 (Aを離す) が失われ、seq 3 は他の変化のない差分
+    server.feed(encode_packet(3, bytes(STATE_LEN), state_with(False), now + 2), now + 2)
+    assert wait_applied(server, procon, state_with(False))
+    assert server.lost == 1
+    # 古いパケットは反映しない
+    server.feed(encode_packet(2, changed, state_with(True), now + 1), now + 1)
+    server(procon)
+    assert bytes(procon.control_data[1:4]) == state_with(False)[0:3]
+    assert server.dropped == 1
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+通知の送信キュー (FileBackend に保存して確認する)
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.notify import FileBackend, Notifier
+
+
+class TimedBackend(FileBackend):
+    """送信した時刻も記録する"""
+
+    def __init__(self, dir_path: str):
+        super().__init__(dir_path)
+        self.times = []
+        self.texts = []
+
+    def send_text(self, text: str):
+        self.times.append(time.monotonic())
+        self.texts.append(text)
+        super().send_text(text)
+
+    def send_image(self, text: str, data: bytes, filename: str):
+        self.times.append(time.monotonic())
+        self.texts.append(text)
+        with open(os.path.join(self.dir_path, filename), "wb") as f:
+            f.write(data)
+
+
+def test_messages_are_coalesced_and_rate_limited(tmp_path):
+    backend = TimedBackend(str(tmp_path))
+    notifier = Notifier(backend, min_interval=0.3)
+    assert notifier.notify_image("screen", b"jpeg", "ss.jpg")
+    # 画像の送信後の待ち時間の間に積まれたメッセージは1つにまとめる (同じ内容は1回だけ)
+    for text in ("b", "c", "b"):
+        assert notifier.notify(text)
+    notifier.close()
+    assert backend.texts == ["screen", "b\nc"]
+    assert notifier.sent == 2 and notifier.dropped == 0
+    assert backend.times[1] - backend.times[0] >= 0.3
+    with open(tmp_path / "ss.jpg", "rb") as f:
+        assert f.read() == b"jpeg"
+    with open(tmp_path / "messages.log") as f:
+        assert f.read().endswith("] b\nc\n")
+
+
+def test_image_is_not_merged_with_messages(tmp_path):
+    backend = TimedBackend(str(tmp_path))
+    notifier = Notifier(backend, min_interval=0.1)
+    notifier.notify("first")
+    notifier.notify("second")
+    notifier.notify_image("screen", b"jpeg", "ss.jpg")
+    notifier.notify("third")
+    notifier.close()
+    # メッセージは画像をまたいでまとめない
+    assert backend.texts[-2:] == ["screen", "third"]
+    assert "\n".join(backend.texts[:-2]) == "first\nsecond"
+    assert all(b - a >= 0.1 for a, b in zip(backend.times, backend.times[1:]))
+
+
+def test_full_queue_drops_notifications(tmp_path):
+    entered = threading.Event()
+    release = threading.Event()
+
+    class BlockingBackend(FileBackend):
+        def send_text(self, text: str):
+            entered.set()
+            release.wait(5.0)
+            super().send_text(text)
+
+    notifier = Notifier(BlockingBackend(str(tmp_path)), maxsize=1, min_interval=0.0)
+    assert notifier.notify("sending")
+    assert entered.wait(5.0)
+    assert notifier.notify("queued")
+    assert not notifier.notify("dropped")
+    release.set()
+    notifier.close()
+    assert (notifier.sent, notifier.dropped) == (2, 1)
+    with open(tmp_path / "messages.log") as f:
+        lines = f.read().splitlines()
+    assert [line.split("] ", 1)[1] for line in lines] == ["sending", "queued"]
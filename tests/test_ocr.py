@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+OCRサービスの非同期の呼び出し (Tesseractの代わりにスレッドで偽の結果を返す)
+"""
+
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch import ocr as ocr_module
+from piswitch.ocr import OcrService
+
+
+def test_recognize_async_does_not_block_event_loop(monkeypatch):
+    release = threading.Event()
+
+    def fake_tesseract(img, lang, layout):
+        release.wait(5.0)
+        return "12345"
+
+    monkeypatch.setattr(ocr_module, "_tesseract", fake_tesseract)
+    service = OcrService()
+    service._executor = ThreadPoolExecutor(max_workers=1)
+    img = np.zeros((24, 120), np.uint8)
+    img[4:20, 10:20] = 255
+
+    async def run():
+        task = asyncio.ensure_future(service.recognize_async(img, None))
+        # OCRの結果を待つ間もイベントループは他の処理を進められる
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        release.set()
+        return await task
+
+    try:
+        assert asyncio.run(run()) == "12345"
+        # 同じ画像はキャッシュから返す
+        assert asyncio.run(service.recognize_async(img.copy())) == "12345"
+        assert (service.misses, service.hits) == (1, 1)
+    finally:
+        service.close()
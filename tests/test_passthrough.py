@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+ゲームパッドのパススルー (SyntheticSource の入力イベントを反映する)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.fake_gadget import FakeGadget
+from piswitch.passthrough import CODES, EV_ABS, EV_KEY, Passthrough, SyntheticSource
+from piswitch.procon import Procon
+
+
+def make(mapping=None):
+    source = SyntheticSource()
+    procon = Procon(gadget=FakeGadget())
+    return source, Passthrough(source, mapping), procon
+
+
+def test_buttons_and_sticks_are_applied():
+    source, passthrough, procon = make()
+    source.push(EV_KEY, CODES["BTN_EAST"], 1)
+    source.push(EV_ABS, CODES["ABS_HAT0Y"], -1)
+    source.push(EV_ABS, CODES["ABS_X"], 32767)
+    passthrough(procon)
+    assert procon.control.button_a == 1
+    assert procon.control.dpad_up == 1
+    assert bytes(procon.control_data[4:7]) == procon.stick_encoder.encode_bytes("l", 1.0, 0.0)
+    source.push(EV_KEY, CODES["BTN_EAST"], 0)
+    source.push(EV_ABS, CODES["ABS_HAT0Y"], 0)
+    passthrough(procon)
+    assert procon.control.button_a == 0
+    assert procon.control.dpad_up == 0
+
+
+def test_unmapped_bits_are_kept():
+    source, passthrough, procon = make({"BTN_EAST": "a", "ABS_X": ("lx", False)})
+    procon.control.charging_grip = 1
+    procon.set_button_state("button_b", True)
+    procon.set_stick("r", 0.0, 1.0)
+    right = bytes(procon.control_data[7:10])
+    source.push(EV_KEY, CODES["BTN_EAST"], 1)
+    source.push(EV_ABS, CODES["ABS_X"], -32768)
+    passthrough(procon)
+    assert (procon.control.button_a, procon.control.button_b, procon.control.charging_grip) == (1, 1, 1)
+    assert bytes(procon.control_data[4:7]) == procon.stick_encoder.encode_bytes("l", -1.0, 0.0)
+    assert bytes(procon.control_data[7:10]) == right
+    source.push(EV_KEY, CODES["BTN_EAST"], 0)
+    passthrough(procon)
+    assert (procon.control.button_a, procon.control.button_b, procon.control.charging_grip) == (0, 1, 1)
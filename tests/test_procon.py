@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Procon の入力レポートの列をゴールデンファイルと比較する
+
+VirtualClock と FakeGadget を使うため、実機なしで実時間を待たずに実行できる。
+ゴールデンファイルを作り直す場合は PISWITCH_UPDATE_GOLDEN=1 を設定して実行する。
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.clock import VirtualClock
+from piswitch.fake_gadget import FakeGadget
+from piswitch.procon import Procon
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "golden")
+
+
+def check_golden(gadget: FakeGadget, name: str):
+    path = os.path.join(GOLDEN_DIR, name)
+    if os.environ.get("PISWITCH_UPDATE_GOLDEN"):
+        gadget.save(path)
+    assert gadget.matches(path), f"{name} does not match (PISWITCH_UPDATE_GOLDEN=1 to update)"
+
+
+def simulated_procon():
+    clock = VirtualClock()
+    gadget = FakeGadget(clock)
+    con = Procon(gadget=gadget, clock=clock)
+    con.start()
+    return con, clock, gadget
+
+
+def test_push_button_golden():
+    con, clock, gadget = simulated_procon()
+    con.push_button("a")
+    con.move_left_stick(90, 1.0)
+    con.push_button("dpad_down", hold_time=0.1, delay_time=0.05, repeat_count=2)
+    con.close()
+    check_golden(gadget, "push_button.txt")
+
+
+def test_press_until_golden():
+    con, clock, gadget = simulated_procon()
+    frames = {}
+
+    def get_frame():
+        # 30fpsのフレーム。仮想時間で1.2秒以降に条件を満たす
+        n = int(clock.monotonic() * 30)
+        return frames.setdefault(n, (n, clock.monotonic() >= 1.2))
+
+    result = con.press_until([("a", 0.15, 1.0)] * 3, lambda f: f[1], get_frame, timeout=5.0)
+    assert result.matched
+    assert result.actions == 2
+    assert result.elapsed == 1.2
+    # 仮想時間は条件を満たした時点までしか進まない
+    assert clock.monotonic() == 1.2
+    con.close()
+    check_golden(gadget, "press_until.txt")
+
+
+def test_press_until_timeout():
+    con, clock, gadget = simulated_procon()
+    result = con.press_until([("b", 0.1, 0.1)], lambda f: False, lambda: object(), timeout=2.0)
+    assert not result.matched
+    assert result.actions == 1
+    assert clock.monotonic() == 2.0
+
+
+def uart_packet(subcmd: int, args: bytes) -> bytes:
+    """ホストからのUARTのサブコマンドのパケット"""
+    return bytes([0x01, 0x00]) + bytes(8) + bytes([subcmd]) + args + bytes(64 - 11 - len(args))
+
+
+@pytest.mark.parametrize("mode", [0x30, 0x31, 0x3F])
+def test_report_mode_golden(mode):
+    con, clock, gadget = simulated_procon()
+    # サブコマンド0x03で形式を切り替える
+    con.handle_packet(uart_packet(0x03, bytes([mode])))
+    con.push_button("button_a", hold_time=0.05, delay_time=0.05)
+    con.move_left_stick(90, 1.0)
+    con.push_button("dpad_down", hold_time=0.05, delay_time=0.05)
+    con.close()
+    assert all(len(d) == 64 for _, d in gadget.reports(mode))
+    assert len(gadget.reports(mode)) == len([d for _, d in gadget.sent if d[0] != 0x21])
+    check_golden(gadget, f"report_{mode:02x}.txt")
+
+
+def test_failing_tick_hook_is_removed():
+    con, clock, gadget = simulated_procon()
+    calls = []
+
+    def broken(procon):
+        raise RuntimeError("broken")
+
+    def counter(procon):
+        calls.append(procon.counter)
+
+    con.add_tick_hook(broken)
+    con.add_tick_hook(counter)
+    con.send_report()
+    assert con.tick_hooks == (counter,)
+    con.send_report()
+    assert len(calls) == 2
+    assert con.remove_tick_hook(counter)
+    assert not con.remove_tick_hook(counter)
+    con.send_report()
+    assert len(calls) == 2
+    con.close()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+解像度に依存しないROIの切り出しとキャプチャの形式の選択 (合成したフレーム)
+"""
+
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.capture import Capture
+from piswitch.roi import RoiRegistry
+
+
+def synthetic_bgr(w=1280, h=720, seed=1):
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur((rng.random((h, w, 3)) * 255).astype(np.uint8), (7, 7), 0)
+
+
+def to_yuyv(bgr):
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_YUY2)
+
+
+def test_choose_mode_considers_width_and_aspect():
+    rois = RoiRegistry()
+    rois.add_pixels("money", 1111, 16, 120, 24, scale=0.5)
+    assert rois.choose_mode() == (640, 360, "YUYV")
+    # 高さは足りても幅が足りない形式や、縦横比の違う形式は選ばない
+    modes = [(640, 480, "YUYV"), (800, 450, "YUYV"), (480, 400, "YUYV")]
+    assert rois.choose_mode(modes) == (800, 450, "YUYV")
+    rois.add_pixels("digits", 0, 0, 10, 10, scale=1.0)
+    assert rois.choose_mode(modes) == (800, 450, "YUYV")  # 足りない場合は同じ縦横比で最大
+    assert rois.choose_mode([(640, 480, "YUYV"), (1280, 960, "YUYV")]) == (1280, 960, "YUYV")
+
+
+def test_extract_yuyv_with_odd_offset():
+    bgr = synthetic_bgr()
+    yuyv = to_yuyv(bgr)
+    rois = RoiRegistry()
+    rois.add_pixels("odd", 101, 31, 47, 20)
+    # グレースケールは輝度(Y)をそのまま切り出す
+    gray = rois.extract(yuyv, gray=True, yuyv=True)["odd"]
+    assert gray.shape == (20, 47)
+    assert np.array_equal(gray, yuyv[31:51, 101:148, 0])
+    # カラーはフレーム全体を変換した場合と同じになる (色を共有する2画素の組を崩さない)
+    color = rois.extract(yuyv, gray=False, yuyv=True)["odd"]
+    assert np.array_equal(color, cv2.cvtColor(yuyv, cv2.COLOR_YUV2BGR_YUYV)[31:51, 101:148])
+
+
+def test_extract_rescales_to_base_size():
+    rois = RoiRegistry()
+    rois.add_pixels("money", 1111, 16, 120, 24)
+    full = synthetic_bgr()
+    low = cv2.resize(full, (640, 360), interpolation=cv2.INTER_AREA)
+    expected = rois.extract(full)["money"]
+    scaled = rois.extract(to_yuyv(low), yuyv=True)["money"]
+    assert scaled.shape == expected.shape == (24, 120)
+    assert np.abs(scaled.astype(int) - expected).mean() < 8
+    assert rois.extract(low, base_size=None)["money"].shape == (12, 60)
+    out = {}
+    first = rois.extract(low, out=out)["money"]
+    assert rois.extract(low, out=out)["money"] is first
+
+
+class FakeVideoCapture:
+    """cv2.VideoCapture の代わりに決めたデータを返す"""
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.props = {}
+
+    def read(self):
+        return True, self.frames.pop(0)
+
+    def set(self, prop, value):
+        self.props[prop] = value
+        return True
+
+    def release(self):
+        pass
+
+
+def fake_capture(frames, size=(640, 360)):
+    cap = Capture.__new__(Capture)
+    cap.cap = FakeVideoCapture(frames)
+    cap.size = size
+    cap.raw = True
+    return cap
+
+
+def test_raw_frame_layouts():
+    yuyv = to_yuyv(synthetic_bgr(640, 360))
+    padded = np.zeros((360, 640 * 2 + 64), np.uint8)
+    padded[:, :640 * 2] = yuyv.reshape(360, -1)
+    cap = fake_capture([yuyv.reshape(-1, 2), yuyv.reshape(1, -1), padded])
+    for _ in range(3):
+        assert np.array_equal(cap._read(), yuyv)
+    assert cap.raw
+
+
+def test_unexpected_raw_frame_falls_back_to_converted():
+    bgr = synthetic_bgr(640, 360)
+    cap = fake_capture([np.zeros((1, 1000), np.uint8), bgr])
+    assert cap._read() is None
+    assert not cap.raw
+    assert cap.cap.props[cv2.CAP_PROP_CONVERT_RGB] == 1
+    assert cap._read() is bgr
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+テンプレートの探索 (合成したフレーム)
+"""
+
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.search import TemplateSearcher
+from piswitch.template import Template
+
+
+def synthetic_frame(seed=1):
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur((rng.random((720, 1280)) * 255).astype(np.uint8), (5, 5), 0)
+
+
+def template_at(frame, x, y, w=60, h=40):
+    return Template("t", None, 128, frame[y:y + h, x:x + w].copy())
+
+
+def test_find_in_whole_frame():
+    frame = synthetic_frame()
+    match = TemplateSearcher().find(frame, template_at(frame, 603, 301))
+    assert (match.x, match.y, match.w, match.h) == (603, 301, 60, 40)
+
+
+def test_area_not_aligned_to_pyramid():
+    frame = synthetic_frame()
+    searcher = TemplateSearcher()
+    # 範囲の終わりがテンプレートの終わりと一致する (縮小した段で範囲が狭まると見つからない)
+    match = searcher.find(frame, template_at(frame, 603, 301), area=(500, 250, 163, 91))
+    assert match is not None and (match.x, match.y) == (603, 301)
+    # 範囲から1画素でもはみ出す位置は返さない
+    assert searcher.find(frame, template_at(frame, 603, 301), area=(500, 250, 162, 91)) is None
+    assert searcher.find(frame, template_at(frame, 603, 301), area=(604, 250, 100, 100)) is None
+
+
+def test_reused_buffer_is_searched_again():
+    frame = synthetic_frame(1)
+    template = template_at(frame, 603, 301)
+    searcher = TemplateSearcher()
+    assert searcher.find(frame, template, frame_id=1) is not None
+    # 同じバッファに次のフレームを書き込む
+    frame[:] = synthetic_frame(2)
+    assert searcher.find(frame, template) is None
+    assert searcher.find(frame, template, frame_id=2) is None
+    # 同じ frame_id ならピラミッドを使い回す
+    pyramid = searcher.frame_pyramid(frame, frame_id=2)
+    assert searcher.frame_pyramid(frame, frame_id=2) is pyramid
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+セッションの記録 (フレームの重複の判定と書き込みの失敗)
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch import session as session_module
+from piswitch.session import Session, SessionRecorder
+
+
+def test_small_roi_change_is_kept(tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    frame = np.zeros((720, 1280, 3), np.uint8)
+    assert recorder.add_frame(frame, t=0.0) == 0
+    assert recorder.add_frame(frame.copy(), t=0.1) == 0  # 内容が同じ
+    changed = frame.copy()
+    changed[20, 1120] = 255  # 所持金の数字の1画素だけが変わる
+    assert recorder.add_frame(changed, t=0.2) == 1
+    recorder.close()
+    session = Session(str(tmp_path))
+    assert session.frames == [(0.0, 0), (0.1, 0), (0.2, 1)]
+    assert np.array_equal(session.load_frame(1), changed)
+
+
+def test_failed_write_is_marked_missing(tmp_path, monkeypatch):
+    real_imwrite = session_module.cv2.imwrite
+    monkeypatch.setattr(session_module.cv2, "imwrite",
+                        lambda path, frame: False if path.endswith("000000.png") else real_imwrite(path, frame))
+    recorder = SessionRecorder(str(tmp_path))
+    frame = np.zeros((8, 8, 3), np.uint8)
+    recorder.add_frame(frame, t=0.0)
+    recorder.annotate("money", 100)
+    # 書き込みのスレッドが失敗を記録するまで待つ
+    deadline = time.monotonic() + 5.0
+    while 0 not in recorder._failed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # 失敗したフレームとは重複とみなさず、新しく保存する
+    assert recorder.add_frame(frame.copy(), t=0.1) == 1
+    recorder.annotate("money", 100)
+    recorder.close()
+    session = Session(str(tmp_path))
+    assert session.missing == {0}
+    assert session.frames == [(0.1, 1)]
+    assert session.labels == [(1, "money", 100)]
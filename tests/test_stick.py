@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+スティックの較正を考慮した変換 (既定のSPI ROMを使う)
+"""
+
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.fake_gadget import FakeGadget
+from piswitch.procon import Procon
+from piswitch.stick import StickCalibration, StickEncoder, pack_stick, unpack_stick
+
+
+def default_rom():
+    return Procon(gadget=FakeGadget()).spi_rom
+
+
+def normalized(cal: StickCalibration, raw) -> tuple:
+    """12bitの値から、中心からの幅で割った値に戻す"""
+    result = []
+    for axis in (0, 1):
+        d = raw[axis] - cal.center[axis]
+        result.append(d / (cal.above[axis] if d >= 0 else cal.below[axis]))
+    return tuple(result)
+
+
+def test_center():
+    rom = default_rom()
+    encoder = StickEncoder(rom)
+    for stick in ("l", "r"):
+        cal = StickCalibration.from_spi(rom, stick)
+        assert encoder.encode(stick, 0.0, 0.0) == cal.center
+    assert encoder.neutral() == pack_stick(*encoder.encode("l", 0, 0)) + pack_stick(*encoder.encode("r", 0, 0))
+
+
+def test_full_range():
+    rom = default_rom()
+    encoder = StickEncoder(rom)
+    cal = StickCalibration.from_spi(rom, "l")
+    cx, cy = cal.center
+    assert encoder.encode("l", 1.0, 0.0) == (cx + cal.above[0], cy)
+    assert encoder.encode("l", -1.0, 0.0) == (cx - cal.below[0], cy)
+    assert encoder.encode("l", 0.0, 1.0) == (cx, cy + cal.above[1])
+    assert encoder.encode("l", 0.0, -1.0) == (cx, cy - cal.below[1])
+    # 範囲外は端に揃える
+    assert encoder.encode("l", 2.0, 0.0) == (cx + cal.above[0], cy)
+
+
+def test_shallow_angle_keeps_direction():
+    rom = default_rom()
+    encoder = StickEncoder(rom)
+    cal = StickCalibration.from_spi(rom, "l")
+    assert cal.deadzone > 0
+    for angle in (0.6, 5.0, 30.0):
+        x, y = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        nx, ny = normalized(cal, encoder.encode("l", x, y))
+        assert abs(math.degrees(math.atan2(ny, nx)) - angle) < 0.3
+
+
+def test_small_radius_leaves_deadzone():
+    rom = default_rom()
+    encoder = StickEncoder(rom)
+    cal = StickCalibration.from_spi(rom, "l")
+    x, y = encoder.encode("l", 0.01, 0.0)
+    assert math.hypot(x - cal.center[0], y - cal.center[1]) >= cal.deadzone - 1
+    # 半径に対して単調に増える
+    radii = [math.hypot(*(a - c for a, c in zip(encoder.encode("l", r / 10, 0.0), cal.center))) for r in range(1, 11)]
+    assert radii == sorted(radii)
+
+
+def test_user_calibration_override():
+    rom = default_rom()
+    encoder = StickEncoder(rom)
+    factory = StickCalibration.from_spi(rom, "l")
+    # 左スティックのユーザー較正値 (上側の幅, 中心, 下側の幅)
+    user = pack_stick(1500, 1500) + pack_stick(2100, 2000) + pack_stick(1400, 1400)
+    rom[0x80][0x10:0x1b] = b"\xb2\xa1" + user
+    cal = StickCalibration.from_spi(rom, "l")
+    assert cal.center == (2100, 2000) != factory.center
+    assert cal.above == (1500, 1500)
+    assert unpack_stick(user[3:6]) == (2100, 2000)
+    assert encoder.encode("l", 0.0, 0.0) == (2100, 2000)
+    assert encoder.encode("l", 1.0, 0.0) == (3600, 2000)
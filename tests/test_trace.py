@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+USB通信の記録の読み書き・解読・応答時間の集計・リプレイ
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from piswitch.clock import VirtualClock
+from piswitch.fake_gadget import FakeGadget
+from piswitch.procon_base import ProconBase
+from piswitch.trace import DIR_IN, DIR_OUT, TracingGadget, decode_packet, read_trace, replay, reply_latencies
+
+
+def usb_packet(cmd: int) -> bytes:
+    return bytes([0x80, cmd]) + bytes(62)
+
+
+def uart_packet(subcmd: int, args=b"") -> bytes:
+    return bytes([0x01, 0x00]) + bytes(8) + bytes([subcmd]) + args + bytes(64 - 11 - len(args))
+
+
+# 接続時の要求の例 (0x77 は応答しないサブコマンド)
+REQUESTS = [usb_packet(0x01), usb_packet(0x02), uart_packet(0x02), uart_packet(0x10, bytes([0x3d, 0x60, 0, 0, 9])),
+            uart_packet(0x03, b"\x30"), uart_packet(0x77)]
+
+
+def record_session(path=None) -> TracingGadget:
+    """ホストからの要求を ProconBase に処理させ、送受信を記録する"""
+    clock = VirtualClock()
+    fake = FakeGadget(clock)
+    gadget = TracingGadget(fake, path=path)
+    gadget.open()
+    procon = ProconBase(gadget=gadget, clock=clock)
+    for packet in REQUESTS:
+        fake.feed(packet)
+        procon.handle_packet(gadget.recv())
+    gadget.close()
+    return gadget
+
+
+def test_file_matches_ring(tmp_path):
+    path = str(tmp_path / "session.trace")
+    gadget = record_session(path)
+    assert read_trace(path) == list(gadget.ring)
+    dumped = str(tmp_path / "dump.trace")
+    gadget.dump(dumped)
+    assert read_trace(dumped) == list(gadget.ring)
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    path = str(tmp_path / "session.trace")
+    gadget = record_session(path)
+    with open(path, "ab") as f:
+        f.write(b"\x00" * 5)  # 書き込み途中の記録
+    assert len(read_trace(path)) == len(gadget.ring)
+
+
+def test_decode():
+    records = list(record_session().ring)
+    assert [decode_packet(d, data) for _, d, data in records] == [
+        "0x80 Request MAC addr",
+        "0x81 Reply Request MAC addr",
+        "0x80 Handshake",
+        "0x81 Reply Handshake",
+        "0x01 UART Request device info: 0000000000",
+        "0x21 UART reply Request device info (ack 0x82)",
+        "0x01 UART SPI flash read: 3d60000009",
+        "0x21 UART reply SPI flash read (ack 0x90)",
+        "0x01 UART Set input report mode: 3000000000",
+        "0x21 UART reply Set input report mode (ack 0x80)",
+        "0x01 UART 0x77: 0000000000",
+    ]
+
+
+def test_reply_latencies():
+    records = list(record_session().ring)
+    # 時刻を決め打ちにする (要求の 2ms 後に応答)
+    timed = [(i // 2 * 0.01 + (0.002 if d == DIR_IN else 0.0), d, data) for i, (_, d, data) in enumerate(records)]
+    latencies = reply_latencies(timed)
+    assert latencies["UART 0x77"] == [None]
+    for name in ("0x80 Request MAC addr", "0x80 Handshake", "UART Request device info", "UART SPI flash read"):
+        assert len(latencies[name]) == 1 and abs(latencies[name][0] - 0.002) < 1e-9, name
+    # 応答の前に同じ要求が繰り返された場合は、前の要求を応答なしとする
+    repeated = [(0.0, DIR_OUT, usb_packet(0x01)), (0.1, DIR_OUT, usb_packet(0x01)), (0.15, DIR_IN, records[1][2])]
+    first, second = reply_latencies(repeated)["0x80 Request MAC addr"]
+    assert first is None and abs(second - 0.05) < 1e-9
+
+
+def test_replay_matches_recording():
+    records = list(record_session().ring)
+    assert replay(records) == []
+    # 応答を書き換えると不一致として報告する
+    t, d, data = records[7]
+    tampered = records[:7] + [(t, d, data[:20] + b"\xee" + data[21:])] + records[8:]
+    mismatches = replay(tampered)
+    assert [m[1] for m in mismatches] == ["0x01 UART SPI flash read: 3d60000009"]